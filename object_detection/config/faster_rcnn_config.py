@@ -17,6 +17,10 @@ def get_default_pascal_faster_rcnn_config():
         'ratios': [0.5, 1.0, 2.0],
         'scales': [8, 16, 32],
         'extractor_stride': 16,
+        'anchor_cache_size': 512,  # 不同图片尺寸对应的 anchors 缓存数量，0 表示不缓存
+
+        # xla configs
+        'use_xla_jit': False,  # region proposal 等组件使用固定 shape 的版本，在 defun 中通过 XLA 编译
 
         # training configs
         'learning_rate_multi_decay_steps': [80000],  # 50000 for pascal 2007, 80000 for pascal 0712
@@ -28,6 +32,8 @@ def get_default_pascal_faster_rcnn_config():
         # preprocessing configs
         'image_max_size': 1000,
         'image_min_size': 600,
+        'preprocessing_type': 'caffe',  # one of [caffe, tf]
+        'uint8_image': False,  # 数据集输出 uint8 图片，在模型中进行归一化
         'bgr_pixel_means': [103.939, 116.779, 123.68],
         # 'bgr_pixel_means': [102.9801, 115.9465, 122.7717],  # for tf-faster-rcnn
 
@@ -93,6 +99,10 @@ def get_default_coco_faster_rcnn_config():
         'ratios': [0.5, 1.0, 2.0],
         'scales': [4, 8, 16, 32],
         'extractor_stride': 16,
+        'anchor_cache_size': 512,  # 不同图片尺寸对应的 anchors 缓存数量，0 表示不缓存
+
+        # xla configs
+        'use_xla_jit': False,  # region proposal 等组件使用固定 shape 的版本，在 defun 中通过 XLA 编译
 
         # training configs
         'learning_rate_multi_decay_steps': [350000],
@@ -104,6 +114,8 @@ def get_default_coco_faster_rcnn_config():
         # preprocessing configs
         'image_max_size': 1000,
         'image_min_size': 600,
+        'preprocessing_type': 'caffe',  # one of [caffe, tf]
+        'uint8_image': False,  # 数据集输出 uint8 图片，在模型中进行归一化
         # 'bgr_pixel_means': [103.939, 116.779, 123.68],
         'bgr_pixel_means': [102.9801, 115.9465, 122.7717],  # for tf-faster-rcnn
 
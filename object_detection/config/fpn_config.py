@@ -16,6 +16,8 @@ def get_default_pascal_faster_rcnn_config():
         # preprocessing configs
         'image_max_size': 1000,
         'image_min_size': 600,
+        'preprocessing_type': 'caffe',  # one of [caffe, tf]
+        'uint8_image': False,  # 数据集输出 uint8 图片，在模型中进行归一化
         'bgr_pixel_means': [103.939, 116.779, 123.68],
 
         # predict & evaluate configs
@@ -31,6 +33,10 @@ def get_default_pascal_faster_rcnn_config():
         'scales': [1.],
         'anchor_stride_list': [4, 8, 16, 32, 64],
         'base_anchor_size_list': [32, 64, 128, 256, 512],
+        'anchor_cache_size': 512,  # 不同图片尺寸对应的 anchors 缓存数量，0 表示不缓存
+
+        # xla configs
+        'use_xla_jit': False,  # region proposal 等组件使用固定 shape 的版本，在 defun 中通过 XLA 编译
 
         # training configs
         'learning_rate_multi_decay_steps': [60000, 80000],
@@ -53,6 +59,7 @@ def get_default_pascal_faster_rcnn_config():
         'rpn_proposal_test_pre_nms_sample_number': 6000,
         'rpn_proposal_test_after_nms_sample_number': 1000,
         'rpn_proposal_nms_iou_threshold': 0.7,
+        'rpn_proposal_pre_nms_per_level': False,  # True 时 nms 前对每个 level 分别获取 pre_nms_sample_number 个 anchors
 
         'roi_pooling_size': 7,
         'roi_pooling_max_pooling_flag': True,
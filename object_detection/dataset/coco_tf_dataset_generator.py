@@ -2,51 +2,83 @@ import os
 import numpy as np
 import tensorflow as tf
 from functools import partial
-from pycocotools.coco import COCO
 
 from object_detection.dataset.utils.tf_dataset_utils import image_argument_with_imgaug, preprocessing_training_func, \
-    preprocessing_eval_func
+    preprocessing_eval_func, preprocessing_training_single_func, bucket_by_aspect_ratio, get_tf_records_dataset, \
+    get_prefetch_buffer_size, get_cached_image_func, get_anchor_target_map_func, preprocessing_eval_single_func, \
+    bucket_eval_by_aspect_ratio
+from object_detection.dataset.utils.image_cache_utils import get_resized_image_cache
+from object_detection.dataset.utils.tf_argument_utils import get_tf_argument_map_func
+from object_detection.dataset.utils.imgaug_pool_utils import get_imgaug_process_pool, \
+    image_argument_with_imgaug_pool
+from object_detection.dataset.utils.coco_index_utils import get_default_index_file_path, build_coco_index, \
+    load_coco_index
 
 _COCO_TRAIN_DATASET = None
 _COCO_VAL_DATASET = None
 _COCO_TEST_DATASET = None
 
 
-def _get_global_dataset(mode, year, root_dir):
+def _get_global_dataset(mode, year, root_dir, index_file_path=None):
     global _COCO_TRAIN_DATASET, _COCO_VAL_DATASET, _COCO_TEST_DATASET
     if mode not in ['train', 'val', 'test', 'minival']:
         raise ValueError('unknown mode {}'.format(mode))
     if mode == 'train':
         if _COCO_TRAIN_DATASET is None:
-            _COCO_TRAIN_DATASET = CocoDataset(root_dir=root_dir, sub_dir=mode, year=year)
+            _COCO_TRAIN_DATASET = CocoDataset(root_dir=root_dir, sub_dir=mode, year=year,
+                                              index_file_path=index_file_path)
         coco_dataset = _COCO_TRAIN_DATASET
     elif mode == 'val':
         if _COCO_VAL_DATASET is None:
-            _COCO_VAL_DATASET = CocoDataset(root_dir=root_dir, sub_dir=mode, year=year)
+            _COCO_VAL_DATASET = CocoDataset(root_dir=root_dir, sub_dir=mode, year=year,
+                                            index_file_path=index_file_path)
         coco_dataset = _COCO_VAL_DATASET
     else:
         if _COCO_TEST_DATASET is None:
-            _COCO_TEST_DATASET = CocoDataset(root_dir=root_dir, sub_dir=mode, year=year)
+            _COCO_TEST_DATASET = CocoDataset(root_dir=root_dir, sub_dir=mode, year=year,
+                                             index_file_path=index_file_path)
         coco_dataset = _COCO_TEST_DATASET
     return coco_dataset
 
 
 class CocoDataset:
     def __init__(self, root_dir='/ssd/zhangyiyang/COCO2017', sub_dir='train', year="2017",
-                 min_edge=32, ):
+                 min_edge=32, index_file_path=None):
+        """
+        COCO 数据集的 annotation 信息，只保存列式索引（参考 `coco_index_utils`），不保存 pycocotools.COCO 对象
+        :param root_dir:
+        :param sub_dir:
+        :param year:
+        :param min_edge:            图片短边的最小值，只在没有索引文件、需要从 json 文件生成索引时使用
+        :param index_file_path:     索引文件路径，默认为 `annotations/instances_{sub_dir}{year}_index.npz`，
+                                    文件不存在时读取 json 文件生成索引（可通过 `scripts/generate_coco_index.py` 提前生成）
+        """
         if sub_dir not in ['train', 'val', 'minival']:
             raise ValueError('unknown sub dir {}'.format(sub_dir))
         if year not in ['2014', '2017']:
             raise ValueError('unknown year dir {}'.format(year))
 
         annotation_file_path = os.path.join(root_dir, 'annotations', 'instances_{}{}.json'.format(sub_dir, year))
+        if index_file_path is None:
+            index_file_path = get_default_index_file_path(root_dir, sub_dir, year)
         if sub_dir == 'minival':
             sub_dir = 'val'
         self._image_dir = os.path.join(root_dir, sub_dir + year)
 
-        self._coco = COCO(annotation_file=annotation_file_path)
-        self._get_cat_id_name_dict()
-        self._img_ids, self._img_info_dict = self._filter_images(min_edge=min_edge)
+        if os.path.exists(index_file_path):
+            index = load_coco_index(index_file_path)
+        else:
+            tf.logging.warning('coco index file {} not found, parsing {}'.format(index_file_path,
+                                                                                annotation_file_path))
+            index = build_coco_index(annotation_file_path, min_edge=min_edge)
+        self._img_ids = index['img_ids']
+        self._heights = index['heights']
+        self._widths = index['widths']
+        self._file_names = index['file_names']
+        self._bbox_offsets = index['bbox_offsets']
+        self._bboxes = index['bboxes']
+        self._labels = index['labels']
+        self._get_cat_id_name_dict(index['cat_ids'], index['cat_names'])
 
     @property
     def img_ids(self):
@@ -54,7 +86,9 @@ class CocoDataset:
 
     @property
     def img_info_dict(self):
-        return self._img_info_dict
+        return {int(img_id): {'height': int(height), 'width': int(width), 'file_name': file_name.decode('utf8')}
+                for img_id, height, width, file_name in zip(self._img_ids, self._heights,
+                                                            self._widths, self._file_names)}
 
     @property
     def cat_id_to_name_dict(self):
@@ -72,14 +106,14 @@ class CocoDataset:
     def raw_id_to_cat_id(self):
         return self._raw_id_to_cat_id
 
-    def _get_cat_id_name_dict(self):
-        cat_ids = self._coco.getCatIds()
+    def _get_cat_id_name_dict(self, cat_ids, cat_names):
         cat_id_to_name = {0: 'background'}
         name_to_cat_id = {'background': 0}
         cat_id_to_raw_id = {}
         raw_id_to_cat_id = {}
-        for idx, cat_id in enumerate(cat_ids):
-            cat_name = self._coco.loadCats(cat_id)[0]['name']
+        for idx, (cat_id, cat_name) in enumerate(zip(cat_ids, cat_names)):
+            cat_id = int(cat_id)
+            cat_name = cat_name.decode('utf8')
             cat_id_to_name[cat_id] = cat_name
             name_to_cat_id[cat_name] = cat_id
             cat_id_to_raw_id[cat_id] = idx + 1
@@ -89,75 +123,84 @@ class CocoDataset:
         self._cat_id_to_raw_id = cat_id_to_raw_id
         self._raw_id_to_cat_id = raw_id_to_cat_id
 
-    def _filter_images(self, min_edge):
-        all_img_ids = list(set([_['image_id'] for _ in self._coco.anns.values()]))
-        img_ids = []
-        img_info_dict = {}
-        for i in all_img_ids:
-            info = self._coco.loadImgs(i)[0]
-
-            ann_ids = self._coco.getAnnIds(imgIds=i)
-            ann_info = self._coco.loadAnns(ann_ids)
-            _, labels, _ = self._parse_ann_info(ann_info)
-
-            if min(info['width'], info['height']) >= min_edge and labels.shape[0] != 0:
-                img_ids.append(i)
-                img_info_dict[i] = info
-        return img_ids, img_info_dict
-
-    def _parse_ann_info(self, ann_infos):
-        """Parse bbox annotation.
-
-        Args
-        ---
-            ann_info (list[dict]): Annotation info of an image.
-
-        Returns
-        ---
-            dict: A dict containing the following keys: bboxes,
-                bboxes_ignore, labels.
+    def get_index_tensors(self):
         """
-        gt_bboxes = []
-        gt_labels = []
-        gt_labels_text = []
-
-        for i, ann in enumerate(ann_infos):
-            if ann.get('ignore', False):
-                continue
-            x1, y1, w, h = ann['bbox']
-            if ann['area'] <= 0 or w < 1 or h < 1:
-                continue
-            bbox = [y1, x1, y1 + h - 1., x1 + w - 1.]
-            gt_bboxes.append(bbox)
-            gt_labels.append(self._cat_id_to_raw_id[ann['category_id']])
-            gt_labels_text.append(self._cat_id_to_name_dict[ann['category_id']])
-
-        if gt_bboxes:
-            gt_bboxes = np.array(gt_bboxes, dtype=np.float32)
-            gt_labels = np.array(gt_labels, dtype=np.int64)
-            gt_labels_text = np.array(gt_labels_text, dtype=np.string_)
-        else:
-            gt_bboxes = np.zeros((0, 4), dtype=np.float32)
-            gt_labels = np.array([], dtype=np.int64)
-            gt_labels_text = np.array([], dtype=np.string_)
-
-        return gt_bboxes, gt_labels, gt_labels_text
+        将列式索引转换为 tensor，用于在 `tf.data` 中直接通过 gather 获取每张图片的信息，不需要 `tf.py_func`
+        :return:    dict，包括 img_ids, file_paths, heights, widths, bbox_offsets, bboxes, labels
+        """
+        file_paths = [os.path.join(self._image_dir, file_name.decode('utf8')) for file_name in self._file_names]
+        return {
+            'img_ids': tf.constant(self._img_ids, dtype=tf.int64),
+            'file_paths': tf.constant(file_paths, dtype=tf.string),
+            'heights': tf.constant(self._heights, dtype=tf.int64),
+            'widths': tf.constant(self._widths, dtype=tf.int64),
+            'bbox_offsets': tf.constant(self._bbox_offsets, dtype=tf.int64),
+            'bboxes': tf.constant(self._bboxes, dtype=tf.float32),
+            'labels': tf.constant(self._labels, dtype=tf.int64),
+        }
 
     def __getitem__(self, img_id):
-        # 获取 annotation dict 信息
-        ann_ids = self._coco.getAnnIds(imgIds=img_id)
-        ann_infos = self._coco.loadAnns(ann_ids)
-        gt_bboxes, gt_labels, _ = self._parse_ann_info(ann_infos)
+        # img_ids 升序排列，通过二分查找获取 index
+        idx = np.searchsorted(self._img_ids, img_id)
+        if idx >= len(self._img_ids) or self._img_ids[idx] != img_id:
+            raise KeyError('unknown image id {}'.format(img_id))
+        start, end = self._bbox_offsets[idx], self._bbox_offsets[idx + 1]
+        gt_bboxes = self._bboxes[start:end].copy()
+        gt_labels = self._labels[start:end].copy()
 
         # 设置 bboxes 范围为 [0, 1]
-        image_height, image_width = self._img_info_dict[img_id]['height'], self._img_info_dict[img_id]['width']
+        image_height, image_width = self._heights[idx], self._widths[idx]
         gt_bboxes[:, ::2] = gt_bboxes[:, ::2] / image_height
         gt_bboxes[:, 1::2] = gt_bboxes[:, 1::2] / image_width
 
-        file_path = os.path.join(self._image_dir, self._img_info_dict[img_id]['file_name'])
+        file_path = os.path.join(self._image_dir, self._file_names[idx].decode('utf8'))
         return file_path, gt_bboxes, image_height, image_width, gt_labels
 
 
+def _get_lookup_func(coco_dataset):
+    """
+    获取通过 index 查找单张图片信息的函数，只使用 tf.gather 以及 tf.slice，可以在 `tf.data` 中并行运行
+    bboxes 以及 labels 的保存方式与 RaggedTensor 相同，即所有图片的结果拼接在一起，通过 bbox_offsets 获取每张图片的范围
+    :param coco_dataset:    `CocoDataset` 对象
+    :return:                函数，输入为 index（int64 scalar tensor），
+                            输出为 file_path, gt_bboxes（[0, 1]范围）, image_height, image_width, gt_labels, img_id
+    """
+    index_tensors = coco_dataset.get_index_tensors()
+
+    def _lookup(idx):
+        image_height = index_tensors['heights'][idx]
+        image_width = index_tensors['widths'][idx]
+        start = index_tensors['bbox_offsets'][idx]
+        size = index_tensors['bbox_offsets'][idx + 1] - start
+        gt_bboxes = tf.slice(index_tensors['bboxes'], tf.stack([start, 0]), tf.stack([size, 4]))
+        gt_labels = tf.slice(index_tensors['labels'], tf.reshape(start, [1]), tf.reshape(size, [1]))
+
+        # 设置 bboxes 范围为 [0, 1]
+        scale = tf.to_float(tf.stack([image_height, image_width, image_height, image_width]))
+        gt_bboxes = gt_bboxes / scale
+        return index_tensors['file_paths'][idx], gt_bboxes, image_height, image_width, gt_labels, \
+               index_tensors['img_ids'][idx]
+
+    return _lookup
+
+
+def _get_read_image_func(mode, year, min_size, max_size, image_cache_dir, image_cache_max_bytes):
+    """
+    获取读取单张图片的函数，输入为 img_id, file_path, image_height, image_width，输出 uint8 rgb 图片
+    image_cache_dir 为 None 时直接解码 jpeg，否则从磁盘缓存中读取已经 resize 的图片，
+    之后 preprocessing 中根据原始尺寸计算的 resize 尺寸与缓存图片尺寸相同
+    """
+    if image_cache_dir is None:
+        return lambda img_id, file_path, image_height, image_width: \
+            tf.image.decode_jpeg(tf.io.read_file(file_path), channels=3)
+
+    image_cache = get_resized_image_cache(image_cache_dir, 'coco_{}{}'.format(mode, year),
+                                          min_size, max_size, max_bytes=image_cache_max_bytes)
+    cached_image_func = get_cached_image_func(image_cache, min_size, max_size)
+    return lambda img_id, file_path, image_height, image_width: \
+        cached_image_func(tf.as_string(img_id), file_path, image_height, image_width)
+
+
 def get_training_dataset(root_dir='D:\\data\\COCO2017',
                          mode='train', year="2017",
                          min_size=600, max_size=1000,
@@ -165,44 +208,167 @@ def get_training_dataset(root_dir='D:\\data\\COCO2017',
                          batch_size=1,
                          repeat=1,
                          shuffle=False, shuffle_buffer_size=1000,
-                         prefetch=False, prefetch_buffer_size=1000,
-                         argument=True, iaa_sequence=None):
-    coco_dataset = _get_global_dataset(mode, year, root_dir)
-
-    def _parse_coco_data_py(img_id):
-        file_path, gt_bboxes, image_height, image_width, gt_labels = coco_dataset[img_id]
-        return file_path, gt_bboxes, image_height, image_width, gt_labels
-
-    tf_dataset = tf.data.Dataset.from_tensor_slices(coco_dataset.img_ids).map(
-        lambda img_id: tuple([*tf.py_func(_parse_coco_data_py, [img_id],
-                                          [tf.string, tf.float32, tf.int64, tf.int64, tf.int64])])
-    )
-    tf_dataset = tf_dataset.map(
-        lambda file_path, gt_bboxes, image_height, image_width, gt_labels: tuple([
-            tf.image.decode_jpeg(tf.io.read_file(file_path), channels=3),
-            gt_bboxes, image_height, image_width, gt_labels
-        ])
-    )
-
+                         prefetch=False, prefetch_buffer_size=2, prefetch_max_bytes=None,
+                         argument=True, iaa_sequence=None,
+                         argument_type='imgaug', tf_argument_sequence=None,
+                         aspect_ratio_boundaries=None,
+                         index_file_path=None,
+                         uint8_image=False,
+                         image_cache_dir=None, image_cache_max_bytes=50 * 1024 ** 3,
+                         imgaug_num_workers=4, imgaug_micro_batch_size=4,
+                         shuffle_seed=None, skip=0,
+                         anchor_target_fn=None):
+    """
+    shuffle 在读取图片之前进行，即打乱所有图片的 index（不使用 shuffle_buffer_size），buffer 中不保存图片
+    shuffle_seed 相同时图片顺序相同，skip 跳过前 skip 张图片（只跳过 index，不读取图片），用于从 checkpoint 恢复训练
+    prefetch_buffer_size 为 batch 数量，可以通过 prefetch_max_bytes 限制内存
+    uint8_image 为 True 时输出 tf.uint8 rgb 图片，只进行 resize，归一化在模型中进行
+    image_cache_dir 不为 None 时，resize 后的图片保存在磁盘缓存中（参考 `ResizedImageCache`），与 eval 共享
+    """
+    coco_dataset = _get_global_dataset(mode, year, root_dir, index_file_path)
+
+    lookup_func = _get_lookup_func(coco_dataset)
+    read_image_func = _get_read_image_func(mode, year, min_size, max_size, image_cache_dir, image_cache_max_bytes)
+
+    def _parse_coco_data(idx):
+        file_path, gt_bboxes, image_height, image_width, gt_labels, img_id = lookup_func(idx)
+        return read_image_func(img_id, file_path, image_height, image_width), \
+               gt_bboxes, image_height, image_width, gt_labels
+
+    tf_dataset = tf.data.Dataset.range(len(coco_dataset.img_ids))
+    if shuffle:
+        tf_dataset = tf_dataset.shuffle(buffer_size=len(coco_dataset.img_ids), seed=shuffle_seed)
+    if skip > 0:
+        tf_dataset = tf_dataset.skip(skip)
+    tf_dataset = tf_dataset.map(_parse_coco_data, num_parallel_calls=5)
+
+    return _get_training_dataset_after_parsing(tf_dataset,
+                                               min_size=min_size, max_size=max_size,
+                                               preprocessing_type=preprocessing_type,
+                                               caffe_pixel_means=caffe_pixel_means,
+                                               batch_size=batch_size, repeat=repeat,
+                                               prefetch=prefetch, prefetch_buffer_size=prefetch_buffer_size,
+                                               prefetch_max_bytes=prefetch_max_bytes,
+                                               argument=argument, iaa_sequence=iaa_sequence,
+                                               argument_type=argument_type, tf_argument_sequence=tf_argument_sequence,
+                                               aspect_ratio_boundaries=aspect_ratio_boundaries,
+                                               uint8_image=uint8_image,
+                                               imgaug_num_workers=imgaug_num_workers,
+                                               imgaug_micro_batch_size=imgaug_micro_batch_size,
+                                               anchor_target_fn=anchor_target_fn)
+
+
+def get_training_dataset_by_tf_records(tf_records_list,
+                                       min_size=600, max_size=1000,
+                                       preprocessing_type='caffe', caffe_pixel_means=None,
+                                       batch_size=1,
+                                       repeat=1,
+                                       shuffle=False, shuffle_buffer_size=1000,
+                                       prefetch=False, prefetch_buffer_size=2, prefetch_max_bytes=None,
+                                       argument=True, iaa_sequence=None,
+                                       argument_type='imgaug', tf_argument_sequence=None,
+                                       aspect_ratio_boundaries=None,
+                                       num_parallel_reads=4, read_buffer_size=None,
+                                       uint8_image=False,
+                                       imgaug_num_workers=4, imgaug_micro_batch_size=4,
+                                       shuffle_seed=None, skip=0,
+                                       anchor_target_fn=None):
+    """
+    从 `scripts/generate_coco_tf_records.py` 生成的 tfrecords 文件中获取训练数据，
+    多个文件通过 parallel interleave 同时读取，之后的操作与 `get_training_dataset` 相同
+    :param tf_records_list:
+    :param num_parallel_reads:      同时读取的 tfrecords 文件数量
+    :param read_buffer_size:        每个 tfrecords 文件的读取 buffer 大小（bytes）
+    :param shuffle_seed:            shuffle 的随机种子，相同的 seed 得到相同的图片顺序
+    :param skip:                    跳过前 skip 张图片（解码之前），用于从 checkpoint 恢复训练
+    :return:
+    """
+    tf_dataset = get_tf_records_dataset(tf_records_list, num_parallel_reads=num_parallel_reads,
+                                        read_buffer_size=read_buffer_size, num_parallel_calls=5,
+                                        shuffle=shuffle, shuffle_buffer_size=shuffle_buffer_size,
+                                        shuffle_seed=shuffle_seed, skip=skip)
+
+    return _get_training_dataset_after_parsing(tf_dataset,
+                                               min_size=min_size, max_size=max_size,
+                                               preprocessing_type=preprocessing_type,
+                                               caffe_pixel_means=caffe_pixel_means,
+                                               batch_size=batch_size, repeat=repeat,
+                                               prefetch=prefetch, prefetch_buffer_size=prefetch_buffer_size,
+                                               prefetch_max_bytes=prefetch_max_bytes,
+                                               argument=argument, iaa_sequence=iaa_sequence,
+                                               argument_type=argument_type, tf_argument_sequence=tf_argument_sequence,
+                                               aspect_ratio_boundaries=aspect_ratio_boundaries,
+                                               uint8_image=uint8_image,
+                                               imgaug_num_workers=imgaug_num_workers,
+                                               imgaug_micro_batch_size=imgaug_micro_batch_size,
+                                               anchor_target_fn=anchor_target_fn)
+
+
+def _get_training_dataset_after_parsing(tf_dataset,
+                                        min_size, max_size,
+                                        preprocessing_type, caffe_pixel_means,
+                                        batch_size, repeat,
+                                        prefetch, prefetch_buffer_size, prefetch_max_bytes,
+                                        argument, iaa_sequence,
+                                        argument_type, tf_argument_sequence,
+                                        aspect_ratio_boundaries,
+                                        uint8_image=False,
+                                        imgaug_num_workers=4, imgaug_micro_batch_size=4,
+                                        anchor_target_fn=None):
+    """
+    数据增强、预处理、batch 等操作，shuffle 已经在解码之前进行
+    :param tf_dataset:      输出为 image（rgb uint8）, bboxes（[0, 1]范围）, image_height, image_width, labels
+    :param imgaug_num_workers:      argument_type 为 imgaug_pool 时的进程数量（参考 `ImgaugProcessPool`）
+    :param imgaug_micro_batch_size: argument_type 为 imgaug_pool 时，每次 augment_images 的图片数量
+    :param anchor_target_fn:        不为 None 时在数据集中计算 anchor target（参考 `get_anchor_target_map_func`），
+                                    只支持 batch_size 为 1
+    """
     if argument:
-        image_argument_partial = partial(image_argument_with_imgaug, iaa_sequence=iaa_sequence)
-        tf_dataset = tf_dataset.map(
-            lambda image, bboxes, image_height, image_width, labels: tuple([
-                *tf.py_func(image_argument_partial, [image, bboxes], [image.dtype, bboxes.dtype]),
-                image_height, image_width, labels]),
-            num_parallel_calls=5
-        )
+        if argument_type == 'imgaug':
+            image_argument_partial = partial(image_argument_with_imgaug, iaa_sequence=iaa_sequence)
+            tf_dataset = tf_dataset.map(
+                lambda image, bboxes, image_height, image_width, labels: tuple([
+                    *tf.py_func(image_argument_partial, [image, bboxes], [image.dtype, bboxes.dtype]),
+                    image_height, image_width, labels]),
+                num_parallel_calls=5
+            )
+        elif argument_type == 'tf':
+            # 增强可能改变图片尺寸，image_height、image_width 使用增强后的尺寸
+            tf_dataset = tf_dataset.map(get_tf_argument_map_func(tf_argument_sequence), num_parallel_calls=5)
+        elif argument_type == 'imgaug_pool':
+            imgaug_pool = get_imgaug_process_pool(iaa_sequence, num_workers=imgaug_num_workers)
+            tf_dataset = image_argument_with_imgaug_pool(tf_dataset, imgaug_pool,
+                                                         micro_batch_size=imgaug_micro_batch_size,
+                                                         num_parallel_calls=imgaug_num_workers)
+        else:
+            raise ValueError('unknown argument type {}'.format(argument_type))
 
     preprocessing_partial_func = partial(preprocessing_training_func,
                                          min_size=min_size, max_size=max_size,
-                                         preprocessing_type=preprocessing_type, caffe_pixel_means=caffe_pixel_means)
+                                         preprocessing_type=preprocessing_type, caffe_pixel_means=caffe_pixel_means,
+                                         uint8_image=uint8_image)
 
-    tf_dataset = tf_dataset.batch(batch_size=batch_size).map(preprocessing_partial_func, num_parallel_calls=5)
+    if batch_size == 1:
+        tf_dataset = tf_dataset.batch(batch_size=batch_size).map(preprocessing_partial_func, num_parallel_calls=5)
+        if anchor_target_fn is not None:
+            tf_dataset = tf_dataset.map(get_anchor_target_map_func(anchor_target_fn), num_parallel_calls=5)
+    else:
+        if anchor_target_fn is not None:
+            raise ValueError('anchor target in dataset only supports batch_size 1')
+        # 与 pascal 相同，batch_size > 1 时根据 aspect ratio 分组并 padding
+        preprocessing_partial_func = partial(preprocessing_training_single_func,
+                                             min_size=min_size, max_size=max_size,
+                                             preprocessing_type=preprocessing_type,
+                                             caffe_pixel_means=caffe_pixel_means,
+                                             uint8_image=uint8_image)
+        tf_dataset = bucket_by_aspect_ratio(tf_dataset.map(preprocessing_partial_func, num_parallel_calls=5),
+                                            batch_size=batch_size, min_size=min_size, max_size=max_size,
+                                            aspect_ratio_boundaries=aspect_ratio_boundaries)
 
-    if shuffle:
-        tf_dataset = tf_dataset.shuffle(buffer_size=shuffle_buffer_size)
     if prefetch:
-        tf_dataset = tf_dataset.prefetch(buffer_size=prefetch_buffer_size)
+        tf_dataset = tf_dataset.prefetch(buffer_size=get_prefetch_buffer_size(prefetch_buffer_size, batch_size,
+                                                                              max_size, prefetch_max_bytes,
+                                                                              uint8_image))
 
     return tf_dataset.repeat(repeat)
 
@@ -212,25 +378,60 @@ def get_eval_dataset(root_dir='D:\\data\\COCO2017',
                      min_size=600, max_size=1000,
                      preprocessing_type='caffe', caffe_pixel_means=None,
                      batch_size=1,
-                     repeat=1, ):
-    coco_dataset = _get_global_dataset(mode, year, root_dir)
+                     repeat=1,
+                     index_file_path=None,
+                     uint8_image=False,
+                     image_cache_dir=None, image_cache_max_bytes=50 * 1024 ** 3,
+                     aspect_ratio_boundaries=None,
+                     num_parallel_calls=tf.data.experimental.AUTOTUNE, prefetch_buffer_size=2):
+    """
+    解码、预处理并行进行，并预先读取 prefetch_buffer_size 个 batch，输出顺序与 img_ids 相同
+    batch_size 为 1 时输出 img, img_scale, img_height, img_width, img_id；
+    batch_size 大于 1 时通过 `bucket_eval_by_aspect_ratio` 按 aspect ratio 分组、padding，
+    输出 img, image_shape, img_scale, img_height, img_width, img_id，此时输出顺序与 img_ids 不同
+    :param aspect_ratio_boundaries: 只在 batch_size > 1 时使用
+    :param num_parallel_calls:      同时解码、预处理的线程数量，为 None 时按顺序进行
+    :param prefetch_buffer_size:    为 None 时不 prefetch
+    """
+    coco_dataset = _get_global_dataset(mode, year, root_dir, index_file_path)
+    read_image_func = _get_read_image_func(mode, year, min_size, max_size, image_cache_dir, image_cache_max_bytes)
 
     preprocessing_partial_func = partial(preprocessing_eval_func,
                                          min_size=min_size, max_size=max_size,
-                                         preprocessing_type=preprocessing_type, caffe_pixel_means=caffe_pixel_means)
+                                         preprocessing_type=preprocessing_type, caffe_pixel_means=caffe_pixel_means,
+                                         uint8_image=uint8_image)
 
-    def _parse_coco_data_py(img_id):
-        file_path, _, img_height, img_width, _ = coco_dataset[img_id]
-        img = tf.image.decode_jpeg(tf.io.read_file(file_path), channels=3)
+    lookup_func = _get_lookup_func(coco_dataset)
+
+    def _parse_coco_data(idx):
+        file_path, _, img_height, img_width, _, img_id = lookup_func(idx)
+        img = read_image_func(img_id, file_path, img_height, img_width)
         return img, img_height, img_width, img_id
 
     def _preprocessing_after_batch(img, img_height, img_width, img_id):
         img, img_scale, img_height, img_width = preprocessing_partial_func(img, img_height, img_width)
         return img, img_scale, img_height, img_width, img_id[0]
 
-    tf_dataset = tf.data.Dataset.from_tensor_slices(coco_dataset.img_ids).map(
-        lambda img_id: tuple([*tf.py_func(_parse_coco_data_py, [img_id],
-                                          [tf.uint8, tf.int64, tf.int64, tf.int32])])
-    ).batch(batch_size).map(_preprocessing_after_batch)
+    tf_dataset = tf.data.Dataset.range(len(coco_dataset.img_ids)).map(
+        _parse_coco_data, num_parallel_calls=num_parallel_calls
+    )
+    if batch_size == 1:
+        tf_dataset = tf_dataset.batch(batch_size).map(_preprocessing_after_batch, num_parallel_calls=num_parallel_calls)
+    else:
+        preprocessing_partial_func = partial(preprocessing_eval_single_func,
+                                             min_size=min_size, max_size=max_size,
+                                             preprocessing_type=preprocessing_type,
+                                             caffe_pixel_means=caffe_pixel_means,
+                                             uint8_image=uint8_image)
+
+        def _preprocessing_single(img, img_height, img_width, img_id):
+            return (*preprocessing_partial_func(img, img_height, img_width), img_id)
+
+        tf_dataset = bucket_eval_by_aspect_ratio(tf_dataset.map(_preprocessing_single,
+                                                                num_parallel_calls=num_parallel_calls),
+                                                 batch_size=batch_size, min_size=min_size, max_size=max_size,
+                                                 aspect_ratio_boundaries=aspect_ratio_boundaries)
+    if prefetch_buffer_size is not None:
+        tf_dataset = tf_dataset.prefetch(prefetch_buffer_size)
 
     return tf_dataset.repeat(repeat)
@@ -1,5 +1,7 @@
 from object_detection.dataset.coco_tf_dataset_generator import get_training_dataset as get_coco_train_dataset
 from object_detection.dataset.coco_tf_dataset_generator import get_eval_dataset as get_coco_eval_dataset
+from object_detection.dataset.coco_tf_dataset_generator import get_training_dataset_by_tf_records as \
+    get_coco_train_dataset_by_tf_records
 from object_detection.dataset.pascal_tf_dataset_generator import get_dataset as get_pascal_train_dataset
 from object_detection.dataset.eval_pascal_tf_dataset import get_dataset_by_local_file as get_pascal_eval_dataset
 
@@ -15,6 +17,8 @@ def dataset_factory(dataset_type, mode, configs):
     if dataset_type == 'coco':
         if mode == 'train':
             return get_coco_train_dataset(**configs)
+        elif mode == 'train_tf_records':
+            return get_coco_train_dataset_by_tf_records(**configs)
         elif mode == 'val':
             return get_coco_eval_dataset(**configs)
         raise ValueError('unknown mode {} for dataset type {}'.format(mode, dataset_type))
@@ -4,13 +4,33 @@ import cv2
 import os
 from functools import partial
 
+from object_detection.dataset.utils.image_cache_utils import get_resized_image_cache
+from object_detection.dataset.utils.tf_dataset_utils import preprocessing_eval_func, \
+    preprocessing_eval_single_func, bucket_eval_by_aspect_ratio
+
 
 __all__ = ['get_dataset_by_tf_records', 'get_dataset_by_local_file']
 
 
+def _bucket_eval_dataset(dataset, num_examples, batch_size, min_edge, max_edge, aspect_ratio_boundaries):
+    """
+    输入 dataset 的元素为单张图片的 img [n_height, n_width, 3], img_scale, raw_h, raw_w，
+    添加图片编号后通过 `bucket_eval_by_aspect_ratio` 按 aspect ratio 分组、padding，输出的元素为
+    img [batch_size, bucket_height, bucket_width, 3], image_shape [batch_size, 2],
+    img_scale, raw_h, raw_w, example_idx（均为 [batch_size, ]）
+    分组后输出顺序与 examples_list 不同，通过 example_idx 对应
+    """
+    dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.range(num_examples))).map(
+        lambda image_info, example_idx: (*image_info, example_idx))
+    return bucket_eval_by_aspect_ratio(dataset, batch_size, min_edge, max_edge, aspect_ratio_boundaries)
+
+
 def get_dataset_by_local_file(mode, root_path, image_format='bgr',
                               preprocessing_type='caffe', caffe_pixel_means=None,
-                              min_edge=600, max_edge=1000):
+                              min_edge=600, max_edge=1000, uint8_image=False,
+                              image_cache_dir=None, image_cache_max_bytes=50 * 1024 ** 3,
+                              batch_size=1, aspect_ratio_boundaries=None,
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE, prefetch_buffer_size=2):
     """
     根据 /path/to/VOC2007 or VOC2012/ImageSets/Main/{}.txt 读取图片列表，读取图片
     :param mode:
@@ -20,6 +40,14 @@ def get_dataset_by_local_file(mode, root_path, image_format='bgr',
     :param preprocessing_type:
     :param min_edge: 
     :param max_edge: 
+    :param uint8_image:         为 True 时只进行 resize，输出 uint8 rgb 图片（忽略 image_format），归一化在模型中进行
+    :param image_cache_dir:     不为 None 时，resize 后的 uint8 图片保存在磁盘缓存中（参考 `ResizedImageCache`），
+                                此时先 resize 再归一化，结果与不使用缓存时有微小差别
+    :param image_cache_max_bytes:
+    :param batch_size:          大于 1 时参考 `_bucket_eval_dataset`
+    :param aspect_ratio_boundaries: 只在 batch_size > 1 时使用
+    :param num_parallel_calls:  同时读取、resize 图片的线程数量，为 None 时按顺序读取，输出顺序与 examples_list 相同
+    :param prefetch_buffer_size: 预先读取的图片数量，为 None 时不 prefetch
     :return: 
     """
     if image_format not in ['rgb', 'bgr']:
@@ -29,10 +57,54 @@ def get_dataset_by_local_file(mode, root_path, image_format='bgr',
     examples_list = [line.strip() for line in lines]
     img_dir = os.path.join(root_path, 'JPEGImages')
 
+    image_cache = None
+    if image_cache_dir is not None:
+        dataset_name = 'pascal_{}_{}'.format(os.path.basename(os.path.normpath(root_path)), mode)
+        image_cache = get_resized_image_cache(image_cache_dir, dataset_name, min_edge, max_edge,
+                                              max_bytes=image_cache_max_bytes)
+
+    def _read_from_cache(example):
+        # 返回 resize 后的 uint8 rgb 图片，以及原始尺寸
+        img = image_cache.get(example)
+        if img is not None:
+            h, w = image_cache.get_raw_shape(example)
+        else:
+            img = cv2.imread(os.path.join(img_dir, example + '.jpg'))
+            h, w, _ = img.shape
+            scale = min(min_edge / min(h, w), max_edge / max(h, w))
+            img = image_cache.put(example, cv2.resize(img, (int(scale * w), int(scale * h)))[..., ::-1], h, w)
+        return img, float(min(min_edge / min(h, w), max_edge / max(h, w))), h, w
+
+    def _map_from_cache(example):
+        img, scale, h, w = _read_from_cache(example.decode())
+        if uint8_image:
+            return img, scale, h, w
+
+        img = img.astype(np.float32)
+        if image_format == 'bgr':
+            img = img[..., ::-1]
+        if preprocessing_type == 'caffe':
+            means = np.array([[caffe_pixel_means]], dtype=np.float32)
+            img = img - (means if image_format == 'bgr' else means[..., ::-1])
+        elif preprocessing_type == 'tf':
+            img = img / 255.0 * 2.0 - 1.0
+        else:
+            raise ValueError('unknown preprocessing type {}'.format(preprocessing_type))
+        return img, scale, h, w
+
     def _map_from_cv2(example):
+        if image_cache is not None:
+            return _map_from_cache(example)
         example = example.decode()
         img_file_path = os.path.join(img_dir, example + '.jpg')
-        img = cv2.imread(img_file_path).astype(np.float32)
+        img = cv2.imread(img_file_path)
+        if uint8_image:
+            h, w, _ = img.shape
+            scale = min(min_edge / min(h, w), max_edge / max(h, w))
+            img = cv2.resize(img, (int(scale * w), int(scale * h)))
+            return img[..., ::-1], float(scale), h, w
+
+        img = img.astype(np.float32)
         if preprocessing_type == 'caffe':
             img -= np.array([[caffe_pixel_means]])
         elif preprocessing_type == 'tf':
@@ -54,64 +126,73 @@ def get_dataset_by_local_file(mode, root_path, image_format='bgr',
     dataset = tf.data.Dataset.from_tensor_slices(examples_list).map(
         lambda example: tf.py_func(_map_from_cv2,
                                    [example],
-                                   [tf.float32, tf.float64, tf.int64, tf.int64]  # linux
+                                   [tf.uint8 if uint8_image else tf.float32, tf.float64, tf.int64, tf.int64]  # linux
                                    # [tf.float32, tf.float64, tf.int32, tf.int32]  # windows
-                                   )
-    ).batch(1)
+                                   ),
+        num_parallel_calls=num_parallel_calls
+    )
+    if batch_size == 1:
+        dataset = dataset.batch(1)
+    else:
+        dataset = _bucket_eval_dataset(dataset, len(examples_list), batch_size, min_edge, max_edge,
+                                       aspect_ratio_boundaries)
+    if prefetch_buffer_size is not None:
+        dataset = dataset.prefetch(prefetch_buffer_size)
 
     return dataset, examples_list
 
 
-def _caffe_preprocessing(image, pixel_means):
-    """
-    输入 uint8 RGB 的图像，转换为 tf.float32 BGR 格式，并减去 imagenet 平均数
-    :param image:
-    :return:
-    """
-    image = tf.to_float(image)
-    image = tf.reverse(image, axis=[-1])
-    channels = tf.split(axis=-1, num_or_size_splits=3, value=image)
-    for i in range(3):
-        channels[i] -= pixel_means[i]
-    return tf.concat(axis=-1, values=channels)
-
-
-def _tf_preprocessing(image):
+def get_dataset_by_tf_records(mode, root_path,
+                              preprocessing_type='caffe', caffe_pixel_means=None,
+                              min_edge=600, max_edge=1000, uint8_image=False,
+                              batch_size=1, aspect_ratio_boundaries=None,
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE, prefetch_buffer_size=2):
     """
-    输入 uint8 RGB 的图像，转换为 tf.float32 RGB 格式，取值范围[-1, 1]
-    :param image:
+    通过 tf 读取、解码图片，预处理与 `preprocessing_eval_func` 相同（输出 rgb 图片）
+    :param mode:
+    :param root_path:
+    :param preprocessing_type:
+    :param caffe_pixel_means:
+    :param min_edge:
+    :param max_edge:
+    :param uint8_image:         为 True 时只进行 resize，输出 uint8 rgb 图片，归一化在模型中进行
+    :param batch_size:          大于 1 时参考 `_bucket_eval_dataset`
+    :param aspect_ratio_boundaries: 只在 batch_size > 1 时使用
+    :param num_parallel_calls:  同时解码、预处理图片的线程数量，为 None 时按顺序进行，输出顺序与 examples_list 相同
+    :param prefetch_buffer_size: 预先读取的图片数量，为 None 时不 prefetch
     :return:
     """
-    return tf.image.convert_image_dtype(image, dtype=tf.float32) * 2.0 - 1.0
-
-
-def get_dataset_by_tf_records(mode, root_path,
-                              preprocessing_type='caffe', caffe_pixel_means=None,
-                              min_edge=600, max_edge=1000):
     with open(os.path.join(root_path, 'ImageSets', 'Main', '%s.txt' % mode), 'r') as f:
         lines = f.readlines()
     examples_list = [line.strip() for line in lines]
     img_dir = os.path.join(root_path, 'JPEGImages')
     example_path_list = [os.path.join(img_dir, example+'.jpg') for example in examples_list]
 
+    preprocessing_partial_func = partial(preprocessing_eval_func,
+                                         min_size=min_edge, max_size=max_edge,
+                                         preprocessing_type=preprocessing_type, caffe_pixel_means=caffe_pixel_means,
+                                         uint8_image=uint8_image)
+
     def _map_from_tf_image(example_path):
+        # 解码之前无法获取图片尺寸，通过 tf.shape 获取
         img = tf.image.decode_jpeg(tf.io.read_file(example_path), channels=3)
-        if preprocessing_type == 'caffe':
-            preprocessing_fn = partial(_caffe_preprocessing, pixel_means=caffe_pixel_means)
-        elif preprocessing_type == 'tf':
-            preprocessing_fn = _tf_preprocessing
-        else:
-            raise ValueError('unknown preprocessing type {}'.format(preprocessing_type))
-        img = preprocessing_fn(img)
-
-        # TODO: could not get image shape
-        h, w, _ = img.get_shape().as_list()
-        scale1 = min_edge / min(h, w)
-        scale2 = max_edge / max(h, w)
-        scale = min(scale1, scale2)
-        img = tf.image.resize_bilinear(img, [tf.to_int32(scale*h), tf.to_int32(scale*w)])
-        return img, float(scale), h, w
-
-    dataset = tf.data.Dataset.from_tensor_slices(example_path_list).map(_map_from_tf_image).batch(1)
+        img_shape = tf.shape(img)
+        return img, img_shape[0], img_shape[1]
+
+    dataset = tf.data.Dataset.from_tensor_slices(example_path_list).map(
+        _map_from_tf_image, num_parallel_calls=num_parallel_calls
+    )
+    if batch_size == 1:
+        dataset = dataset.batch(1).map(preprocessing_partial_func, num_parallel_calls=num_parallel_calls)
+    else:
+        preprocessing_partial_func = partial(preprocessing_eval_single_func,
+                                             min_size=min_edge, max_size=max_edge,
+                                             preprocessing_type=preprocessing_type,
+                                             caffe_pixel_means=caffe_pixel_means,
+                                             uint8_image=uint8_image)
+        dataset = _bucket_eval_dataset(dataset.map(preprocessing_partial_func, num_parallel_calls=num_parallel_calls),
+                                       len(examples_list), batch_size, min_edge, max_edge, aspect_ratio_boundaries)
+    if prefetch_buffer_size is not None:
+        dataset = dataset.prefetch(prefetch_buffer_size)
 
     return dataset, examples_list
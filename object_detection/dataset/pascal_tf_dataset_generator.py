@@ -1,54 +1,44 @@
 import tensorflow as tf
 from functools import partial
 
-from object_detection.dataset.utils.tf_dataset_utils import image_argument_with_imgaug, preprocessing_training_func
+from object_detection.dataset.utils.tf_dataset_utils import image_argument_with_imgaug, preprocessing_training_func, \
+    preprocessing_training_single_func, bucket_by_aspect_ratio, get_tf_records_dataset, \
+    get_prefetch_buffer_size, parse_tf_records, get_anchor_target_map_func
+from object_detection.dataset.utils.tf_argument_utils import get_tf_argument_map_func
+from object_detection.dataset.utils.imgaug_pool_utils import get_imgaug_process_pool, \
+    image_argument_with_imgaug_pool
+from object_detection.dataset.utils.tf_record_index_utils import get_tf_records_dataset_by_index
 
 __all__ = ['get_dataset']
 
 
-def _parse_tf_records(serialized_example):
-    features = tf.parse_single_example(serialized_example,
-                                       features={'image/height': tf.FixedLenFeature([1], tf.int64),
-                                                 'image/width': tf.FixedLenFeature([1], tf.int64),
-                                                 'image/filename': tf.FixedLenFeature([1], tf.string),
-                                                 'image/encoded': tf.FixedLenFeature([1], tf.string),
-                                                 'image/object/bbox/xmin': tf.VarLenFeature(tf.float32),
-                                                 'image/object/bbox/xmax': tf.VarLenFeature(tf.float32),
-                                                 'image/object/bbox/ymin': tf.VarLenFeature(tf.float32),
-                                                 'image/object/bbox/ymax': tf.VarLenFeature(tf.float32),
-                                                 'image/object/class/label': tf.VarLenFeature(tf.int64),
-                                                 'image/object/class/text': tf.VarLenFeature(tf.string),
-                                                 }
-                                       )
-    features['image/object/bbox/xmin'] = tf.sparse_tensor_to_dense(features['image/object/bbox/xmin'])
-    features['image/object/bbox/xmax'] = tf.sparse_tensor_to_dense(features['image/object/bbox/xmax'])
-    features['image/object/bbox/ymin'] = tf.sparse_tensor_to_dense(features['image/object/bbox/ymin'])
-    features['image/object/bbox/ymax'] = tf.sparse_tensor_to_dense(features['image/object/bbox/ymax'])
-    features['image/object/class/label'] = tf.sparse_tensor_to_dense(features['image/object/class/label'])
-    image = tf.image.decode_jpeg(features['image/encoded'][0])
-    bboxes = tf.transpose(tf.stack((features['image/object/bbox/ymin'],
-                                    features['image/object/bbox/xmin'],
-                                    features['image/object/bbox/ymax'],
-                                    features['image/object/bbox/xmax'])), name='bboxes')
-    return image, bboxes, features['image/height'][0], features['image/width'][0], features['image/object/class/label']
-
-
 def get_dataset(tf_records_list,
                 min_size=600, max_size=1000,
                 preprocessing_type='caffe', caffe_pixel_means=None,
                 batch_size=1, repeat=1,
                 shuffle=False, shuffle_buffer_size=1000,
-                prefetch=False, prefetch_buffer_size=1000,
-                argument=True, iaa_sequence=None):
+                prefetch=False, prefetch_buffer_size=2, prefetch_max_bytes=None,
+                argument=True, iaa_sequence=None,
+                argument_type='imgaug', tf_argument_sequence=None,
+                aspect_ratio_boundaries=None,
+                num_parallel_reads=4, read_buffer_size=None,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                uint8_image=False,
+                imgaug_num_workers=4, imgaug_micro_batch_size=4,
+                shuffle_seed=None, skip=0,
+                use_tf_record_index=False, num_shards=1, shard_index=0,
+                anchor_target_fn=None):
     """
     获取数据集，操作过程如下：
 
-    1) 从 tfrecords 文件中读取基本数据；
-    2) 如果需要数据增强，则通过输入的 iaa_sequence 进行；
-    3) 数据归一化，将 uint8 转换为 float，可能是转换到[0, 1]之间，也可能是减去像素平均数
-    4) shuffle 操作；
-    5) prefetch 操作；
-    6) batch 操作。
+    1) 从 tfrecords 文件中读取基本数据，多个文件通过 parallel interleave 同时读取；
+       use_tf_record_index 为 True 时，通过索引文件（`generate_pascal_tf_records.py` 生成）随机读取；
+    2) shuffle 操作，在解码之前对序列化的 records 进行，buffer 中不保存解码后的图片；
+       use_tf_record_index 为 True 时，对所有 records 进行全局随机排列，不使用 shuffle buffer；
+    3) 如果需要数据增强，则通过输入的 iaa_sequence（imgaug）或 tf_argument_sequence（纯TF）进行；
+    4) 数据归一化，将 uint8 转换为 float，可能是转换到[0, 1]之间，也可能是减去像素平均数
+    5) batch 操作；
+    6) prefetch 操作，buffer 大小为 batch 数量，可以通过 prefetch_max_bytes 限制内存；
     7) repeat 操作
 
     其中，默认数据增强包括：
@@ -59,11 +49,24 @@ def get_dataset(tf_records_list,
     ```
     1) 随机水平；
 
+    当 argument_type 为 'tf' 时，使用 `tf_argument_utils` 中的纯 TF 增强，不经过 tf.py_func，
+    默认同样只有随机水平翻转，可以通过 tf_argument_sequence 添加 random_expand/random_crop_keep_bboxes 等。
+
+    当 argument_type 为 'imgaug_pool' 时，iaa_sequence 在 imgaug_num_workers 个进程中执行（参考 `ImgaugProcessPool`），
+    每 imgaug_micro_batch_size 张图片调用一次 augment_images，适用于 affine、weather 等耗时的 imgaug 增强。
+
     当通过 itr 进行操作时，该 dataset 返回的数据包括：
     image, bboxes, labels
     数据类型分别是：tf.float32([0, 1]), tf.float32([0, 边长]), tf.int32([0, num_classes])
     shape为：[1, height, width, 3], [1, num_bboxes, 4], [num_bboxes]
 
+    当 batch_size > 1 时，先对每张图片单独 resize，再根据 aspect ratio 分组（aspect_ratio_boundaries）
+    并 padding 到固定的 bucket 尺寸，此时 dataset 返回的数据包括：
+    image, bboxes, labels, image_shape, num_bboxes
+    shape为：[batch_size, bucket_height, bucket_width, 3], [batch_size, max_num_bboxes, 4],
+    [batch_size, max_num_bboxes], [batch_size, 2], [batch_size, ]
+    其中 bboxes 的 padding 为0，labels 的 padding 为-1，image_shape 为每张图片 resize 后的真实尺寸
+
     :param tf_records_list:
     :param min_size:
     :param max_size:
@@ -72,34 +75,88 @@ def get_dataset(tf_records_list,
     :param repeat:
     :param batch_size:
     :param shuffle:
-    :param shuffle_buffer_size:
+    :param shuffle_buffer_size:     序列化 records 的数量
     :param prefetch:
-    :param prefetch_buffer_size:
+    :param prefetch_buffer_size:    batch 数量
+    :param prefetch_max_bytes:      prefetch buffer 的内存上限（bytes），None 表示不限制
     :param argument:
     :param iaa_sequence:
+    :param argument_type:           one of ['imgaug', 'tf', 'imgaug_pool']
+    :param tf_argument_sequence:
+    :param aspect_ratio_boundaries: height/width 的分界点，只在 batch_size > 1 时使用
+    :param num_parallel_reads:      同时读取的 tfrecords 文件数量，None 或 1 表示按顺序读取
+    :param read_buffer_size:        每个 tfrecords 文件的读取 buffer 大小（bytes）
+    :param num_parallel_calls:      解析、数据增强、预处理等 map 操作的并行数量，默认为 AUTOTUNE，None 表示不并行
+    :param uint8_image:             为 True 时 image 为 tf.uint8（[0, 255]，rgb），只进行 resize，归一化在模型中进行
+    :param imgaug_num_workers:      argument_type 为 imgaug_pool 时的进程数量
+    :param imgaug_micro_batch_size: argument_type 为 imgaug_pool 时，每次 augment_images 的图片数量
+    :param shuffle_seed:            shuffle 的随机种子，相同的 seed 得到相同的图片顺序
+    :param skip:                    跳过前 skip 张图片（解码之前），与 shuffle_seed 一起用于从 checkpoint 恢复训练
+    :param use_tf_record_index:     是否通过索引文件随机读取 records（参考 `tf_record_index_utils`）
+    :param num_shards:              use_tf_record_index 为 True 时，按照 rank 划分 records，用于多个 worker 同时训练
+    :param shard_index:             当前 worker 的 rank
+    :param anchor_target_fn:        不为 None 时（如 `BaseFasterRcnn.get_anchor_target`），在数据集中并行计算 anchor target，
+                                    dataset 额外返回 rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights，
+                                    只支持 batch_size 为 1
     :return:
     """
 
-    dataset = tf.data.TFRecordDataset(tf_records_list).map(_parse_tf_records)
+    if use_tf_record_index:
+        dataset = get_tf_records_dataset_by_index(tf_records_list, parse_tf_records,
+                                                  shuffle=shuffle, shuffle_seed=shuffle_seed,
+                                                  num_workers=num_shards, worker_rank=shard_index,
+                                                  skip=skip, num_parallel_calls=num_parallel_calls)
+    else:
+        dataset = get_tf_records_dataset(tf_records_list, num_parallel_reads=num_parallel_reads,
+                                         read_buffer_size=read_buffer_size, num_parallel_calls=num_parallel_calls,
+                                         shuffle=shuffle, shuffle_buffer_size=shuffle_buffer_size,
+                                         shuffle_seed=shuffle_seed, skip=skip)
 
     if argument:
-        image_argument_partial = partial(image_argument_with_imgaug, iaa_sequence=iaa_sequence)
-        dataset = dataset.map(
-            lambda image, bboxes, image_height, image_width, labels: tuple([
-                *tf.py_func(image_argument_partial, [image, bboxes], [image.dtype, bboxes.dtype]),
-                image_height, image_width, labels])
-        )
+        if argument_type == 'imgaug':
+            image_argument_partial = partial(image_argument_with_imgaug, iaa_sequence=iaa_sequence)
+            dataset = dataset.map(
+                lambda image, bboxes, image_height, image_width, labels: tuple([
+                    *tf.py_func(image_argument_partial, [image, bboxes], [image.dtype, bboxes.dtype]),
+                    image_height, image_width, labels]),
+                num_parallel_calls=num_parallel_calls
+            )
+        elif argument_type == 'tf':
+            # 增强可能改变图片尺寸，image_height、image_width 使用增强后的尺寸
+            dataset = dataset.map(get_tf_argument_map_func(tf_argument_sequence), num_parallel_calls=num_parallel_calls)
+        elif argument_type == 'imgaug_pool':
+            imgaug_pool = get_imgaug_process_pool(iaa_sequence, num_workers=imgaug_num_workers)
+            dataset = image_argument_with_imgaug_pool(dataset, imgaug_pool, micro_batch_size=imgaug_micro_batch_size,
+                                                      num_parallel_calls=num_parallel_calls)
+        else:
+            raise ValueError('unknown argument type {}'.format(argument_type))
 
     preprocessing_partial_func = partial(preprocessing_training_func,
                                          min_size=min_size, max_size=max_size,
                                          preprocessing_type=preprocessing_type,
-                                         caffe_pixel_means=caffe_pixel_means)
-
-    dataset = dataset.batch(batch_size=batch_size).map(preprocessing_partial_func)
+                                         caffe_pixel_means=caffe_pixel_means,
+                                         uint8_image=uint8_image)
+
+    if batch_size == 1:
+        dataset = dataset.batch(batch_size=batch_size).map(preprocessing_partial_func,
+                                                           num_parallel_calls=num_parallel_calls)
+        if anchor_target_fn is not None:
+            dataset = dataset.map(get_anchor_target_map_func(anchor_target_fn), num_parallel_calls=num_parallel_calls)
+    else:
+        if anchor_target_fn is not None:
+            raise ValueError('anchor target in dataset only supports batch_size 1')
+        preprocessing_partial_func = partial(preprocessing_training_single_func,
+                                             min_size=min_size, max_size=max_size,
+                                             preprocessing_type=preprocessing_type,
+                                             caffe_pixel_means=caffe_pixel_means,
+                                             uint8_image=uint8_image)
+        dataset = bucket_by_aspect_ratio(dataset.map(preprocessing_partial_func,
+                                                     num_parallel_calls=num_parallel_calls),
+                                         batch_size=batch_size, min_size=min_size, max_size=max_size,
+                                         aspect_ratio_boundaries=aspect_ratio_boundaries)
 
-    if shuffle:
-        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
     if prefetch:
-        dataset = dataset.prefetch(buffer_size=prefetch_buffer_size)
+        dataset = dataset.prefetch(buffer_size=get_prefetch_buffer_size(prefetch_buffer_size, batch_size, max_size,
+                                                                        prefetch_max_bytes, uint8_image))
 
     return dataset.repeat(repeat)
@@ -0,0 +1,196 @@
+import os
+import json
+import atexit
+import hashlib
+import threading
+import numpy as np
+import tensorflow as tf
+
+__all__ = ['get_anchor_target_cache_key', 'AnchorTargetCache', 'get_anchor_target_cache',
+           'get_all_anchor_target_cache_stats']
+
+"""
+anchor target 的离线缓存
+默认数据增强只有 `iaa.Fliplr(0.5)`，每张图片在每个尺寸下只有两种（是否翻转）gt_bboxes，
+即只有两种 anchors 与 gt_bboxes 的 iou 计算结果，没有必要每个 step 都重新计算 [num_anchors, num_gt_bboxes] 的 iou。
+
+1) 缓存的是随机采样之前的结果（参考 `AnchorTarget.get_overlap_labels`）：每个 anchor 的 label（int8，-1/0/1）
+   以及对应的 gt_bboxes index（int16），正例反例的随机采样以及 bboxes targets 的 encode 仍然在训练时进行；
+2) 数据保存在 `data.bin` 中，每条记录为 argmax_overlaps[num_anchors] int16 + labels[num_anchors] int8，
+   索引文件 `index.json` 保存每条记录的 (offset, num_anchors, num_gt_bboxes, image_idx, height, width, flip)；
+3) key 为 resize 后的图片尺寸以及 gt_bboxes（像素坐标，保留一位小数）的 sha1，由 (image id, 尺寸, 是否翻转) 唯一确定，
+   训练时不需要在数据增强中传递 image id 以及是否翻转；使用其他数据增强时 gt_bboxes 不同，找不到缓存，在线计算。
+
+通过 `generate_anchor_target_cache.py` 生成，训练时只读。
+"""
+
+_INDEX_FILE_NAME = 'index.json'
+_DATA_FILE_NAME = 'data.bin'
+
+
+def get_anchor_target_cache_key(gt_bboxes, image_shape):
+    """
+    :param gt_bboxes:       [num_bboxes, 4]，xmin, ymin, xmax, ymax，单位为像素（resize 之后）
+    :param image_shape:     [height, width]，resize 之后的图片尺寸
+    :return:                str
+    """
+    # 保留一位小数，避免不同计算顺序带来的浮点误差；加 0. 将 -0.0 转换为 0.0
+    gt_bboxes = np.round(np.asarray(gt_bboxes, dtype=np.float64).reshape([-1, 4]), 1) + 0.
+    digest = hashlib.sha1(gt_bboxes.astype(np.float32).tobytes()).hexdigest()
+    return '{}x{}_{}'.format(int(image_shape[0]), int(image_shape[1]), digest)
+
+
+class AnchorTargetCache(object):
+    def __init__(self, cache_dir, readonly=True, flush_every_n_writes=1000):
+        """
+        :param cache_dir:
+        :param readonly:                训练时为 True，`generate_anchor_target_cache.py` 中为 False
+        :param flush_every_n_writes:    每写入多少条记录后保存一次索引文件
+        """
+        self._cache_dir = cache_dir
+        self._readonly = readonly
+        self._flush_every_n_writes = flush_every_n_writes
+        if not readonly and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._lock = threading.Lock()
+        self._index = {}
+        index_file_path = os.path.join(cache_dir, _INDEX_FILE_NAME)
+        if os.path.exists(index_file_path):
+            with open(index_file_path, 'r') as f:
+                self._index = json.load(f)
+        elif readonly:
+            raise ValueError('anchor target cache index {} does not exist, '
+                             'generate it by `generate_anchor_target_cache.py`'.format(index_file_path))
+
+        data_file_path = os.path.join(cache_dir, _DATA_FILE_NAME)
+        self._data = None
+        if readonly:
+            if os.path.getsize(data_file_path) > 0:
+                self._data = np.memmap(data_file_path, dtype=np.uint8, mode='r')
+            self._data_file = None
+        else:
+            self._data_file = open(data_file_path, 'ab')
+            atexit.register(self.flush)
+
+        self.hits = 0
+        self.misses = 0
+        self._num_unflushed_writes = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key, num_anchors=None, num_gt_bboxes=None):
+        """
+        :param key:             `get_anchor_target_cache_key` 的结果
+        :param num_anchors:     不为 None 时检查 anchors 数量，不一致（如 anchors 参数不同）时认为不存在
+        :param num_gt_bboxes:   不为 None 时检查 gt_bboxes 数量
+        :return:                labels [num_anchors, ] int8, argmax_overlaps [num_anchors, ] int16，不存在时返回 None
+        """
+        if isinstance(key, bytes):
+            key = key.decode()
+        entry = self._index.get(key)
+        if entry is None or self._data is None or \
+                (num_anchors is not None and entry[1] != num_anchors) or \
+                (num_gt_bboxes is not None and entry[2] != num_gt_bboxes):
+            self.misses += 1
+            return None
+        self.hits += 1
+        offset, cur_num_anchors = entry[:2]
+        argmax_overlaps = self._data[offset:offset + 2 * cur_num_anchors].view(np.int16)
+        labels = self._data[offset + 2 * cur_num_anchors:offset + 3 * cur_num_anchors].view(np.int8)
+        return labels, argmax_overlaps
+
+    def lookup(self, gt_bboxes, image_shape, num_anchors):
+        """
+        在 tf.data 或模型中查找缓存，通过 tf.py_func 实现
+        :param gt_bboxes:       [num_bboxes, 4]，xmin, ymin, xmax, ymax，单位为像素
+        :param image_shape:     [height, width]，python 数值或 scalar tensor
+        :param num_anchors:     int32 scalar tensor
+        :return:                found（bool scalar tensor）, labels, argmax_overlaps（[num_anchors, ] int32，不存在时 shape 为[0]）
+        """
+
+        def _lookup(cur_gt_bboxes, cur_image_shape, cur_num_anchors):
+            result = self.get(get_anchor_target_cache_key(cur_gt_bboxes, cur_image_shape),
+                              num_anchors=int(cur_num_anchors), num_gt_bboxes=len(cur_gt_bboxes))
+            if result is None:
+                return np.zeros([0], dtype=np.int32), np.zeros([0], dtype=np.int32)
+            return result[0].astype(np.int32), result[1].astype(np.int32)
+
+        image_shape = tf.to_int32(tf.stack([image_shape[0], image_shape[1]]))
+        labels, argmax_overlaps = tf.py_func(_lookup, [gt_bboxes, image_shape, num_anchors],
+                                             [tf.int32, tf.int32], stateful=False)
+        labels.set_shape([None])
+        argmax_overlaps.set_shape([None])
+        return tf.greater(tf.size(labels), 0), labels, argmax_overlaps
+
+    def put(self, key, labels, argmax_overlaps, num_gt_bboxes, image_idx=-1, flip=-1):
+        """
+        写入一条记录，key 已经存在时不写入
+        :param key:             `get_anchor_target_cache_key` 的结果
+        :param labels:          [num_anchors, ]，-1/0/1
+        :param argmax_overlaps: [num_anchors, ]，要求 num_gt_bboxes 不超过 int16 范围
+        :param num_gt_bboxes:
+        :param image_idx:       只用于记录，如 records 的顺序编号
+        :param flip:            只用于记录
+        :return:                是否写入
+        """
+        if self._readonly:
+            raise ValueError('anchor target cache {} is readonly'.format(self._cache_dir))
+        if num_gt_bboxes > np.iinfo(np.int16).max:
+            raise ValueError('too many gt bboxes: {}'.format(num_gt_bboxes))
+        height, width = key.split('_')[0].split('x')
+        num_anchors = len(labels)
+        with self._lock:
+            if key in self._index:
+                return False
+            offset = self._data_file.tell()
+            self._data_file.write(np.asarray(argmax_overlaps, dtype=np.int16).tobytes())
+            self._data_file.write(np.asarray(labels, dtype=np.int8).tobytes())
+            # 下一条记录的 offset 保持 2 bytes 对齐，int16 数组可以直接 view
+            if num_anchors % 2 == 1:
+                self._data_file.write(b'\0')
+            self._index[key] = (offset, num_anchors, int(num_gt_bboxes), int(image_idx),
+                                int(height), int(width), int(flip))
+            self._num_unflushed_writes += 1
+            if self._num_unflushed_writes >= self._flush_every_n_writes:
+                self._flush()
+        return True
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # 先写数据再写索引，索引中的记录都已经写入数据文件
+        if self._num_unflushed_writes == 0:
+            return
+        self._data_file.flush()
+        index_file_path = os.path.join(self._cache_dir, _INDEX_FILE_NAME)
+        with open(index_file_path + '.tmp', 'w') as f:
+            json.dump(self._index, f)
+        os.replace(index_file_path + '.tmp', index_file_path)
+        self._num_unflushed_writes = 0
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._index)}
+
+
+_ANCHOR_TARGET_CACHES = {}
+
+
+def get_anchor_target_cache(cache_dir):
+    """
+    获取全局的只读缓存对象
+    """
+    key = os.path.abspath(cache_dir)
+    if key not in _ANCHOR_TARGET_CACHES:
+        _ANCHOR_TARGET_CACHES[key] = AnchorTargetCache(cache_dir, readonly=True)
+    return _ANCHOR_TARGET_CACHES[key]
+
+
+def get_all_anchor_target_cache_stats():
+    """
+    :return:    dict，key 为缓存目录，value 为 `AnchorTargetCache.get_stats()`
+    """
+    return {key: cache.get_stats() for key, cache in _ANCHOR_TARGET_CACHES.items()}
@@ -0,0 +1,106 @@
+import os
+import json
+import numpy as np
+
+__all__ = ['get_default_index_file_path', 'build_coco_index', 'save_coco_index', 'load_coco_index']
+
+"""
+COCO annotation 的列式索引
+原始 instances json 文件包含 segmentation 等训练时不需要的信息，通过 pycocotools.COCO 导入需要几十秒以及几个 GB 内存。
+列式索引只保存训练/测试时需要的信息，每个字段都是一个 numpy 数组：
+1) img_ids: [num_images, ]，int64，升序排列
+2) heights, widths: [num_images, ]，int64
+3) file_names: [num_images, ]，bytes
+4) bbox_offsets: [num_images + 1, ]，int64，第 i 张图片的 bboxes 为 bboxes[bbox_offsets[i]:bbox_offsets[i + 1]]
+5) bboxes: [num_bboxes, 4]，float32，格式为 ymin, xmin, ymax, xmax，单位为像素
+6) labels: [num_bboxes, ]，int64，取值范围为 [1, num_classes)
+7) cat_ids, cat_names: [num_classes - 1, ]，原始 category id 以及名称，labels 为 cat_ids 中的 index + 1
+"""
+
+_INDEX_KEYS = ('img_ids', 'heights', 'widths', 'file_names', 'bbox_offsets', 'bboxes', 'labels',
+               'cat_ids', 'cat_names')
+
+
+def get_default_index_file_path(root_dir, sub_dir, year):
+    return os.path.join(root_dir, 'annotations', 'instances_{}{}_index.npz'.format(sub_dir, year))
+
+
+def build_coco_index(annotation_file_path, min_edge=32):
+    """
+    读取 instances json 文件并生成列式索引，过滤规则与原先 `CocoDataset._filter_images` 相同：
+    1. 只保留有 annotation 的图片；
+    2. 过滤 ignore、area <= 0、宽或高小于1 的 annotation；
+    3. 过滤短边小于 min_edge 或者过滤后没有 bboxes 的图片。
+    :param annotation_file_path:
+    :param min_edge:
+    :return:                        dict，具体内容参考模块注释
+    """
+    with open(annotation_file_path, 'r') as f:
+        dataset = json.load(f)
+
+    cat_ids = [cat['id'] for cat in dataset['categories']]
+    cat_names = [cat['name'] for cat in dataset['categories']]
+    cat_id_to_raw_id = {cat_id: idx + 1 for idx, cat_id in enumerate(cat_ids)}
+
+    # 与 pycocotools 相同，按照 annotations 中的顺序分组
+    img_to_anns = {}
+    for ann in dataset['annotations']:
+        img_to_anns.setdefault(ann['image_id'], []).append(ann)
+    img_infos = {info['id']: info for info in dataset['images']}
+    del dataset
+
+    img_ids = []
+    heights = []
+    widths = []
+    file_names = []
+    bbox_offsets = [0]
+    bboxes = []
+    labels = []
+    for img_id in sorted(img_to_anns.keys()):
+        info = img_infos[img_id]
+        if min(info['width'], info['height']) < min_edge:
+            continue
+        cur_bboxes = []
+        cur_labels = []
+        for ann in img_to_anns[img_id]:
+            if ann.get('ignore', False):
+                continue
+            x1, y1, w, h = ann['bbox']
+            if ann['area'] <= 0 or w < 1 or h < 1:
+                continue
+            cur_bboxes.append([y1, x1, y1 + h - 1., x1 + w - 1.])
+            cur_labels.append(cat_id_to_raw_id[ann['category_id']])
+        if len(cur_bboxes) == 0:
+            continue
+
+        img_ids.append(img_id)
+        heights.append(info['height'])
+        widths.append(info['width'])
+        file_names.append(info['file_name'].encode('utf8'))
+        bbox_offsets.append(bbox_offsets[-1] + len(cur_bboxes))
+        bboxes.extend(cur_bboxes)
+        labels.extend(cur_labels)
+
+    return {
+        'img_ids': np.array(img_ids, dtype=np.int64),
+        'heights': np.array(heights, dtype=np.int64),
+        'widths': np.array(widths, dtype=np.int64),
+        'file_names': np.array(file_names, dtype=np.string_),
+        'bbox_offsets': np.array(bbox_offsets, dtype=np.int64),
+        'bboxes': np.array(bboxes, dtype=np.float32).reshape([-1, 4]),
+        'labels': np.array(labels, dtype=np.int64),
+        'cat_ids': np.array(cat_ids, dtype=np.int64),
+        'cat_names': np.array([name.encode('utf8') for name in cat_names], dtype=np.string_),
+    }
+
+
+def save_coco_index(index, file_path):
+    """
+    保存为不压缩的 npz 文件，导入时不需要解压
+    """
+    np.savez(file_path, **{key: index[key] for key in _INDEX_KEYS})
+
+
+def load_coco_index(file_path):
+    with np.load(file_path) as data:
+        return {key: data[key] for key in _INDEX_KEYS}
@@ -0,0 +1,220 @@
+import os
+import json
+import atexit
+import threading
+import numpy as np
+import tensorflow as tf
+
+try:
+    import fcntl
+except ImportError:
+    # windows 下没有 fcntl，不能保证只有一个进程写入
+    fcntl = None
+
+__all__ = ['ResizedImageCache', 'get_resized_image_cache', 'get_all_image_cache_stats']
+
+"""
+resize 后 uint8 rgb 图片的磁盘缓存
+训练的每个 epoch、每次 eval 都需要重新解码 jpeg 并 resize 到相同的尺寸，缓存后直接从 memmap 文件中读取。
+
+1) 每个 (dataset_name, min_size, max_size) 对应一个缓存目录 `{cache_dir}/{dataset_name}_{min_size}_{max_size}`；
+2) 图片数据依次写入若干个固定大小的 shard 文件（`shard_%03d.bin`，稀疏文件，不会预先占用磁盘），通过 np.memmap 读写；
+3) 索引文件 `index.json` 保存每张图片的 (shard, offset, height, width, raw_height, raw_width)，key 为 image id 的字符串；
+4) 所有图片总大小超过 max_bytes 后不再写入，之后未命中的图片每次都重新解码。
+
+同一个缓存目录可以被多个进程同时读取，但同时只能有一个进程写入：
+创建缓存对象时获取 `write.lock` 的排他锁（fcntl.flock），获取失败时（如多个 eval 任务共享 val 缓存）该对象只读，
+`put` 不写入任何数据，未命中的图片每次都重新解码。
+"""
+
+_INDEX_FILE_NAME = 'index.json'
+_SHARD_FILE_PATTERN = 'shard_%03d.bin'
+_LOCK_FILE_NAME = 'write.lock'
+
+
+class ResizedImageCache(object):
+    def __init__(self, cache_dir, dataset_name, min_size, max_size,
+                 max_bytes=50 * 1024 ** 3, shard_bytes=1024 ** 3, flush_every_n_writes=100):
+        """
+        :param cache_dir:
+        :param dataset_name:            如 coco_train2017, pascal_VOC2007_test
+        :param min_size:
+        :param max_size:
+        :param max_bytes:               所有图片的总大小上限
+        :param shard_bytes:             每个 shard 文件的大小，要求大于单张图片的大小（max_size * max_size * 3）
+        :param flush_every_n_writes:    每写入多少张图片后保存一次索引文件
+        """
+        if shard_bytes < max_size * max_size * 3:
+            raise ValueError('shard bytes {} is less than max image bytes'.format(shard_bytes))
+        self._cache_dir = os.path.join(cache_dir, '{}_{}_{}'.format(dataset_name, min_size, max_size))
+        if not os.path.exists(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        self._max_bytes = max_bytes
+        self._shard_bytes = shard_bytes
+        self._flush_every_n_writes = flush_every_n_writes
+
+        self._lock = threading.Lock()
+        # 先获取写锁再读取索引，保证写入的位置是根据最新的索引计算的
+        self._lock_file = None
+        self.readonly = not self._acquire_write_lock()
+        self._shards = {}
+        self._index = {}
+        index_file_path = os.path.join(self._cache_dir, _INDEX_FILE_NAME)
+        if os.path.exists(index_file_path):
+            with open(index_file_path, 'r') as f:
+                self._index = json.load(f)
+
+        # 新的图片写入最后一个 shard 的末尾
+        self._cur_shard = 0
+        self._cur_offset = 0
+        self._total_bytes = 0
+        for shard_idx, offset, height, width, _, _ in self._index.values():
+            num_bytes = height * width * 3
+            self._total_bytes += num_bytes
+            if (shard_idx, offset + num_bytes) > (self._cur_shard, self._cur_offset):
+                self._cur_shard, self._cur_offset = shard_idx, offset + num_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.skipped_writes = 0
+        self._num_unflushed_writes = 0
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._index)
+
+    def _acquire_write_lock(self):
+        """
+        :return:    是否获取了写锁，进程退出时自动释放
+        """
+        if fcntl is None:
+            tf.logging.warning('fcntl is not available, can not make sure only one process writes to {}'
+                               .format(self._cache_dir))
+            return True
+        lock_file = open(os.path.join(self._cache_dir, _LOCK_FILE_NAME), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            tf.logging.info('image cache {} is being written by another process, open it readonly'
+                            .format(self._cache_dir))
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _get_shard(self, shard_idx):
+        if shard_idx not in self._shards:
+            shard_path = os.path.join(self._cache_dir, _SHARD_FILE_PATTERN % shard_idx)
+            if self.readonly:
+                mode = 'r'
+            else:
+                mode = 'r+' if os.path.exists(shard_path) else 'w+'
+            self._shards[shard_idx] = np.memmap(shard_path, dtype=np.uint8, mode=mode, shape=(self._shard_bytes,))
+        return self._shards[shard_idx]
+
+    def get(self, key):
+        """
+        :param key:     image id 的字符串（或 bytes）
+        :return:        [height, width, 3] uint8 rgb 图片，即 memmap 的 view（不拷贝），不存在时返回 None
+        """
+        if isinstance(key, bytes):
+            key = key.decode()
+        entry = self._index.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        shard_idx, offset, height, width, _, _ = entry
+        return self._get_shard(shard_idx)[offset:offset + height * width * 3].reshape([height, width, 3])
+
+    def get_or_empty(self, key):
+        """
+        用于 tf.py_func，不存在时返回 shape 为 [0, 0, 3] 的图片
+        """
+        image = self.get(key)
+        if image is None:
+            return np.zeros([0, 0, 3], dtype=np.uint8)
+        return image
+
+    def get_raw_shape(self, key):
+        """
+        :return:        resize 之前的图片尺寸 (raw_height, raw_width)，不存在时返回 None
+        """
+        if isinstance(key, bytes):
+            key = key.decode()
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        return entry[4], entry[5]
+
+    def put(self, key, image, raw_height=-1, raw_width=-1):
+        """
+        写入一张图片，超过 max_bytes 或者只读（其他进程持有写锁）时不写入
+        :param key:
+        :param image:       [height, width, 3] uint8 rgb 图片
+        :param raw_height:  resize 之前的图片尺寸，可以通过 `get_raw_shape` 获取
+        :param raw_width:
+        :return:            输入的 image
+        """
+        if isinstance(key, bytes):
+            key = key.decode()
+        height, width, _ = image.shape
+        num_bytes = height * width * 3
+        with self._lock:
+            if key in self._index:
+                return image
+            if self.readonly or self._total_bytes + num_bytes > self._max_bytes:
+                self.skipped_writes += 1
+                return image
+            if self._cur_offset + num_bytes > self._shard_bytes:
+                self._cur_shard += 1
+                self._cur_offset = 0
+            self._get_shard(self._cur_shard)[self._cur_offset:self._cur_offset + num_bytes] = \
+                np.ascontiguousarray(image, dtype=np.uint8).reshape([-1])
+            self._index[key] = (self._cur_shard, self._cur_offset, int(height), int(width), int(raw_height), int(raw_width))
+            self._cur_offset += num_bytes
+            self._total_bytes += num_bytes
+            self._num_unflushed_writes += 1
+            if self._num_unflushed_writes >= self._flush_every_n_writes:
+                self._flush()
+        return image
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # 先写图片数据再写索引，索引中的图片都已经写入 shard 文件
+        if self.readonly or self._num_unflushed_writes == 0:
+            return
+        for shard in self._shards.values():
+            shard.flush()
+        index_file_path = os.path.join(self._cache_dir, _INDEX_FILE_NAME)
+        with open(index_file_path + '.tmp', 'w') as f:
+            json.dump(self._index, f)
+        os.replace(index_file_path + '.tmp', index_file_path)
+        self._num_unflushed_writes = 0
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'skipped_writes': self.skipped_writes,
+                'size': len(self._index), 'bytes': self._total_bytes, 'readonly': self.readonly}
+
+
+_IMAGE_CACHES = {}
+
+
+def get_resized_image_cache(cache_dir, dataset_name, min_size, max_size, max_bytes=50 * 1024 ** 3):
+    """
+    获取全局的缓存对象，训练、eval 等使用相同参数时共享同一个对象
+    """
+    key = (os.path.abspath(cache_dir), dataset_name, min_size, max_size)
+    if key not in _IMAGE_CACHES:
+        _IMAGE_CACHES[key] = ResizedImageCache(cache_dir, dataset_name, min_size, max_size, max_bytes=max_bytes)
+    return _IMAGE_CACHES[key]
+
+
+def get_all_image_cache_stats():
+    """
+    :return:    dict，key 为 `{dataset_name}_{min_size}_{max_size}`，value 为 `ResizedImageCache.get_stats()`
+    """
+    return {'{}_{}_{}'.format(*key[1:]): cache.get_stats() for key, cache in _IMAGE_CACHES.items()}
@@ -0,0 +1,221 @@
+import atexit
+import queue
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import imgaug as ia
+from imgaug import augmenters as iaa
+
+__all__ = ['ImgaugProcessPool', 'get_imgaug_process_pool', 'image_argument_with_imgaug_pool']
+
+"""
+基于多进程的 imgaug 数据增强，用于 `image_argument_with_imgaug` 无法满足速度要求的情况（如 affine、weather 等）
+
+1) 每个 worker 进程只创建一次 `iaa.Sequential(iaa_sequence)`，之后每个 micro batch 调用一次 `to_deterministic`；
+2) 图片不经过 pickle，而是通过共享内存（`multiprocessing.RawArray`）传递，队列中只传递 shape、bboxes 等少量数据；
+3) 共享内存划分为若干个 slot，每个 slot 保存一个 micro batch，主进程中多个线程（tf.data 并行 map）可以同时使用不同的 slot；
+4) worker 直接将增强结果写入 slot（padding 后的 [batch_size, max_height, max_width, 3]），主进程只拷贝一次到 tensor。
+"""
+
+
+def _to_imgaug_bboxes(bboxes, image_shape):
+    """
+    :param bboxes:          [num_bboxes, 4]，ymin, xmin, ymax, xmax，取值范围 [0, 1]
+    :param image_shape:     [height, width, 3]
+    :return:                `ia.BoundingBoxesOnImage`
+    """
+    height, width, _ = image_shape
+    bboxes_list = [ia.BoundingBox(x1=int(bbox[1] * width), y1=int(bbox[0] * height),
+                                  x2=int(bbox[3] * width), y2=int(bbox[2] * height))
+                   for bbox in bboxes]
+    return ia.BoundingBoxesOnImage(bboxes_list, shape=tuple(image_shape))
+
+
+def _from_imgaug_bboxes(bbs_aug, image_shape):
+    """
+    `_to_imgaug_bboxes` 的逆操作，结果截取到 [0, 1] 范围
+    """
+    height, width = image_shape[:2]
+    bboxes_aug = np.array([[bbox.y1 / height, bbox.x1 / width, bbox.y2 / height, bbox.x2 / width]
+                           for bbox in bbs_aug.bounding_boxes], dtype=np.float32).reshape([-1, 4])
+    return np.clip(bboxes_aug, 0, 1)
+
+
+def _worker_loop(worker_idx, seed, iaa_sequence, slots, task_queue, result_queues):
+    """
+    worker 进程的主循环
+    task 为 (slot_idx, image_shapes, bboxes_list)，图片保存在 slots[slot_idx] 中，shape 为 [batch_size, h, w, 3]，
+    其中 h, w 为所有图片的最大尺寸；结果写回同一个 slot，并通过 result_queues[slot_idx] 返回 (image_shapes, bboxes_list)
+    """
+    # imgaug 默认的全局随机种子是固定的，每个进程需要设置不同的种子
+    ia.seed(seed + worker_idx)
+    if iaa_sequence is None:
+        iaa_sequence = [iaa.Fliplr(0.5)]
+    seq = iaa.Sequential(iaa_sequence)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        slot_idx, image_shapes, bboxes_list = task
+        try:
+            slot = np.frombuffer(slots[slot_idx], dtype=np.uint8)
+            padded_height = max(shape[0] for shape in image_shapes)
+            padded_width = max(shape[1] for shape in image_shapes)
+            padded_images = slot[:len(image_shapes) * padded_height * padded_width * 3].reshape(
+                [len(image_shapes), padded_height, padded_width, 3])
+            images = [np.array(padded_images[i, :shape[0], :shape[1]]) for i, shape in enumerate(image_shapes)]
+            bbs = [_to_imgaug_bboxes(bboxes, shape) for bboxes, shape in zip(bboxes_list, image_shapes)]
+
+            seq_det = seq.to_deterministic()
+            images_aug = seq_det.augment_images(images)
+            bbs_aug = seq_det.augment_bounding_boxes(bbs)
+
+            # 增强结果可能改变图片尺寸，重新计算 padding 后的尺寸
+            image_shapes_aug = [image.shape for image in images_aug]
+            padded_height = max(shape[0] for shape in image_shapes_aug)
+            padded_width = max(shape[1] for shape in image_shapes_aug)
+            num_bytes = len(images_aug) * padded_height * padded_width * 3
+            if num_bytes > slot.size:
+                raise ValueError('augmented images need {} bytes, more than slot bytes {}'.format(num_bytes,
+                                                                                              slot.size))
+            padded_images = slot[:num_bytes].reshape([len(images_aug), padded_height, padded_width, 3])
+            padded_images[...] = 0
+            for i, image in enumerate(images_aug):
+                padded_images[i, :image.shape[0], :image.shape[1]] = image
+            result = (image_shapes_aug, [_from_imgaug_bboxes(cur_bbs, shape)
+                                         for cur_bbs, shape in zip(bbs_aug, image_shapes_aug)])
+        except Exception as e:
+            result = e
+        result_queues[slot_idx].put(result)
+
+
+class ImgaugProcessPool(object):
+    def __init__(self, iaa_sequence=None, num_workers=4, num_slots=None, slot_bytes=64 * 1024 ** 2,
+                 start_method='spawn', seed=None):
+        """
+        :param iaa_sequence:    imgaug augmenters 列表，需要能够 pickle，为 None 时只进行随机水平翻转
+        :param num_workers:     worker 进程数量
+        :param num_slots:       共享内存 slot 数量，即同时处理的 micro batch 数量上限，默认为 2 * num_workers
+        :param slot_bytes:      每个 slot 的大小，要求大于一个 micro batch padding 后的图片大小
+        :param start_method:    进程启动方式，默认为 spawn，避免 fork 已经启动 TensorFlow 线程的进程
+        :param seed:            worker 进程的随机种子，第 i 个进程为 seed + i，为 None 时随机选择
+        """
+        if num_slots is None:
+            num_slots = 2 * num_workers
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31 - num_workers)
+        context = multiprocessing.get_context(start_method)
+        self._slots = [context.RawArray('B', slot_bytes) for _ in range(num_slots)]
+        self._task_queue = context.Queue()
+        self._result_queues = [context.Queue() for _ in range(num_slots)]
+        self._free_slots = queue.Queue()
+        for slot_idx in range(num_slots):
+            self._free_slots.put(slot_idx)
+
+        self._workers = [context.Process(target=_worker_loop,
+                                         args=(i, seed, iaa_sequence, self._slots,
+                                               self._task_queue, self._result_queues),
+                                         daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.close)
+
+    def augment_padded_batch(self, images, image_shapes, bboxes, num_bboxes):
+        """
+        增强一个 micro batch，用于 tf.py_func
+        :param images:          [batch_size, max_height, max_width, 3] uint8，padded_batch 的结果
+        :param image_shapes:    [batch_size, 3]，每张图片的真实尺寸
+        :param bboxes:          [batch_size, max_num_bboxes, 4]，ymin, xmin, ymax, xmax，取值范围 [0, 1]
+        :param num_bboxes:      [batch_size, ]
+        :return:                增强后的 images, image_shapes, bboxes，格式与输入相同
+        """
+        slot_idx = self._free_slots.get()
+        try:
+            slot = np.frombuffer(self._slots[slot_idx], dtype=np.uint8)
+            if images.size > slot.size:
+                raise ValueError('images need {} bytes, more than slot bytes {}'.format(images.size, slot.size))
+            slot[:images.size] = images.reshape([-1])
+            self._task_queue.put((slot_idx,
+                                  [tuple(shape) for shape in image_shapes.tolist()],
+                                  [bboxes[i, :num_bboxes[i]] for i in range(len(num_bboxes))]))
+            result = self._result_queues[slot_idx].get()
+            if isinstance(result, Exception):
+                raise result
+            image_shapes_aug, bboxes_list = result
+
+            padded_height = max(shape[0] for shape in image_shapes_aug)
+            padded_width = max(shape[1] for shape in image_shapes_aug)
+            # slot 释放后会被其他线程覆盖，所以需要拷贝一次
+            images_aug = np.array(slot[:len(image_shapes_aug) * padded_height * padded_width * 3].reshape(
+                [len(image_shapes_aug), padded_height, padded_width, 3]))
+        finally:
+            self._free_slots.put(slot_idx)
+
+        bboxes_aug = np.zeros_like(bboxes)
+        for i, cur_bboxes in enumerate(bboxes_list):
+            bboxes_aug[i, :len(cur_bboxes)] = cur_bboxes
+        return images_aug, np.array(image_shapes_aug, dtype=np.int32), bboxes_aug
+
+    def close(self):
+        if not self._workers:
+            return
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._workers = []
+
+
+_IMGAUG_POOLS = {}
+
+
+def get_imgaug_process_pool(iaa_sequence=None, num_workers=4):
+    """
+    获取全局的 `ImgaugProcessPool` 对象，相同参数（iaa_sequence 为同一个对象或都为 None）时共享同一个进程池，
+    训练时每个 epoch 都会重新构建 dataset，避免每个 epoch 都创建新的 worker 进程以及共享内存
+    """
+    key = (id(iaa_sequence) if iaa_sequence is not None else None, num_workers)
+    if key not in _IMGAUG_POOLS:
+        # 同时保存 iaa_sequence，保证其 id 不会被其他对象复用
+        _IMGAUG_POOLS[key] = (iaa_sequence, ImgaugProcessPool(iaa_sequence, num_workers=num_workers))
+    return _IMGAUG_POOLS[key][1]
+
+
+def image_argument_with_imgaug_pool(dataset, imgaug_pool, micro_batch_size=4,
+                                    num_parallel_calls=tf.data.experimental.AUTOTUNE):
+    """
+    通过 `ImgaugProcessPool` 对 dataset 进行数据增强
+    先通过 padded_batch 组成 micro batch，每个 micro batch 调用一次 tf.py_func，之后通过 unbatch 恢复为单张图片
+    :param dataset:             输出为 image（rgb uint8）, bboxes（[0, 1]范围）, image_height, image_width, labels
+    :param imgaug_pool:         `ImgaugProcessPool` 对象
+    :param micro_batch_size:
+    :param num_parallel_calls:  同时处理的 micro batch 数量，不应超过 imgaug_pool 的 slot 数量
+    :return:                    与输入 dataset 格式相同，image_height, image_width 为增强后的图片尺寸
+    """
+
+    def _add_shapes(image, bboxes, image_height, image_width, labels):
+        return image, tf.shape(image, out_type=tf.int32), bboxes, tf.shape(bboxes)[0], \
+               image_height, image_width, labels
+
+    def _augment(images, image_shapes, bboxes, num_bboxes, image_height, image_width, labels):
+        images_aug, image_shapes_aug, bboxes_aug = tf.py_func(imgaug_pool.augment_padded_batch,
+                                                              [images, image_shapes, bboxes, num_bboxes],
+                                                              [tf.uint8, tf.int32, tf.float32],
+                                                              stateful=True)
+        images_aug.set_shape([None, None, None, 3])
+        image_shapes_aug.set_shape([None, 3])
+        bboxes_aug.set_shape([None, None, 4])
+        return images_aug, image_shapes_aug, bboxes_aug, num_bboxes, image_height, image_width, labels
+
+    def _remove_padding(image, image_shape, bboxes, num_bboxes, image_height, image_width, labels):
+        # 增强可能改变图片尺寸，image_height、image_width 使用增强后的尺寸
+        return image[:image_shape[0], :image_shape[1]], bboxes[:num_bboxes], \
+               tf.cast(image_shape[0], image_height.dtype), tf.cast(image_shape[1], image_width.dtype), \
+               labels[:num_bboxes]
+
+    dataset = dataset.map(_add_shapes, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.padded_batch(micro_batch_size, padded_shapes=dataset.output_shapes)
+    dataset = dataset.map(_augment, num_parallel_calls=num_parallel_calls)
+    return dataset.apply(tf.data.experimental.unbatch()).map(_remove_padding, num_parallel_calls=num_parallel_calls)
@@ -0,0 +1,177 @@
+import tensorflow as tf
+
+__all__ = ['random_flip_left_right', 'random_expand', 'random_crop_keep_bboxes', 'random_photometric_distort',
+           'image_argument_with_tf', 'get_tf_argument_map_func']
+
+"""
+纯 TensorFlow 实现的数据增强，可以替代 `image_argument_with_imgaug`（基于 tf.py_func）
+
+所有增强函数的输入输出格式一致：
+输入图像是 tf.uint8 类型，shape 为 [height, width, 3]，数据范围 [0, 255]
+输入bboxes是 tf.float32 类型，shape 为 [bbox_number, 4]，顺序为 ymin, xmin, ymax, xmax，数据范围 [0, 1]
+返回结果与输入相同
+
+因为全部是 TF 操作，所以可以在 tf.data 的 map 中通过 num_parallel_calls 并行，不受 GIL 影响。
+"""
+
+
+def random_flip_left_right(image, bboxes, probability=0.5):
+    """
+    随机水平翻转，与 iaa.Fliplr(probability) 对应
+    :param image:
+    :param bboxes:
+    :param probability:
+    :return:
+    """
+
+    def _flip():
+        ymin, xmin, ymax, xmax = tf.unstack(bboxes, axis=1)
+        flipped_bboxes = tf.stack([ymin, 1. - xmax, ymax, 1. - xmin], axis=1)
+        return tf.image.flip_left_right(image), flipped_bboxes
+
+    return tf.cond(tf.random_uniform([]) < probability, _flip, lambda: (image, bboxes))
+
+
+def random_expand(image, bboxes, max_ratio=2.0, fill_value=(124, 117, 104), probability=0.5):
+    """
+    随机缩小（scale jitter），即将原图放到一张更大的画布中，画布剩余部分用 fill_value 填充
+    由于后续预处理会把图片 resize 到 min_size/max_size，所以最终效果就是物体尺寸随机变小
+    :param image:
+    :param bboxes:
+    :param max_ratio:       画布边长与原图边长的最大比例
+    :param fill_value:      画布填充值，rgb格式，默认为 imagenet 均值
+    :param probability:
+    :return:
+    """
+
+    def _expand():
+        height = tf.shape(image)[0]
+        width = tf.shape(image)[1]
+        ratio = tf.random_uniform([], 1.0, max_ratio)
+        new_height = tf.to_int32(tf.to_float(height) * ratio)
+        new_width = tf.to_int32(tf.to_float(width) * ratio)
+        top = tf.random_uniform([], 0, new_height - height + 1, dtype=tf.int32)
+        left = tf.random_uniform([], 0, new_width - width + 1, dtype=tf.int32)
+
+        fill = tf.constant(fill_value, dtype=tf.float32)
+        expanded_image = tf.image.pad_to_bounding_box(tf.to_float(image) - fill, top, left,
+                                                      new_height, new_width) + fill
+        expanded_image = tf.cast(expanded_image, image.dtype)
+
+        scale = tf.to_float(tf.stack([height, width, height, width])) / \
+                tf.to_float(tf.stack([new_height, new_width, new_height, new_width]))
+        offset = tf.to_float(tf.stack([top, left, top, left])) / \
+                 tf.to_float(tf.stack([new_height, new_width, new_height, new_width]))
+        return expanded_image, bboxes * scale + offset
+
+    return tf.cond(tf.random_uniform([]) < probability, _expand, lambda: (image, bboxes))
+
+
+def random_crop_keep_bboxes(image, bboxes, probability=0.5):
+    """
+    随机剪裁（放大），剪裁区域一定包含所有 bboxes，所以不需要同时修改 labels
+    :param image:
+    :param bboxes:
+    :param probability:
+    :return:
+    """
+
+    def _crop():
+        height = tf.to_float(tf.shape(image)[0])
+        width = tf.to_float(tf.shape(image)[1])
+
+        # 剪裁区域的范围：左上角在所有bboxes左上角之前，右下角在所有bboxes右下角之后
+        union_ymin = tf.reduce_min(bboxes[:, 0])
+        union_xmin = tf.reduce_min(bboxes[:, 1])
+        union_ymax = tf.reduce_max(bboxes[:, 2])
+        union_xmax = tf.reduce_max(bboxes[:, 3])
+        crop_ymin = tf.random_uniform([]) * union_ymin
+        crop_xmin = tf.random_uniform([]) * union_xmin
+        crop_ymax = union_ymax + tf.random_uniform([]) * (1. - union_ymax)
+        crop_xmax = union_xmax + tf.random_uniform([]) * (1. - union_xmax)
+
+        offset_height = tf.to_int32(tf.floor(crop_ymin * height))
+        offset_width = tf.to_int32(tf.floor(crop_xmin * width))
+        target_height = tf.maximum(tf.to_int32(tf.ceil(crop_ymax * height)) - offset_height, 1)
+        target_width = tf.maximum(tf.to_int32(tf.ceil(crop_xmax * width)) - offset_width, 1)
+        cropped_image = tf.image.crop_to_bounding_box(image, offset_height, offset_width,
+                                                      target_height, target_width)
+
+        offset = tf.to_float(tf.stack([offset_height, offset_width, offset_height, offset_width]))
+        sizes = tf.to_float(tf.stack([target_height, target_width, target_height, target_width]))
+        scale = tf.stack([height, width, height, width])
+        return cropped_image, (bboxes * scale - offset) / sizes
+
+    do_crop = tf.logical_and(tf.random_uniform([]) < probability, tf.size(bboxes) > 0)
+    return tf.cond(do_crop, _crop, lambda: (image, bboxes))
+
+
+def random_photometric_distort(image, bboxes,
+                               brightness_max_delta=32. / 255.,
+                               contrast_range=(0.5, 1.5),
+                               saturation_range=(0.5, 1.5),
+                               hue_max_delta=0.05):
+    """
+    随机修改亮度、对比度、饱和度、色调，不影响 bboxes
+    :param image:
+    :param bboxes:
+    :param brightness_max_delta:
+    :param contrast_range:
+    :param saturation_range:
+    :param hue_max_delta:
+    :return:
+    """
+    dtype = image.dtype
+    image = tf.image.convert_image_dtype(image, tf.float32)
+    image = tf.image.random_brightness(image, max_delta=brightness_max_delta)
+    image = tf.image.random_contrast(image, lower=contrast_range[0], upper=contrast_range[1])
+    image = tf.image.random_saturation(image, lower=saturation_range[0], upper=saturation_range[1])
+    image = tf.image.random_hue(image, max_delta=hue_max_delta)
+    image = tf.clip_by_value(image, 0., 1.)
+    return tf.image.convert_image_dtype(image, dtype, saturate=True), bboxes
+
+
+def _get_default_tf_argument_sequence():
+    return [
+        random_flip_left_right,
+    ]
+
+
+def image_argument_with_tf(image, bboxes, tf_argument_sequence=None):
+    """
+    增强一张图片，是 `image_argument_with_imgaug` 的纯 TF 版本
+    输入图像是 tf.uint8 类型，数据范围 [0, 255]
+    输入bboxes是 tf.float32 类型，数据范围 [0, 1]
+    返回结果与输入相同
+    :param image:                   一张图片，shape为[None, None, 3]
+    :param bboxes:                  一组bounding box，shape 为 [bbox_number, 4]，顺序为 ymin, xmin, ymax, xmax
+                                    float类型，取值范围[0, 1]
+    :param tf_argument_sequence:    一组增强函数，每个函数的输入输出都是 (image, bboxes)，
+                                    可以通过 functools.partial 设置参数，默认只有随机水平翻转
+    :return:                        图像增强结果，包括image和bbox，其格式与输入相同
+    """
+    if tf_argument_sequence is None:
+        tf_argument_sequence = _get_default_tf_argument_sequence()
+
+    bboxes = tf.reshape(tf.to_float(bboxes), [-1, 4])
+    for argument_fn in tf_argument_sequence:
+        image, bboxes = argument_fn(image, bboxes)
+    return image, tf.clip_by_value(bboxes, 0., 1.)
+
+
+def get_tf_argument_map_func(tf_argument_sequence=None):
+    """
+    获取 dataset 中进行 `image_argument_with_tf` 的 map 函数
+    random_expand、random_crop_keep_bboxes 等会改变图片尺寸，输出的 image_height、image_width 为增强后的图片尺寸，
+    `preprocessing_training_func` 根据这两个值计算 resize 后的尺寸
+    :param tf_argument_sequence:    参考 `image_argument_with_tf`
+    :return:                        map 函数，输入输出都是 image, bboxes, image_height, image_width, labels
+    """
+
+    def _tf_argument_map_func(image, bboxes, image_height, image_width, labels):
+        image, bboxes = image_argument_with_tf(image, bboxes, tf_argument_sequence=tf_argument_sequence)
+        image_shape = tf.shape(image)
+        return image, bboxes, tf.cast(image_shape[0], image_height.dtype), \
+               tf.cast(image_shape[1], image_width.dtype), labels
+
+    return _tf_argument_map_func
@@ -4,7 +4,11 @@ from imgaug import augmenters as iaa
 import numpy as np
 from functools import partial
 
-__all__ = ['image_argument_with_imgaug', 'preprocessing_training_func', 'preprocessing_eval_func']
+__all__ = ['image_argument_with_imgaug', 'preprocessing_training_func', 'preprocessing_eval_func',
+           'preprocessing_training_single_func', 'preprocessing_eval_single_func',
+           'get_aspect_ratio_bucket_shapes', 'bucket_by_aspect_ratio', 'bucket_eval_by_aspect_ratio',
+           'parse_tf_records', 'get_tf_records_dataset', 'get_prefetch_buffer_size', 'get_cached_image_func',
+           'get_anchor_target_map_func']
 
 
 def _get_default_iaa_sequence():
@@ -80,8 +84,33 @@ def _tf_preprocessing(image):
     return tf.image.convert_image_dtype(image, dtype=tf.float32) * 2.0 - 1.0
 
 
+def _get_preprocessing_fn(preprocessing_type, caffe_pixel_means):
+    if preprocessing_type == 'caffe':
+        return partial(_caffe_preprocessing, pixel_means=caffe_pixel_means)
+    elif preprocessing_type == 'tf':
+        return _tf_preprocessing
+    raise ValueError('unknown preprocessing type {}'.format(preprocessing_type))
+
+
+def _get_resized_shape_tf(height, width, min_size, max_size):
+    # 短边最短为 min_size，长边最长为 max_size，矛盾时，优先满足长边
+    scale1 = min_size / tf.minimum(height, width)
+    scale2 = max_size / tf.maximum(height, width)
+    scale = tf.minimum(scale1, scale2)
+    return scale, tf.to_int32(scale * height), tf.to_int32(scale * width)
+
+
+def _resize_uint8_image(image, n_height, n_width):
+    """
+    resize 后重新转换为 uint8，之后的 buffer（shuffle、prefetch、batch 等）大小只有 float32 的 1/4
+    """
+    image = tf.image.resize_bilinear(image, (n_height, n_width))
+    return tf.saturate_cast(tf.round(image), tf.uint8)
+
+
 def preprocessing_training_func(image, bboxes, height, width, labels,
-                                min_size, max_size, preprocessing_type, caffe_pixel_means=None):
+                                min_size, max_size, preprocessing_type, caffe_pixel_means=None,
+                                uint8_image=False):
     """
     输入 rgb 图片，进行以下预处理
     1) 短边最短为 min_size，长边最长为 max_size，矛盾时，优先满足长边
@@ -95,26 +124,18 @@ def preprocessing_training_func(image, bboxes, height, width, labels,
     :param min_size:
     :param preprocessing_type:
     :param caffe_pixel_means:
+    :param uint8_image:         为 True 时只进行 resize，输出 uint8 rgb 图片，归一化在模型中进行（参考 `normalize_image`）
     :return:
     """
-
-    if preprocessing_type == 'caffe':
-        preprocessing_fn = partial(_caffe_preprocessing, pixel_means=caffe_pixel_means)
-    elif preprocessing_type == 'tf':
-        preprocessing_fn = _tf_preprocessing
-    else:
-        raise ValueError('unknown preprocessing type {}'.format(preprocessing_type))
-    image = preprocessing_fn(image)
-
     height = tf.to_float(height[0])
     width = tf.to_float(width[0])
-    scale1 = min_size / tf.minimum(height, width)
-    scale2 = max_size / tf.maximum(height, width)
-    scale = tf.minimum(scale1, scale2)
-    n_height = tf.to_int32(scale * height)
-    n_width = tf.to_int32(scale * width)
+    scale, n_height, n_width = _get_resized_shape_tf(height, width, min_size, max_size)
 
-    image = tf.image.resize_bilinear(image, (n_height, n_width))
+    if uint8_image:
+        image = _resize_uint8_image(image, n_height, n_width)
+    else:
+        image = _get_preprocessing_fn(preprocessing_type, caffe_pixel_means)(image)
+        image = tf.image.resize_bilinear(image, (n_height, n_width))
 
     channels = tf.split(axis=-1, num_or_size_splits=4, value=bboxes)
     channels[0] = channels[0] * tf.to_float(n_height - 1)
@@ -127,28 +148,323 @@ def preprocessing_training_func(image, bboxes, height, width, labels,
 
 
 def preprocessing_eval_func(image, height, width,
-                            min_size, max_size, preprocessing_type, caffe_pixel_means=None):
+                            min_size, max_size, preprocessing_type, caffe_pixel_means=None,
+                            uint8_image=False):
     """
     输入 rgb 图片，进行以下预处理
     1) 短边最短为 min_size，长边最长为 max_size，矛盾时，优先满足长边
-    2) 通过 preprocessing_type 选择 preprocessing 函数
+    2) 通过 preprocessing_type 选择 preprocessing 函数，uint8_image 为 True 时不进行归一化
     """
-    if preprocessing_type == 'caffe':
-        preprocessing_fn = partial(_caffe_preprocessing, pixel_means=caffe_pixel_means)
-    elif preprocessing_type == 'tf':
-        preprocessing_fn = _tf_preprocessing
-    else:
-        raise ValueError('unknown preprocessing type {}'.format(preprocessing_type))
-    image = preprocessing_fn(image)
-
     height = tf.to_float(height[0])
     width = tf.to_float(width[0])
-    scale1 = min_size / tf.minimum(height, width)
-    scale2 = max_size / tf.maximum(height, width)
-    scale = tf.minimum(scale1, scale2)
-    n_height = tf.to_int32(scale * height)
-    n_width = tf.to_int32(scale * width)
+    scale, n_height, n_width = _get_resized_shape_tf(height, width, min_size, max_size)
 
-    image = tf.image.resize_bilinear(image, (n_height, n_width))
+    if uint8_image:
+        image = _resize_uint8_image(image, n_height, n_width)
+    else:
+        image = _get_preprocessing_fn(preprocessing_type, caffe_pixel_means)(image)
+        image = tf.image.resize_bilinear(image, (n_height, n_width))
 
     return image, scale, tf.to_int32(height), tf.to_int32(width)
+
+
+def preprocessing_training_single_func(image, bboxes, height, width, labels,
+                                       min_size, max_size, preprocessing_type, caffe_pixel_means=None,
+                                       uint8_image=False):
+    """
+    与 `preprocessing_training_func` 相同，但输入为单张图片（batch 之前），用于 aspect ratio bucketing
+    :param image:           [height, width, 3]
+    :param bboxes:          [num_bboxes, 4]，取值范围 [0, 1]
+    :param height:
+    :param width:
+    :param labels:          [num_bboxes, ]
+    :param min_size:
+    :param max_size:
+    :param preprocessing_type:
+    :param caffe_pixel_means:
+    :param uint8_image:
+    :return:                image [n_height, n_width, 3], bboxes [num_bboxes, 4], labels [num_bboxes, ],
+                            image_shape [2, ]（即 [n_height, n_width]），num_bboxes
+    """
+    image, bboxes, labels = preprocessing_training_func(tf.expand_dims(image, axis=0),
+                                                        tf.expand_dims(bboxes, axis=0),
+                                                        tf.reshape(height, [1]), tf.reshape(width, [1]),
+                                                        labels,
+                                                        min_size=min_size, max_size=max_size,
+                                                        preprocessing_type=preprocessing_type,
+                                                        caffe_pixel_means=caffe_pixel_means,
+                                                        uint8_image=uint8_image)
+    image = tf.squeeze(image, axis=0)
+    bboxes = tf.reshape(bboxes, [-1, 4])
+    image_shape = tf.shape(image)[:2]
+    return image, bboxes, labels, image_shape, tf.shape(bboxes)[0]
+
+
+def preprocessing_eval_single_func(image, height, width,
+                                   min_size, max_size, preprocessing_type, caffe_pixel_means=None,
+                                   uint8_image=False):
+    """
+    与 `preprocessing_eval_func` 相同，但输入为单张图片（batch 之前），用于 `bucket_eval_by_aspect_ratio`
+    :param image:           [height, width, 3]
+    :param height:          scalar
+    :param width:           scalar
+    :return:                image [n_height, n_width, 3], img_scale, height, width
+    """
+    image, scale, height, width = preprocessing_eval_func(tf.expand_dims(image, axis=0),
+                                                          tf.reshape(height, [1]), tf.reshape(width, [1]),
+                                                          min_size=min_size, max_size=max_size,
+                                                          preprocessing_type=preprocessing_type,
+                                                          caffe_pixel_means=caffe_pixel_means,
+                                                          uint8_image=uint8_image)
+    return tf.squeeze(image, axis=0), scale, height, width
+
+
+def _get_resized_shape(aspect_ratio, min_size, max_size):
+    # aspect_ratio 为 height / width，返回该比例下 resize 后的 (height, width)
+    scale = min(min_size / min(aspect_ratio, 1.), max_size / max(aspect_ratio, 1.))
+    return aspect_ratio * scale, scale
+
+
+def get_aspect_ratio_bucket_shapes(aspect_ratio_boundaries, min_size, max_size):
+    """
+    获取每个 bucket 的 padding 尺寸
+    aspect_ratio_boundaries 将 height/width 划分为 len(aspect_ratio_boundaries)+1 个 bucket
+    resize 后，高度随 height/width 单调不减，宽度随 height/width 单调不增，
+    所以每个 bucket 的尺寸由区间右端点的高度以及左端点的宽度决定
+    :param aspect_ratio_boundaries:     递增的 height/width 分界点
+    :param min_size:
+    :param max_size:
+    :return:                            list of (bucket_height, bucket_width)
+    """
+    lower_bounds = [None] + list(aspect_ratio_boundaries)
+    upper_bounds = list(aspect_ratio_boundaries) + [None]
+    bucket_shapes = []
+    for lower, upper in zip(lower_bounds, upper_bounds):
+        bucket_height = max_size if upper is None else _get_resized_shape(upper, min_size, max_size)[0]
+        bucket_width = max_size if lower is None else _get_resized_shape(lower, min_size, max_size)[1]
+        bucket_shapes.append((int(np.ceil(bucket_height)) + 1, int(np.ceil(bucket_width)) + 1))
+    return bucket_shapes
+
+
+def bucket_by_aspect_ratio(dataset, batch_size, min_size, max_size, aspect_ratio_boundaries=None):
+    """
+    根据 aspect ratio 将图片分组，组内 padding 到固定尺寸后 batch
+    输入 dataset 的元素为 `preprocessing_training_single_func` 的输出：
+    image, bboxes, labels, image_shape, num_bboxes
+    输出 dataset 的元素为：
+    image [batch_size, bucket_height, bucket_width, 3]，padding 部分为0（caffe 预处理后即像素均值，uint8 图片则为黑色）
+    bboxes [batch_size, max_num_bboxes, 4]，padding 部分为0
+    labels [batch_size, max_num_bboxes]，padding 部分为-1
+    image_shape [batch_size, 2]，每张图片的真实尺寸
+    num_bboxes [batch_size, ]，每张图片的真实 bboxes 数量
+    :param dataset:
+    :param batch_size:
+    :param min_size:
+    :param max_size:
+    :param aspect_ratio_boundaries:
+    :return:
+    """
+    if aspect_ratio_boundaries is None:
+        aspect_ratio_boundaries = [0.5, 0.75, 1.0, 1.5, 2.0]
+    bucket_shapes = get_aspect_ratio_bucket_shapes(aspect_ratio_boundaries, min_size, max_size)
+    boundaries = tf.constant(aspect_ratio_boundaries, dtype=tf.float32)
+    bucket_heights = tf.constant([shape[0] for shape in bucket_shapes], dtype=tf.int64)
+    bucket_widths = tf.constant([shape[1] for shape in bucket_shapes], dtype=tf.int64)
+
+    def _key_func(image, bboxes, labels, image_shape, num_bboxes):
+        aspect_ratio = tf.to_float(image_shape[0]) / tf.to_float(image_shape[1])
+        return tf.reduce_sum(tf.to_int64(aspect_ratio > boundaries))
+
+    def _reduce_func(key, window_dataset):
+        image_type, bboxes_type, labels_type, image_shape_type, num_bboxes_type = window_dataset.output_types
+        padded_shapes = (tf.stack([tf.gather(bucket_heights, key), tf.gather(bucket_widths, key),
+                                   tf.constant(3, tf.int64)]),
+                         tf.constant([-1, 4], tf.int64),
+                         tf.constant([-1], tf.int64),
+                         tf.constant([2], tf.int64),
+                         tf.constant([], tf.int64))
+        padding_values = (tf.constant(0, image_type),
+                          tf.constant(0, bboxes_type),
+                          tf.constant(-1, labels_type),
+                          tf.constant(0, image_shape_type),
+                          tf.constant(0, num_bboxes_type))
+        return window_dataset.padded_batch(batch_size, padded_shapes=padded_shapes, padding_values=padding_values)
+
+    return dataset.apply(tf.data.experimental.group_by_window(_key_func, _reduce_func, window_size=batch_size))
+
+
+def bucket_eval_by_aspect_ratio(dataset, batch_size, min_size, max_size, aspect_ratio_boundaries=None):
+    """
+    eval 版本的 `bucket_by_aspect_ratio`，padding 方式以及 bucket 尺寸相同
+    输入 dataset 的元素为单张图片的 image [n_height, n_width, 3]，以及若干 scalar（如 img_scale、原始尺寸、图片编号）
+    输出 dataset 的元素为：
+    image [batch_size, bucket_height, bucket_width, 3]，padding 部分为0
+    image_shape [batch_size, 2]，每张图片 resize 后的真实尺寸
+    以及输入中的每个 scalar，shape 均为 [batch_size, ]
+    分组后输出顺序与输入顺序不同，需要在输入中添加图片编号（如 pascal 的 index 或 coco 的 img_id）
+    最后每个 bucket 中剩余的图片也会输出，此时 batch 小于 batch_size
+    :param dataset:
+    :param batch_size:
+    :param min_size:
+    :param max_size:
+    :param aspect_ratio_boundaries:
+    :return:
+    """
+    if aspect_ratio_boundaries is None:
+        aspect_ratio_boundaries = [0.5, 0.75, 1.0, 1.5, 2.0]
+    bucket_shapes = get_aspect_ratio_bucket_shapes(aspect_ratio_boundaries, min_size, max_size)
+    boundaries = tf.constant(aspect_ratio_boundaries, dtype=tf.float32)
+    bucket_heights = tf.constant([shape[0] for shape in bucket_shapes], dtype=tf.int64)
+    bucket_widths = tf.constant([shape[1] for shape in bucket_shapes], dtype=tf.int64)
+
+    def _add_image_shape(image, *args):
+        return (image, tf.shape(image)[:2]) + args
+
+    def _key_func(image, image_shape, *args):
+        aspect_ratio = tf.to_float(image_shape[0]) / tf.to_float(image_shape[1])
+        return tf.reduce_sum(tf.to_int64(aspect_ratio > boundaries))
+
+    def _reduce_func(key, window_dataset):
+        output_types = window_dataset.output_types
+        padded_shapes = (tf.stack([tf.gather(bucket_heights, key), tf.gather(bucket_widths, key),
+                                   tf.constant(3, tf.int64)]),
+                         tf.constant([2], tf.int64)) + \
+            tuple(tf.constant([], tf.int64) for _ in output_types[2:])
+        padding_values = tuple(tf.constant(0, cur_type) for cur_type in output_types)
+        return window_dataset.padded_batch(batch_size, padded_shapes=padded_shapes, padding_values=padding_values)
+
+    return dataset.map(_add_image_shape).apply(
+        tf.data.experimental.group_by_window(_key_func, _reduce_func, window_size=batch_size))
+
+
+def parse_tf_records(serialized_example):
+    """
+    解析 pascal 以及 coco tfrecords 文件（格式参考 `generate_pascal_tf_records.py` 以及 `generate_coco_tf_records.py`）
+    :param serialized_example:
+    :return:    image（rgb uint8）, bboxes（ymin, xmin, ymax, xmax，[0, 1]范围）, height, width, labels
+    """
+    features = tf.parse_single_example(serialized_example,
+                                       features={'image/height': tf.FixedLenFeature([1], tf.int64),
+                                                 'image/width': tf.FixedLenFeature([1], tf.int64),
+                                                 'image/filename': tf.FixedLenFeature([1], tf.string),
+                                                 'image/encoded': tf.FixedLenFeature([1], tf.string),
+                                                 'image/object/bbox/xmin': tf.VarLenFeature(tf.float32),
+                                                 'image/object/bbox/xmax': tf.VarLenFeature(tf.float32),
+                                                 'image/object/bbox/ymin': tf.VarLenFeature(tf.float32),
+                                                 'image/object/bbox/ymax': tf.VarLenFeature(tf.float32),
+                                                 'image/object/class/label': tf.VarLenFeature(tf.int64),
+                                                 'image/object/class/text': tf.VarLenFeature(tf.string),
+                                                 }
+                                       )
+    features['image/object/bbox/xmin'] = tf.sparse_tensor_to_dense(features['image/object/bbox/xmin'])
+    features['image/object/bbox/xmax'] = tf.sparse_tensor_to_dense(features['image/object/bbox/xmax'])
+    features['image/object/bbox/ymin'] = tf.sparse_tensor_to_dense(features['image/object/bbox/ymin'])
+    features['image/object/bbox/ymax'] = tf.sparse_tensor_to_dense(features['image/object/bbox/ymax'])
+    features['image/object/class/label'] = tf.sparse_tensor_to_dense(features['image/object/class/label'])
+    image = tf.image.decode_jpeg(features['image/encoded'][0], channels=3)
+    bboxes = tf.transpose(tf.stack((features['image/object/bbox/ymin'],
+                                    features['image/object/bbox/xmin'],
+                                    features['image/object/bbox/ymax'],
+                                    features['image/object/bbox/xmax'])), name='bboxes')
+    return image, bboxes, features['image/height'][0], features['image/width'][0], features['image/object/class/label']
+
+
+def get_tf_records_dataset(tf_records_list, num_parallel_reads=4, read_buffer_size=None,
+                           num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                           shuffle=False, shuffle_buffer_size=1000,
+                           shuffle_seed=None, skip=0):
+    """
+    读取并解析 tfrecords 文件
+    num_parallel_reads 大于1时，通过 parallel interleave 同时读取多个文件（文件内部顺序不变，不同文件交替输出），
+    否则按照文件顺序依次读取（即原先的读取方式）
+    shuffle 在解析之前进行，即打乱文件顺序以及序列化后的 records（jpeg 编码，体积远小于解码后的图片）
+    :param tf_records_list:
+    :param num_parallel_reads:      同时读取的文件数量
+    :param read_buffer_size:        每个文件的读取 buffer 大小（bytes），None 表示使用 TFRecordDataset 的默认值
+    :param num_parallel_calls:      解析（包括 jpeg 解码）的并行数量，默认为 AUTOTUNE，None 表示不并行
+    :param shuffle:
+    :param shuffle_buffer_size:     records 的数量
+    :param shuffle_seed:            相同的 seed 得到相同的 records 顺序，用于从 checkpoint 恢复训练
+    :param skip:                    跳过前 skip 个 records（在解析之前进行，只需要读取，不需要解码）
+    :return:                        输出与 `parse_tf_records` 相同
+    """
+    files = tf.data.Dataset.from_tensor_slices(tf_records_list)
+    if shuffle:
+        files = files.shuffle(buffer_size=len(tf_records_list), seed=shuffle_seed)
+    if num_parallel_reads is None or num_parallel_reads <= 1 or len(tf_records_list) <= 1:
+        dataset = tf.data.TFRecordDataset(files, buffer_size=read_buffer_size)
+    else:
+        dataset = files.apply(
+            tf.data.experimental.parallel_interleave(partial(tf.data.TFRecordDataset, buffer_size=read_buffer_size),
+                                                     cycle_length=min(num_parallel_reads, len(tf_records_list)))
+        )
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size, seed=shuffle_seed)
+    if skip > 0:
+        dataset = dataset.skip(skip)
+    return dataset.map(parse_tf_records, num_parallel_calls=num_parallel_calls)
+
+
+def get_prefetch_buffer_size(prefetch_buffer_size, batch_size, max_size, prefetch_max_bytes=None, uint8_image=False):
+    """
+    获取 prefetch 的 buffer 大小（batch 数量）
+    预处理后的图片为 float32（uint8_image 时为 uint8），每个 batch 的大小不超过 batch_size * max_size * max_size * 3 * 4 bytes，
+    设置 prefetch_max_bytes 时，buffer 大小不超过 prefetch_max_bytes 对应的 batch 数量（至少为1）
+    :param prefetch_buffer_size:    batch 数量
+    :param batch_size:
+    :param max_size:
+    :param prefetch_max_bytes:      None 表示不限制
+    :param uint8_image:
+    :return:
+    """
+    if prefetch_max_bytes is None:
+        return prefetch_buffer_size
+    max_bytes_per_batch = batch_size * max_size * max_size * 3 * (1 if uint8_image else 4)
+    return max(1, min(prefetch_buffer_size, prefetch_max_bytes // max_bytes_per_batch))
+
+
+def get_cached_image_func(image_cache, min_size, max_size):
+    """
+    获取读取图片的函数，优先从 `ResizedImageCache` 中读取 resize 后的 uint8 图片，
+    未命中时解码 jpeg、resize（与 `preprocessing_training_func` 等相同），并写入缓存
+    因为返回的图片已经 resize，之后的 preprocessing 中的 resize 不会改变图片尺寸
+    :param image_cache:     `ResizedImageCache` 对象，其 min_size/max_size 与输入参数相同
+    :param min_size:
+    :param max_size:
+    :return:                函数，输入 key（tf.string）, file_path, height, width，输出 [n_height, n_width, 3] uint8 rgb 图片
+    """
+
+    def _cached_image_func(key, file_path, height, width):
+        cached_image = tf.py_func(image_cache.get_or_empty, [key], tf.uint8, stateful=True)
+
+        def _decode_and_put():
+            image = tf.image.decode_jpeg(tf.io.read_file(file_path), channels=3)
+            _, n_height, n_width = _get_resized_shape_tf(tf.to_float(height), tf.to_float(width), min_size, max_size)
+            image = _resize_uint8_image(tf.expand_dims(image, axis=0), n_height, n_width)[0]
+            return tf.py_func(image_cache.put, [key, image, height, width], tf.uint8, stateful=True)
+
+        image = tf.cond(tf.size(cached_image) > 0, lambda: cached_image, _decode_and_put)
+        image.set_shape([None, None, 3])
+        return image
+
+    return _cached_image_func
+
+
+def get_anchor_target_map_func(anchor_target_fn):
+    """
+    获取在 `tf.data` 中计算 anchor target 的 map 函数，用于 batch_size 为 1 时 preprocessing 之后
+    anchor target 只依赖 gt_bboxes、图片尺寸以及 anchors，在数据集中并行计算，可以与模型的前向计算同时进行
+    :param anchor_target_fn:    如 `BaseFasterRcnn.get_anchor_target`，输入 gt_bboxes（xmin, ymin, xmax, ymax）以及 image_shape
+    :return:                    map 函数，输入 image, bboxes, labels（`preprocessing_training_func` 的输出），
+                                输出 image, bboxes, labels, rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights
+    """
+
+    def _anchor_target_map_func(image, bboxes, labels):
+        # ymin, xmin, ymax, xmax -> xmin, ymin, xmax, ymax，与 `train_one_epoch` 中的转换相同
+        channels = tf.split(bboxes[0], 4, axis=-1)
+        gt_bboxes = tf.concat([channels[1], channels[0], channels[3], channels[2]], axis=-1)
+        image_shape = tf.to_float(tf.shape(image)[1:3])
+        anchor_targets = anchor_target_fn(gt_bboxes, [image_shape[0], image_shape[1]])
+        return (image, bboxes, labels) + tuple(anchor_targets)
+
+    return _anchor_target_map_func
@@ -0,0 +1,168 @@
+import os
+import mmap
+import struct
+import numpy as np
+import tensorflow as tf
+
+__all__ = ['get_default_index_file_path', 'get_record_sizes_index', 'build_tf_record_index', 'save_tf_record_index',
+           'load_tf_record_index', 'TFRecordRandomAccessReader', 'get_tf_record_random_access_reader',
+           'get_tf_records_dataset_by_index']
+
+"""
+tfrecords 文件的 offset 索引，以及基于 mmap 的随机读取
+tfrecords 文件中每个 record 的格式为：
+    uint64 length, uint32 masked_crc32_of_length, byte data[length], uint32 masked_crc32_of_data
+索引文件为 `{tf_record_path}.index.npy`，保存 [num_records, 2] 的 int64 数组，每行为 data 的 (offset, length)，
+通过索引可以按照 record 编号直接读取，不需要按顺序读取整个文件，从而：
+1) 每个 epoch 对所有 records 进行全局的随机排列，不需要 shuffle buffer；
+2) 多个 worker 按照 rank 划分 records；
+3) 从 checkpoint 恢复时直接跳到对应的位置。
+"""
+
+_HEADER_BYTES = 12  # uint64 length + uint32 crc
+_FOOTER_BYTES = 4  # uint32 crc
+
+
+def get_default_index_file_path(tf_record_path):
+    return tf_record_path + '.index.npy'
+
+
+def get_record_sizes_index(record_sizes):
+    """
+    根据每个 record 的大小（序列化后的 bytes 数）计算索引，用于写 tfrecords 文件时同时生成索引
+    :param record_sizes:    list of int
+    :return:                [num_records, 2] int64，每行为 (offset, length)
+    """
+    record_sizes = np.array(record_sizes, dtype=np.int64).reshape([-1])
+    record_ends = np.cumsum(record_sizes + _HEADER_BYTES + _FOOTER_BYTES)
+    offsets = record_ends - record_sizes - _FOOTER_BYTES
+    return np.stack([offsets, record_sizes], axis=1)
+
+
+def build_tf_record_index(tf_record_path):
+    """
+    扫描已有的 tfrecords 文件（只读取每个 record 的 header），生成索引
+    :param tf_record_path:
+    :return:                [num_records, 2] int64，每行为 (offset, length)
+    """
+    index = []
+    file_size = os.path.getsize(tf_record_path)
+    with open(tf_record_path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(_HEADER_BYTES)
+            if len(header) < _HEADER_BYTES:
+                raise ValueError('truncated record header at offset {} in {}'.format(offset, tf_record_path))
+            length, = struct.unpack('<Q', header[:8])
+            index.append((offset + _HEADER_BYTES, length))
+            offset += _HEADER_BYTES + length + _FOOTER_BYTES
+    if offset != file_size:
+        raise ValueError('truncated record at the end of {}'.format(tf_record_path))
+    return np.array(index, dtype=np.int64).reshape([-1, 2])
+
+
+def save_tf_record_index(index, index_file_path):
+    np.save(index_file_path, index)
+
+
+def load_tf_record_index(index_file_path):
+    return np.load(index_file_path)
+
+
+class TFRecordRandomAccessReader(object):
+    def __init__(self, tf_records_list, index_file_paths=None):
+        """
+        多个 tfrecords 文件按照顺序编号，第 i 个文件的 records 编号紧接在第 i - 1 个文件之后
+        :param tf_records_list:
+        :param index_file_paths:    None 时使用 `get_default_index_file_path`
+        """
+        if index_file_paths is None:
+            index_file_paths = [get_default_index_file_path(path) for path in tf_records_list]
+        self._files = []
+        self._mmaps = []
+        indices = []
+        for tf_record_path, index_file_path in zip(tf_records_list, index_file_paths):
+            if not os.path.exists(index_file_path):
+                raise ValueError('index file {} does not exist, '
+                                 'generate it by `generate_pascal_tf_records.py --index_only True`'
+                                 .format(index_file_path))
+            f = open(tf_record_path, 'rb')
+            self._files.append(f)
+            self._mmaps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            indices.append(load_tf_record_index(index_file_path))
+
+        # 第 i 个 record 所在的文件为 file_ids[i]，在文件中的 (offset, length) 为 index[i]
+        self._file_ids = np.concatenate([np.full([len(index)], file_id, dtype=np.int64)
+                                         for file_id, index in enumerate(indices)])
+        self._index = np.concatenate(indices, axis=0)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_record(self, record_id):
+        """
+        :param record_id:   全局的 record 编号
+        :return:            序列化的 tf.train.Example（bytes）
+        """
+        offset, length = self._index[record_id]
+        return self._mmaps[self._file_ids[record_id]][offset:offset + length]
+
+    def close(self):
+        for m in self._mmaps:
+            m.close()
+        for f in self._files:
+            f.close()
+        self._mmaps = []
+        self._files = []
+
+
+_READERS = {}
+
+
+def get_tf_record_random_access_reader(tf_records_list):
+    """
+    获取全局的 `TFRecordRandomAccessReader` 对象，相同的 tfrecords 文件共享同一个对象，
+    训练时每个 epoch 都会重新构建 dataset，避免每个 epoch 都重新打开文件以及 mmap
+    """
+    key = tuple(os.path.abspath(path) for path in tf_records_list)
+    if key not in _READERS:
+        _READERS[key] = TFRecordRandomAccessReader(tf_records_list)
+    return _READERS[key]
+
+
+def get_tf_records_dataset_by_index(tf_records_list, parse_fn,
+                                    shuffle=False, shuffle_seed=None,
+                                    num_workers=1, worker_rank=0,
+                                    skip=0,
+                                    num_parallel_calls=tf.data.experimental.AUTOTUNE):
+    """
+    通过索引随机读取 tfrecords 文件
+    1) shuffle 时，所有 records 进行全局随机排列（np.random.RandomState(shuffle_seed)），否则按照文件顺序；
+    2) 第 worker_rank 个 worker 获取排列后的第 worker_rank, worker_rank + num_workers, ... 个 records；
+    3) 跳过前 skip 个 records（不读取）；
+    4) 通过 mmap 读取 records，并通过 parse_fn 解析。
+    :param tf_records_list:
+    :param parse_fn:                如 `parse_tf_records`
+    :param shuffle:
+    :param shuffle_seed:            相同的 seed 得到相同的排列，每个 epoch 应使用不同的 seed
+    :param num_workers:
+    :param worker_rank:
+    :param skip:                    当前 worker 已经处理的 records 数量
+    :param num_parallel_calls:      读取以及解析的并行数量
+    :return:                        输出与 parse_fn 相同
+    """
+    reader = get_tf_record_random_access_reader(tf_records_list)
+    record_ids = np.arange(len(reader), dtype=np.int64)
+    if shuffle:
+        record_ids = np.random.RandomState(shuffle_seed).permutation(record_ids)
+    record_ids = record_ids[worker_rank::num_workers][skip:]
+
+    def _read_record(record_id):
+        serialized_example = tf.py_func(reader.get_record, [record_id], tf.string, stateful=False)
+        serialized_example.set_shape([])
+        return serialized_example
+
+    dataset = tf.data.Dataset.from_tensor_slices(record_ids)
+    dataset = dataset.map(_read_record, num_parallel_calls=num_parallel_calls)
+    return dataset.map(parse_fn, num_parallel_calls=num_parallel_calls)
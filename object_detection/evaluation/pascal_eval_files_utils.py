@@ -1,9 +1,9 @@
+import time
 import tensorflow as tf
 import numpy as np
 from tqdm import tqdm
 from object_detection.dataset.eval_pascal_tf_dataset import get_dataset_by_local_file, get_dataset_by_tf_records
-from object_detection.utils.bbox_transform import decode_bbox_with_mean_and_std
-from object_detection.utils.bbox_tf import bboxes_clip_filter
+from object_detection.model.prediction import post_ops_prediction
 
 num_classes = 21
 class_list = ('__background__',  # always index 0
@@ -26,7 +26,11 @@ def get_prediction_files(cur_model,
                          score_threshold=0.0, iou_threshold=0.5,
                          max_objects_per_class=50, max_objects_per_image=50,
                          target_means=None, target_stds=None,
-                         min_size=10):
+                         min_size=10,
+                         uint8_image=False,
+                         image_cache_dir=None,
+                         batch_size=1,
+                         num_parallel_calls=tf.data.experimental.AUTOTUNE, prefetch_buffer_size=2):
     """
     使用模型，生成预测结果文件
     :param cur_model:                   已导入pre-trained model的模型
@@ -46,6 +50,12 @@ def get_prediction_files(cur_model,
     :param target_means:                decode_bbox_with_mean_and_std 参数
     :param target_stds:                 decode_bbox_with_mean_and_std 参数
     :param min_size:                    最终结果最小边长（像素）
+    :param uint8_image:                 数据集输出 uint8 rgb 图片，归一化在模型中进行
+    :param image_cache_dir:             resize 后图片的磁盘缓存目录，目前只支持 cv2 数据集
+    :param batch_size:                  大于 1 时图片按 aspect ratio 分组、padding 后通过 `im_detect_batch` 预测，
+                                        post_ops_prediction 仍然逐张图片进行
+    :param num_parallel_calls:          数据集中同时读取、预处理图片的线程数量，为 None 时按顺序进行
+    :param prefetch_buffer_size:        数据集预先读取的图片数量，为 None 时不 prefetch
     :return:
     """
     if image_format not in ['bgr', 'rgb']:
@@ -56,12 +66,21 @@ def get_prediction_files(cur_model,
                                                              image_format=image_format,
                                                              preprocessing_type=preprocessing_type,
                                                              caffe_pixel_means=caffe_pixel_means,
-                                                             min_edge=min_edge, max_edge=max_edge)
+                                                             min_edge=min_edge, max_edge=max_edge,
+                                                             uint8_image=uint8_image,
+                                                             image_cache_dir=image_cache_dir,
+                                                             batch_size=batch_size,
+                                                             num_parallel_calls=num_parallel_calls,
+                                                             prefetch_buffer_size=prefetch_buffer_size)
     elif dataset_type == 'tf':
         eval_dataset, image_sets = get_dataset_by_tf_records(mode, data_root_path,
                                                              preprocessing_type=preprocessing_type,
                                                              caffe_pixel_means=caffe_pixel_means,
-                                                             min_edge=min_edge, max_edge=max_edge)
+                                                             min_edge=min_edge, max_edge=max_edge,
+                                                             uint8_image=uint8_image,
+                                                             batch_size=batch_size,
+                                                             num_parallel_calls=num_parallel_calls,
+                                                             prefetch_buffer_size=prefetch_buffer_size)
     else:
         raise ValueError('unknown dataset type {}'.format(dataset_type))
 
@@ -72,39 +91,41 @@ def get_prediction_files(cur_model,
 
     all_boxes = [[[] for _ in range(len(image_sets))]
                  for _ in range(num_classes)]
-    i = 0
-    for img, img_scale, raw_h, raw_w in tqdm(eval_dataset):
-        raw_h = tf.to_float(raw_h)
-        raw_w = tf.to_float(raw_w)
-        scores, roi_txtytwth, rois = cur_model.im_detect(img, img_scale)
-        roi_txtytwth = tf.reshape(roi_txtytwth, [-1, num_classes, 4])
-        for j in range(1, num_classes):
-            inds = tf.where(scores[:, j] > score_threshold)[:, 0]
-            cls_scores = tf.gather(scores[:, j], inds)
-            cls_boxes = decode_bbox_with_mean_and_std(tf.gather(rois, inds),
-                                                      tf.gather(roi_txtytwth[:, j, :], inds),
-                                                      target_means=target_means, target_stds=target_stds)
-            cls_boxes, inds = bboxes_clip_filter(cls_boxes, 0, raw_h, raw_w, min_size)
-            cls_scores = tf.gather(cls_scores, inds)
-            keep = tf.image.non_max_suppression(cls_boxes, cls_scores, max_objects_per_class,
-                                                iou_threshold=iou_threshold)
 
-            cls_scores = cls_scores.numpy()
-            cls_boxes = cls_boxes.numpy()
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            cls_dets = cls_dets[keep.numpy(), :]
-            all_boxes[j][i] = cls_dets
+    def _fill_all_boxes(image_idx, scores, roi_txtytwth, rois, raw_h, raw_w):
+        # 所有类别一次完成 decode 以及 nms，结果已经按照 max_objects_per_image 截取
+        bboxes, labels, cls_scores = post_ops_prediction(scores, roi_txtytwth, rois, (raw_h, raw_w),
+                                                         target_means, target_stds,
+                                                         max_num_per_class=max_objects_per_class,
+                                                         max_num_per_image=max_objects_per_image,
+                                                         nms_iou_threshold=iou_threshold,
+                                                         score_threshold=score_threshold,
+                                                         num_classes=num_classes,
+                                                         min_edge=min_size)
+        labels = labels.numpy()
+        dets = np.hstack((bboxes.numpy(), cls_scores.numpy()[:, np.newaxis])).astype(np.float32, copy=False)
+        for j in range(1, num_classes):
+            all_boxes[j][image_idx] = dets[labels == j, :]
 
-        if max_objects_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in range(1, num_classes)])
-            if len(image_scores) > max_objects_per_image:
-                image_thresh = np.sort(image_scores)[-max_objects_per_image]
-                for j in range(1, num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        i += 1
+    i = 0
+    start = time.time()
+    if batch_size == 1:
+        for img, img_scale, raw_h, raw_w in tqdm(eval_dataset):
+            scores, roi_txtytwth, rois = cur_model.im_detect(img, img_scale)
+            _fill_all_boxes(i, scores, roi_txtytwth, rois, raw_h, raw_w)
+            i += 1
+    else:
+        # 分组后图片顺序与 image_sets 不同，通过 example_idx 对应
+        with tqdm(total=len(image_sets)) as pbar:
+            for imgs, image_shapes, img_scales, raw_hs, raw_ws, example_idx in eval_dataset:
+                scores_list, roi_txtytwth_list, rois_list = cur_model.im_detect_batch(imgs, image_shapes, img_scales)
+                for k in range(len(scores_list)):
+                    _fill_all_boxes(int(example_idx[k]), scores_list[k], roi_txtytwth_list[k], rois_list[k],
+                                    raw_hs[k], raw_ws[k])
+                i += len(scores_list)
+                pbar.update(len(scores_list))
+    tf.logging.info('predict {} images in {:.2f}s, {:.2f} images/s'.format(i, time.time() - start,
+                                                                         i / max(time.time() - start, 1e-6)))
 
     for cls_ind, cls in enumerate(class_list):
         if cls == '__background__':
@@ -1,7 +1,6 @@
 import tensorflow as tf
 from object_detection.utils.bbox_transform import encode_bbox_with_mean_and_std
-from object_detection.utils.bbox_tf import pairwise_iou, bboxes_range_filter
-from tensorflow.python.platform import tf_logging
+from object_detection.utils.bbox_tf import pairwise_iou_max, bboxes_range_filter
 
 
 class AnchorTarget(tf.keras.Model):
@@ -11,9 +10,17 @@ class AnchorTarget(tf.keras.Model):
                  total_num_samples=256,
                  max_pos_samples=128,
                  target_means=None,
-                 target_stds=None):
+                 target_stds=None,
+                 use_static_shape=False,
+                 iou_chunk_size=16384):
+        """
+        :param iou_chunk_size:  anchors 与 gt_bboxes 的 iou 分块计算（参考 `pairwise_iou_max`），
+                                每次只计算 iou_chunk_size 个 anchors，None 表示计算完整的 iou 矩阵
+        """
         super().__init__()
 
+        self._use_static_shape = use_static_shape
+        self._iou_chunk_size = iou_chunk_size
         self._pos_iou_threshold = pos_iou_threshold
         self._neg_iou_threshold = neg_iou_threshold
         self._total_num_samples = total_num_samples
@@ -41,70 +48,154 @@ class AnchorTarget(tf.keras.Model):
                 2）所有anchors对应的 txtwtyth [all_anchors_num, 4]，只有正例参加训练，反例不参加训练
                 3）smooth l1 loss 中的 bbox_inside_weights [all_anchors_num, 4]
                 3）smooth l1 loss 中的 bbox_outside_weights [all_anchors_num, 4]
+        如果设置了 use_static_shape，则不筛选 anchors，而是将超出边界的 anchors 设置为不参与训练，所有中间结果 shape 固定。
         :param inputs:
         :param training:
         :param mask:
         :return:
         """
-        gt_bboxes, image_shape, all_anchors = inputs
+        # 可选的第四个输入为 `AnchorCache` 的缓存对象，包含提前计算好的 inside index 以及 anchors 几何信息
+        if len(inputs) == 4:
+            gt_bboxes, image_shape, all_anchors, anchors_entry = inputs
+        else:
+            gt_bboxes, image_shape, all_anchors = inputs
+            anchors_entry = None
         total_anchors = all_anchors.get_shape().as_list()[0]
+        if total_anchors is None:
+            total_anchors = tf.shape(all_anchors)[0]
 
         # 1. 对 anchors 进行过滤，筛选符合边界要求的 anchor，之后操作都基于筛选后的结果。
-        tf_logging.debug('anchor target, before filter has %d anchors' % all_anchors.shape[0])
-        selected_anchor_idx = bboxes_range_filter(all_anchors, image_shape[0], image_shape[1])
-        anchors = tf.gather(all_anchors, selected_anchor_idx)
-        tf_logging.debug('anchor target, after filter has %d anchors' % anchors.shape[0])
-
-        # 准备工作
-        labels = -tf.ones((anchors.shape[0],), tf.int32)
-        overlaps = pairwise_iou(anchors, gt_bboxes)  # [anchors_size, gt_bboxes_size]
-        argmax_overlaps = tf.argmax(overlaps, axis=1, output_type=tf.int32)
-        max_overlaps = tf.reduce_max(overlaps, axis=1)
-        gt_max_overlaps = tf.reduce_max(overlaps, axis=0)
-        gt_argmax_overlaps = tf.where(tf.equal(overlaps, gt_max_overlaps))[:, 0]
+        inside_mask = None
+        if self._use_static_shape:
+            anchors = all_anchors
+            anchors_geometry = anchors_entry['geometry'] if anchors_entry is not None else None
+            inside_mask = _inside_mask(all_anchors, image_shape[0], image_shape[1])
+        elif anchors_entry is None:
+            selected_anchor_idx = bboxes_range_filter(all_anchors, image_shape[0], image_shape[1])
+            anchors = tf.gather(all_anchors, selected_anchor_idx)
+            anchors_geometry = None
+        else:
+            selected_anchor_idx = anchors_entry['inside_idx']
+            anchors = anchors_entry['inside_anchors']
+            anchors_geometry = anchors_entry['inside_geometry']
+
+        # use_static_shape 时（XLA）保持原先的完整 iou 矩阵，不引入 while_loop
+        iou_chunk_size = None if self._use_static_shape else self._iou_chunk_size
+        labels, argmax_overlaps = self._get_overlap_labels(anchors, gt_bboxes, inside_mask, iou_chunk_size)
+        labels, bboxes_targets, bbox_inside_weights, bbox_outside_weights = self._sample_and_encode(
+            labels, argmax_overlaps, anchors, gt_bboxes, anchors_geometry)
+
+        # 生成最终结果
+        if inside_mask is not None:
+            # 没有筛选 anchors，不需要 unmap
+            return tf.stop_gradient(tf.to_float(labels)), tf.stop_gradient(bboxes_targets), \
+                   tf.stop_gradient(bbox_inside_weights), tf.stop_gradient(bbox_outside_weights)
+        return tf.stop_gradient(_unmap(labels, total_anchors, selected_anchor_idx, -1)), \
+               tf.stop_gradient(_unmap(bboxes_targets, total_anchors, selected_anchor_idx, 0)), \
+               tf.stop_gradient(_unmap(bbox_inside_weights, total_anchors, selected_anchor_idx, 0)), \
+               tf.stop_gradient(_unmap(bbox_outside_weights, total_anchors, selected_anchor_idx, 0))
+
+    def get_overlap_labels(self, inputs):
+        """
+        计算随机采样之前的 labels 以及每个 anchor 对应的 gt_bboxes index，结果只依赖 gt_bboxes 与 anchors，
+        可以提前计算并保存（参考 `anchor_target_cache_utils`），之后通过 `call_with_overlap_labels` 得到 anchor target。
+        不筛选 anchors，超出边界的 anchors 的 label 为 -1（与 use_static_shape 相同）。
+        :param inputs:  与 `call` 相同
+        :return:        labels [all_anchors_num, ]，int32，-1/0/1；argmax_overlaps [all_anchors_num, ]，int32
+        """
+        gt_bboxes, image_shape, all_anchors = inputs[:3]
+        inside_mask = _inside_mask(all_anchors, image_shape[0], image_shape[1])
+        return self._get_overlap_labels(all_anchors, gt_bboxes, inside_mask, self._iou_chunk_size)
+
+    def call_with_overlap_labels(self, inputs):
+        """
+        通过 `get_overlap_labels` 的结果计算 anchor target，不需要计算 anchors 与 gt_bboxes 的 iou，只进行随机采样以及 encode
+        输出与 use_static_shape 时的 `call` 相同，超出边界的 anchors 的 bboxes targets 不为0，但 inside/outside weights 都为0
+        :param inputs:  gt_bboxes, all_anchors, anchors_geometry（可以为 None）, labels, argmax_overlaps
+        :return:        与 `call` 相同
+        """
+        gt_bboxes, all_anchors, anchors_geometry, labels, argmax_overlaps = inputs
+        labels, bboxes_targets, bbox_inside_weights, bbox_outside_weights = self._sample_and_encode(
+            labels, argmax_overlaps, all_anchors, gt_bboxes, anchors_geometry)
+        return tf.stop_gradient(tf.to_float(labels)), tf.stop_gradient(bboxes_targets), \
+               tf.stop_gradient(bbox_inside_weights), tf.stop_gradient(bbox_outside_weights)
+
+    def _get_overlap_labels(self, anchors, gt_bboxes, inside_mask=None, iou_chunk_size=None):
+        """
+        `call` 的第2~4步，不包括随机采样
+        :return:    labels, argmax_overlaps
+        """
+        # 准备工作，分块计算 iou，不保存完整的 [anchors_size, gt_bboxes_size] 矩阵
+        # 超出边界的 anchors 的 iou 设置为 -1，不会影响 gt_max_overlaps
+        # gt_argmax_mask 为与某个 gt_bboxes 的 iou 等于该 gt_bboxes 最大 iou 的 anchors
+        # （与原先 tf.where 的结果一致，包括多个最大值的情况）
+        max_overlaps, argmax_overlaps, gt_max_overlaps, _, gt_argmax_mask = pairwise_iou_max(
+            anchors, gt_bboxes, chunk_size=iou_chunk_size, valid_mask1=inside_mask, with_max_mask=True)
 
         # 设置labels
+        labels = -tf.ones_like(argmax_overlaps)
         labels = tf.where(max_overlaps < self._neg_iou_threshold, tf.zeros_like(labels), labels)
-        labels = tf.scatter_update(tf.Variable(labels), gt_argmax_overlaps, 1)
+        labels = tf.where(gt_argmax_mask, tf.ones_like(labels), labels)
         labels = tf.where(max_overlaps >= self._pos_iou_threshold, tf.ones_like(labels), labels)
+        if inside_mask is not None:
+            labels = tf.where(inside_mask, labels, -tf.ones_like(labels))
+        return labels, argmax_overlaps
 
-        # 筛选正例反例
-        fg_inds = tf.where(tf.equal(labels, 1))[:, 0]
-        if tf.size(fg_inds) > self._max_pos_samples:
-            fg_inds = tf.random_shuffle(fg_inds)
-            disable_inds = fg_inds[self._max_pos_samples:]
-            fg_inds = fg_inds[:self._max_pos_samples]
-            labels = tf.scatter_update(tf.Variable(labels), disable_inds, -1)
-        num_bg = self._total_num_samples - tf.reduce_sum(tf.to_int32(tf.equal(labels, 1)))
-        bg_inds = tf.where(tf.equal(labels, 0))[:, 0]
-        if tf.size(bg_inds) > num_bg:
-            bg_inds = tf.random_shuffle(bg_inds)
-            disable_inds = bg_inds[num_bg:]
-            bg_inds = bg_inds[:num_bg]
-            labels = tf.scatter_update(tf.Variable(labels), disable_inds, -1)
-        tf.logging.debug('anchor target generate %d fgs and %d bgs.' % (tf.size(fg_inds), tf.size(bg_inds)))
+    def _sample_and_encode(self, labels, argmax_overlaps, anchors, gt_bboxes, anchors_geometry=None):
+        """
+        `call` 的第5步，以及计算 bboxes targets、inside/outside weights
+        :return:    labels, bboxes_targets, bbox_inside_weights, bbox_outside_weights
+        """
+        # 筛选正例反例，通过固定数量的随机采样实现，不需要 tf.Variable 以及 tf.random_shuffle
+        fg_mask = _random_sample_mask(tf.equal(labels, 1), self._max_pos_samples)
+        num_bg = self._total_num_samples - tf.reduce_sum(tf.to_int32(fg_mask))
+        bg_mask = _random_sample_mask(tf.equal(labels, 0), num_bg)
+        labels = tf.where(fg_mask, tf.ones_like(labels),
+                          tf.where(bg_mask, tf.zeros_like(labels), -tf.ones_like(labels)))
 
         # 计算 bboxes targets，作为 rpn reg loss 的 ground truth
         bboxes_targets = encode_bbox_with_mean_and_std(anchors, tf.gather(gt_bboxes, argmax_overlaps),
                                                        target_means=self._target_means,
-                                                       target_stds=self._target_stds)
+                                                       target_stds=self._target_stds,
+                                                       src_geometry=anchors_geometry)
 
         # 只有正例才有 reg loss
-        bbox_inside_weights = tf.zeros((anchors.shape[0], 4), dtype=tf.float32)
-        bbox_inside_weights = tf.scatter_update(tf.Variable(bbox_inside_weights),
-                                                tf.where(tf.equal(labels, 1))[:, 0], 1)
+        bbox_inside_weights = tf.tile(tf.expand_dims(tf.to_float(fg_mask), 1), [1, 4])
 
         # 实质就是对 reg loss / num_rpn_samples
-        bbox_outside_weights = tf.zeros((anchors.shape[0], 4), dtype=tf.float32)
-        num_examples = tf.reduce_sum(tf.to_float(labels >= 0))
-        bbox_outside_weights = tf.scatter_update(tf.Variable(bbox_outside_weights),
-                                                 tf.where(labels >= 0)[:, 0], 1.0 / num_examples)
+        valid_mask = tf.to_float(tf.logical_or(fg_mask, bg_mask))
+        num_examples = tf.reduce_sum(valid_mask)
+        bbox_outside_weights = tf.tile(tf.expand_dims(valid_mask / tf.maximum(num_examples, 1.), 1), [1, 4])
+        return labels, bboxes_targets, bbox_inside_weights, bbox_outside_weights
 
-        # 生成最终结果
-        return tf.stop_gradient(_unmap(labels, total_anchors, selected_anchor_idx, -1)), \
-               tf.stop_gradient(_unmap(bboxes_targets, total_anchors, selected_anchor_idx, 0)), \
-               tf.stop_gradient(_unmap(bbox_inside_weights, total_anchors, selected_anchor_idx, 0)), \
-               tf.stop_gradient(_unmap(bbox_outside_weights, total_anchors, selected_anchor_idx, 0))
+
+def _inside_mask(anchors, max_height, max_width):
+    """
+    与 `bboxes_range_filter` 条件相同，返回 bool mask 而不是 index
+    :param anchors:
+    :param max_height:
+    :param max_width:
+    :return:            [num_anchors, ]，bool
+    """
+    return tf.logical_and(
+        tf.logical_and((anchors[:, 0] >= 0), (anchors[:, 1] >= 0)),
+        tf.logical_and((anchors[:, 2] <= max_width - 1), (anchors[:, 3] <= max_height - 1)),
+    )
+
+
+def _random_sample_mask(mask, max_num_samples):
+    """
+    从 mask 为 True 的位置中随机选择至多 max_num_samples 个，其他位置都设置为 False
+    通过对随机数取 top_k 实现，输出 shape 固定，可以在 graph 模式下使用
+    :param mask:                [num, ]，bool
+    :param max_num_samples:     int 或 int32 scalar tensor
+    :return:                    [num, ]，bool
+    """
+    num_samples = tf.maximum(tf.minimum(max_num_samples, tf.reduce_sum(tf.to_int32(mask))), 0)
+    random_values = tf.where(mask, tf.random_uniform(tf.shape(mask)), -tf.ones(tf.shape(mask)))
+    _, selected_idx = tf.nn.top_k(random_values, num_samples, sorted=False)
+    selected = tf.scatter_nd(tf.expand_dims(selected_idx, 1), tf.ones_like(selected_idx), tf.shape(mask))
+    return tf.greater(selected, 0)
 
 
 def _unmap(data, count, inds, fill=0):
@@ -116,10 +207,7 @@ def _unmap(data, count, inds, fill=0):
     :param fill:
     :return:
     """
-    if len(data.shape) == 1:
-        ret = tf.ones([count], dtype=tf.float32) * fill
-        ret = tf.scatter_update(tf.Variable(ret), inds, tf.to_float(data))
-    else:
-        ret = tf.ones([count, ] + data.get_shape().as_list()[1:], dtype=tf.float32) * fill
-        ret = tf.scatter_update(tf.Variable(ret), inds, tf.to_float(data))
-    return ret
+    data = tf.to_float(data)
+    shape = tf.concat([[count], tf.shape(data)[1:]], axis=0)
+    ret = tf.scatter_nd(tf.expand_dims(tf.to_int32(inds), 1), data - fill, shape) + fill
+    return tf.reshape(ret, [count] + data.get_shape().as_list()[1:])
@@ -7,6 +7,9 @@ from object_detection.model.roi_pooling import RoiPoolingCropAndResize
 from object_detection.model.losses import smooth_l1_loss, cls_loss
 from object_detection.utils.anchor_generator import generate_by_anchor_base_tf, generate_anchor_base
 from object_detection.model.prediction import post_ops_prediction
+from object_detection.utils.anchor_cache import AnchorCache
+from object_detection.utils.xla_utils import jit_scope
+from object_detection.utils.image_utils import normalize_image
 
 __all__ = ['BaseFasterRcnn']
 layers = tf.keras.layers
@@ -59,11 +62,24 @@ class BaseFasterRcnn(tf.keras.Model):
                  prediction_max_objects_per_class,
                  prediction_nms_iou_threshold,
                  prediction_score_threshold,
+
+                 # anchor cache 参数
+                 anchor_cache_size=512,
+
+                 # xla 参数
+                 use_xla_jit=False,
+
+                 # 输入图片参数
+                 preprocessing_type='caffe',
+                 caffe_pixel_means=(103.939, 116.779, 123.68),
                  ):
         super().__init__()
         # 保存后续使用到的参数
         self.num_classes = num_classes
         self.weight_decay = weight_decay
+        self._use_xla_jit = use_xla_jit
+        self._preprocessing_type = preprocessing_type
+        self._caffe_pixel_means = caffe_pixel_means
 
         self._ratios = ratios
         self._scales = scales
@@ -82,6 +98,8 @@ class BaseFasterRcnn(tf.keras.Model):
 
         self._anchor_generator = generate_by_anchor_base_tf
         self._anchor_base = tf.to_float(generate_anchor_base(extractor_stride, ratios, scales))
+        self._anchor_cache = AnchorCache(max_size=anchor_cache_size)
+        self._anchor_cache_key = (extractor_stride, tuple(ratios), tuple(scales))
 
         # 创建Faster R-CNN的核心组件
         self._rpn_head = RpnHead(num_anchors=self._num_anchors, weight_decay=weight_decay)
@@ -94,6 +112,7 @@ class BaseFasterRcnn(tf.keras.Model):
             nms_iou_threshold=rpn_proposal_nms_iou_threshold,
             target_means=rpn_proposal_means,
             target_stds=rpn_proposal_stds,
+            use_static_shape=use_xla_jit,
         )
         self._anchor_target = AnchorTarget(
             pos_iou_threshold=rpn_training_pos_iou_threshold,
@@ -102,6 +121,7 @@ class BaseFasterRcnn(tf.keras.Model):
             max_pos_samples=rpn_training_max_pos_samples,
             target_means=rpn_proposal_means,
             target_stds=rpn_proposal_stds,
+            use_static_shape=use_xla_jit,
         )
         self._roi_pooling = RoiPoolingCropAndResize(pool_size=roi_pool_size,
                                                     max_pooling_flag=roi_pooling_max_pooling_flag)
@@ -123,8 +143,26 @@ class BaseFasterRcnn(tf.keras.Model):
     def _get_extractor(self):
         raise NotImplementedError
 
+    def __call__(self, *args, **kwargs):
+        # 设置了 use_xla_jit 时，在构建 graph（如 defun）的过程中通过 XLA 编译
+        with jit_scope(self._use_xla_jit):
+            return super().__call__(*args, **kwargs)
+
+    def _extract_features(self, image, training):
+        # 输入为 uint8 图片时（数据集中设置了 uint8_image），在 extractor 之前进行归一化
+        if image.dtype == tf.uint8:
+            image = normalize_image(image, self._preprocessing_type, self._caffe_pixel_means)
+        return self._extractor(image, training=training)
+
     def call(self, inputs, training=None, mask=None):
-        if training:
+        if training and len(inputs) == 5:
+            return self._call_padded_batch(inputs, training)
+        anchor_targets = None
+        if training and len(inputs) == 7:
+            # 数据集中已经计算了 anchor target（参考 `get_anchor_target`）
+            image, gt_bboxes, gt_labels = inputs[:3]
+            anchor_targets = inputs[3:]
+        elif training:
             image, gt_bboxes, gt_labels = inputs
         else:
             image = inputs
@@ -132,14 +170,12 @@ class BaseFasterRcnn(tf.keras.Model):
         image_shape = image.get_shape().as_list()[1:3]
         tf.logging.debug('image shape is {}'.format(image_shape))
 
-        shared_features = self._extractor(image, training=training)
+        shared_features = self._extract_features(image, training=training)
         shared_features_shape = shared_features.get_shape().as_list()[1:3]
         tf.logging.debug('shared_features shape is {}'.format(shared_features_shape))
 
-        anchors = self._anchor_generator(self._anchor_base, self._extractor_stride,
-                                         tf.to_int32(tf.ceil(image_shape[0] / self._extractor_stride)),
-                                         tf.to_int32(tf.ceil(image_shape[1] / self._extractor_stride))
-                                         )
+        anchors_entry = self._get_anchors(image_shape)
+        anchors = anchors_entry['anchors']
 
         tf.logging.debug('anchor_generator generate {} anchors'.format(anchors.shape[0]))
 
@@ -150,25 +186,29 @@ class BaseFasterRcnn(tf.keras.Model):
         scores = tf.transpose(tf.reshape(tf.nn.softmax(scores), [-1, self._num_anchors, 2]), [0, 2, 1])
         scores = tf.reshape(scores, [-1, 2 * self._num_anchors])
         scores = tf.reshape(scores[..., self._num_anchors:], [-1])
-        rois = self._rpn_proposal((rpn_bbox_txtytwth, anchors, scores, image_shape),
-                                  training=training)
+        rois, rois_valid_mask = self._get_rois(rpn_bbox_txtytwth, scores, anchors_entry, image_shape, training,
+                                               with_valid_mask=True)
 
         if training:
             # rpn loss
-            rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = self._anchor_target((gt_bboxes,
-                                                                                                 image_shape,
-                                                                                                 anchors),
-                                                                                                training)
+            if anchor_targets is not None:
+                rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = anchor_targets
+            else:
+                rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = self._anchor_target((gt_bboxes,
+                                                                                                     image_shape,
+                                                                                                     anchors,
+                                                                                                     anchors_entry),
+                                                                                                    training)
             rpn_cls_loss, rpn_reg_loss = self._get_rpn_loss(rpn_score, rpn_bbox_txtytwth,
                                                             rpn_labels, rpn_bbox_targets,
                                                             rpn_in_weights, rpn_out_weights)
 
             # roi loss
-            final_rois, roi_labels, roi_bbox_target, roi_in_weights, roi_out_weights = self._proposal_target((rois,
-                                                                                                              gt_bboxes,
-                                                                                                              gt_labels,
-                                                                                                              ),
-                                                                                                             training)
+            proposal_target_inputs = (rois, gt_bboxes, gt_labels)
+            if rois_valid_mask is not None:
+                proposal_target_inputs += (rois_valid_mask,)
+            final_rois, roi_labels, roi_bbox_target, roi_in_weights, roi_out_weights = self._proposal_target(
+                proposal_target_inputs, training)
             # 训练时，只计算 proposal target 的 roi_features，一般只有128个
             roi_features = self._roi_pooling((shared_features, final_rois, self._extractor_stride),
                                              training=training)
@@ -194,17 +234,194 @@ class BaseFasterRcnn(tf.keras.Model):
                                                              nms_iou_threshold=self._prediction_nms_iou_threshold,
                                                              score_threshold=self._prediction_score_threshold,
                                                              extractor_stride=self._extractor_stride,
+                                                             rois_valid_mask=rois_valid_mask,
+                                                             use_static_shape=self._use_xla_jit,
                                                              )
             return p_rois, p_labels, p_scores
 
+    def _get_anchors(self, image_shape, feature_height=None, feature_width=None):
+        """
+        通过 anchor cache 获取 anchors 以及相关几何信息
+        :param image_shape:
+        :param feature_height:      默认为 ceil(image_height / extractor_stride)
+        :param feature_width:       默认为 ceil(image_width / extractor_stride)
+        :return:                    `AnchorCache` 的缓存对象
+        """
+        if feature_height is None:
+            feature_height = tf.to_int32(tf.ceil(image_shape[0] / self._extractor_stride))
+        if feature_width is None:
+            feature_width = tf.to_int32(tf.ceil(image_shape[1] / self._extractor_stride))
+        return self._anchor_cache.get(image_shape, self._anchor_cache_key,
+                                      lambda: self._anchor_generator(self._anchor_base, self._extractor_stride,
+                                                                     feature_height, feature_width))
+
+    @property
+    def anchor_cache_stats(self):
+        return self._anchor_cache.get_stats()
+
+    def get_anchor_target(self, gt_bboxes, image_shape, anchor_target_cache=None):
+        """
+        计算 rpn 训练数据，只依赖 gt_bboxes、图片尺寸以及 anchors，不依赖网络输出，
+        所以可以作为 `tf.data` 中的并行 map 操作（参考 `get_anchor_target_map_func`），结果作为模型的输入
+        :param gt_bboxes:       [num_bboxes, 4]，xmin, ymin, xmax, ymax，单位为像素
+        :param image_shape:     [height, width]，python 数值或 float scalar tensor
+        :param anchor_target_cache: `AnchorTargetCache`，不为 None 时优先使用提前计算的结果（不计算 iou），
+                                    缓存中不存在时（如使用了其他数据增强）在线计算
+        :return:                rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights
+        """
+        anchors_entry = self._get_anchors(image_shape)
+        anchor_target_inputs = (gt_bboxes, image_shape, anchors_entry['anchors'], anchors_entry)
+        if anchor_target_cache is None:
+            # 直接调用 call，不经过 keras 的 __call__，可以在 dataset 的 map 函数中使用
+            return self._anchor_target.call(anchor_target_inputs, training=True)
+
+        found, labels, argmax_overlaps = anchor_target_cache.lookup(gt_bboxes, image_shape,
+                                                                    tf.shape(anchors_entry['anchors'])[0])
+        return tf.cond(found,
+                       lambda: self._anchor_target.call_with_overlap_labels((gt_bboxes, anchors_entry['anchors'],
+                                                                             anchors_entry['geometry'],
+                                                                             labels, argmax_overlaps)),
+                       lambda: self._anchor_target.call(anchor_target_inputs, training=True))
+
+    def get_anchor_overlap_labels(self, gt_bboxes, image_shape):
+        """
+        anchor target 中随机采样之前的部分，结果只依赖 gt_bboxes 以及图片尺寸，可以提前计算并保存到磁盘
+        （参考 `generate_anchor_target_cache.py`）
+        :param gt_bboxes:       [num_bboxes, 4]，xmin, ymin, xmax, ymax，单位为像素
+        :param image_shape:     [height, width]，python 数值或 float scalar tensor
+        :return:                labels, argmax_overlaps，参考 `AnchorTarget.get_overlap_labels`
+        """
+        anchors_entry = self._get_anchors(image_shape)
+        return self._anchor_target.get_overlap_labels((gt_bboxes, image_shape, anchors_entry['anchors']))
+
+    def _get_rois(self, rpn_bbox_txtytwth, scores, anchors_entry, image_shape, training, with_valid_mask=False):
+        """
+        获取 region proposal 结果
+        设置了 use_xla_jit 时 region proposal 结果填充到固定数量
+        :param with_valid_mask:     为 True 时返回 rois 以及 valid mask（没有设置 use_xla_jit 时为 None），
+                                    为 False 时只返回 rois，且会去除填充的 rois
+        """
+        inputs = (rpn_bbox_txtytwth, anchors_entry['anchors'], scores, image_shape, anchors_entry)
+        if self._use_xla_jit:
+            rois, rois_valid_mask = self._rpn_proposal(inputs, training=training)
+        else:
+            rois, rois_valid_mask = self._rpn_proposal(inputs, training=training), None
+        if with_valid_mask:
+            return rois, rois_valid_mask
+        if rois_valid_mask is not None:
+            rois = tf.boolean_mask(rois, rois_valid_mask)
+        return rois
+
+    def _get_rpn_foreground_scores(self, rpn_score):
+        # 这里这么复杂，主要是与tf-faster-rcnn对应……
+        scores = tf.reshape(tf.transpose(tf.reshape(rpn_score, [-1, 2, self._num_anchors]), [0, 2, 1]), [-1, 2])
+        scores = tf.transpose(tf.reshape(tf.nn.softmax(scores), [-1, self._num_anchors, 2]), [0, 2, 1])
+        scores = tf.reshape(scores, [-1, 2 * self._num_anchors])
+        return tf.reshape(scores[..., self._num_anchors:], [-1])
+
+    def _get_batch_rpn_results(self, shared_features, image_shapes, training):
+        """
+        对 padded batch 只运行一次 rpn head，再根据每张图片的真实尺寸截取各自的 rpn 结果，
+        并分别生成 anchors 以及 region proposals
+        :param shared_features:     [batch_size, feature_height, feature_width, channels]
+        :param image_shapes:        [batch_size, 2]，每张图片的真实尺寸
+        :param training:
+        :return:                    list，每个元素为 (image_shape, anchors_entry, rpn_score, rpn_bbox_txtytwth, rois)
+        """
+        batch_size, feature_height, feature_width = shared_features.get_shape().as_list()[:3]
+        rpn_score, rpn_bbox_txtytwth = self._rpn_head(shared_features, training=training)
+        rpn_score = tf.reshape(rpn_score, [batch_size, feature_height, feature_width, -1])
+        rpn_bbox_txtytwth = tf.reshape(rpn_bbox_txtytwth, [batch_size, feature_height, feature_width, -1])
+
+        results = []
+        for i in range(batch_size):
+            image_shape = [tf.to_float(image_shapes[i][0]), tf.to_float(image_shapes[i][1])]
+            cur_height = tf.minimum(tf.to_int32(tf.ceil(image_shape[0] / self._extractor_stride)), feature_height)
+            cur_width = tf.minimum(tf.to_int32(tf.ceil(image_shape[1] / self._extractor_stride)), feature_width)
+            cur_rpn_score = tf.reshape(rpn_score[i, :cur_height, :cur_width], [-1, 2 * self._num_anchors])
+            cur_rpn_bbox_txtytwth = tf.reshape(rpn_bbox_txtytwth[i, :cur_height, :cur_width], [-1, 4])
+
+            anchors_entry = self._get_anchors(image_shape, cur_height, cur_width)
+            rois = self._get_rois(cur_rpn_bbox_txtytwth, self._get_rpn_foreground_scores(cur_rpn_score),
+                                  anchors_entry, image_shape, training)
+            results.append((image_shape, anchors_entry, cur_rpn_score, cur_rpn_bbox_txtytwth, rois))
+        return results
+
+    def _call_padded_batch(self, inputs, training):
+        """
+        训练时输入 aspect ratio bucketing 后的 padded batch（参考 `bucket_by_aspect_ratio`）
+        1. backbone 以及 rpn head 对整个 batch 只运行一次；
+        2. 根据每张图片的真实尺寸以及真实 bboxes 数量，分别计算 region proposal、anchor target、proposal target；
+        3. 所有图片的 rois 合并后，通过 box_ind 进行 roi pooling，roi head 也只运行一次。
+        rpn 损失为每张图片损失的平均，roi 损失直接对所有 rois 计算（每张图片的 roi 数量相同，所以等价于平均）
+        :param inputs:      image [N, H, W, 3], gt_bboxes [N, M, 4], gt_labels [N, M],
+                            image_shapes [N, 2], num_bboxes [N, ]
+        :param training:
+        :return:
+        """
+        image, gt_bboxes, gt_labels, image_shapes, num_bboxes = inputs
+        shared_features = self._extract_features(image, training=training)
+        rpn_results = self._get_batch_rpn_results(shared_features, image_shapes, training)
+
+        rpn_cls_losses = []
+        rpn_reg_losses = []
+        all_rois = []
+        all_box_ind = []
+        all_roi_labels = []
+        all_roi_bbox_target = []
+        all_roi_in_weights = []
+        all_roi_out_weights = []
+        for i, (image_shape, anchors_entry, rpn_score, rpn_bbox_txtytwth, rois) in enumerate(rpn_results):
+            cur_gt_bboxes = gt_bboxes[i, :num_bboxes[i]]
+            cur_gt_labels = gt_labels[i, :num_bboxes[i]]
+
+            # rpn loss
+            rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = self._anchor_target((
+                cur_gt_bboxes, image_shape, anchors_entry['anchors'], anchors_entry), training)
+            rpn_cls_loss, rpn_reg_loss = self._get_rpn_loss(rpn_score, rpn_bbox_txtytwth,
+                                                            rpn_labels, rpn_bbox_targets,
+                                                            rpn_in_weights, rpn_out_weights)
+            rpn_cls_losses.append(rpn_cls_loss)
+            rpn_reg_losses.append(rpn_reg_loss)
+
+            # proposal target
+            final_rois, roi_labels, roi_bbox_target, roi_in_weights, roi_out_weights = self._proposal_target((
+                rois, cur_gt_bboxes, cur_gt_labels), training)
+            all_rois.append(final_rois)
+            all_box_ind.append(tf.fill([tf.shape(final_rois)[0]], i))
+            all_roi_labels.append(roi_labels)
+            all_roi_bbox_target.append(roi_bbox_target)
+            all_roi_in_weights.append(roi_in_weights)
+            all_roi_out_weights.append(roi_out_weights)
+
+        # roi loss
+        roi_features = self._roi_pooling((shared_features, tf.concat(all_rois, axis=0), self._extractor_stride,
+                                          tf.concat(all_box_ind, axis=0)),
+                                         training=training)
+        roi_score, roi_bboxes_txtytwth = self._roi_head(roi_features, training=training)
+        roi_cls_loss, roi_reg_loss = self._get_roi_loss(roi_score, roi_bboxes_txtytwth,
+                                                        tf.concat(all_roi_labels, axis=0),
+                                                        tf.concat(all_roi_bbox_target, axis=0),
+                                                        tf.concat(all_roi_in_weights, axis=0),
+                                                        tf.concat(all_roi_out_weights, axis=0))
+
+        batch_size = len(rpn_results)
+        return tf.add_n(rpn_cls_losses) / batch_size, tf.add_n(rpn_reg_losses) / batch_size, \
+               roi_cls_loss, roi_reg_loss
+
     def _get_rpn_loss(self, rpn_score, rpn_bbox_txtytwth,
                       anchor_target_labels, anchor_target_bboxes_txtytwth,
                       anchor_target_in_weights, anchor_target_out_weights):
         rpn_score = tf.reshape(tf.transpose(tf.reshape(rpn_score, [-1, 2, self._num_anchors]), (0, 2, 1)), [-1, 2])
-        rpn_selected = tf.where(anchor_target_labels >= 0)[:, 0]
-        rpn_score_selected = tf.gather(rpn_score, rpn_selected)
-        rpn_labels_selected = tf.gather(anchor_target_labels, rpn_selected)
-        rpn_cls_loss = cls_loss(logits=rpn_score_selected, labels=rpn_labels_selected)
+        if self._use_xla_jit:
+            # 通过 weights 忽略不参与训练的 anchors，shape 固定，结果与筛选后计算相同
+            rpn_weights = tf.to_float(anchor_target_labels >= 0)
+            rpn_cls_loss = cls_loss(logits=rpn_score, labels=tf.maximum(anchor_target_labels, 0), weight=rpn_weights)
+        else:
+            rpn_selected = tf.where(anchor_target_labels >= 0)[:, 0]
+            rpn_score_selected = tf.gather(rpn_score, rpn_selected)
+            rpn_labels_selected = tf.gather(anchor_target_labels, rpn_selected)
+            rpn_cls_loss = cls_loss(logits=rpn_score_selected, labels=rpn_labels_selected)
 
         rpn_reg_loss = smooth_l1_loss(rpn_bbox_txtytwth, anchor_target_bboxes_txtytwth,
                                       anchor_target_in_weights, anchor_target_out_weights, self._rpn_sigma,
@@ -227,10 +444,8 @@ class BaseFasterRcnn(tf.keras.Model):
         image_shape = image.get_shape().as_list()[1:3]
         tf.logging.debug('image shape is {}'.format(image_shape))
 
-        anchors = generate_by_anchor_base_tf(self._anchor_base, self._extractor_stride,
-                                             tf.to_int32(tf.ceil(image_shape[0] / self._extractor_stride)),
-                                             tf.to_int32(tf.ceil(image_shape[1] / self._extractor_stride))
-                                             )
+        anchors_entry = self._get_anchors(image_shape)
+        anchors = anchors_entry['anchors']
         tf.logging.debug('generate {} anchors'.format(anchors.shape[0]))
 
         rpn_training_idx, _, _, rpn_pos_num = self._anchor_target((anchors,
@@ -244,14 +459,12 @@ class BaseFasterRcnn(tf.keras.Model):
         image_shape = image.get_shape().as_list()[1:3]
         tf.logging.debug('image shape is {}'.format(image_shape))
 
-        shared_features = self._extractor(image, training=True)
+        shared_features = self._extract_features(image, training=True)
         shared_features_shape = shared_features.get_shape().as_list()[1:3]
         tf.logging.debug('shared_features shape is {}'.format(shared_features_shape))
 
-        anchors = generate_by_anchor_base_tf(self._anchor_base, self._extractor_stride,
-                                             tf.to_int32(tf.ceil(image_shape[0] / self._extractor_stride)),
-                                             tf.to_int32(tf.ceil(image_shape[1] / self._extractor_stride))
-                                             )
+        anchors_entry = self._get_anchors(image_shape)
+        anchors = anchors_entry['anchors']
         tf.logging.debug('anchor_generator generate {} anchors'.format(anchors.shape[0]))
 
         rpn_score, rpn_bbox_txtytwth = self._rpn_head(shared_features, training=True)
@@ -259,8 +472,7 @@ class BaseFasterRcnn(tf.keras.Model):
         scores = tf.transpose(tf.reshape(tf.nn.softmax(scores), [-1, self._num_anchors, 2]), [0, 2, 1])
         scores = tf.reshape(scores, [-1, 2 * self._num_anchors])
         scores = tf.reshape(scores[..., self._num_anchors:], [-1])
-        rois = self._rpn_proposal((rpn_bbox_txtytwth, anchors, scores, image_shape),
-                                  training=True)
+        rois = self._get_rois(rpn_bbox_txtytwth, scores, anchors_entry, image_shape, True)
         # final_rois, final_labels, final_bbox_targets, bbox_inside_weights, bbox_outside_weights
         return self._proposal_target((rois, gt_bboxes, gt_labels), training=True)
 
@@ -280,14 +492,12 @@ class BaseFasterRcnn(tf.keras.Model):
         image_shape = preprocessed_image.get_shape().as_list()[1:3]
         tf.logging.debug('image shape is {}'.format(image_shape))
 
-        shared_features = self._extractor(preprocessed_image, training=False)
+        shared_features = self._extract_features(preprocessed_image, training=False)
         shared_features_shape = shared_features.get_shape().as_list()[1:3]
         tf.logging.debug('shared_features shape is {}'.format(shared_features_shape))
 
-        anchors = self._anchor_generator(self._anchor_base, self._extractor_stride,
-                                         tf.to_int32(tf.ceil(image_shape[0] / self._extractor_stride)),
-                                         tf.to_int32(tf.ceil(image_shape[1] / self._extractor_stride))
-                                         )
+        anchors_entry = self._get_anchors(image_shape)
+        anchors = anchors_entry['anchors']
 
         tf.logging.debug('anchor_generator generate {} anchors'.format(anchors.shape[0]))
 
@@ -296,7 +506,7 @@ class BaseFasterRcnn(tf.keras.Model):
         scores = tf.transpose(tf.reshape(tf.nn.softmax(scores), [-1, self._num_anchors, 2]), [0, 2, 1])
         scores = tf.reshape(scores, [-1, 2 * self._num_anchors])
         scores = tf.reshape(scores[..., self._num_anchors:], [-1])
-        rois = self._rpn_proposal((rpn_bbox_txtytwth, anchors, scores, image_shape), training=False)
+        rois = self._get_rois(rpn_bbox_txtytwth, scores, anchors_entry, image_shape, False)
 
         roi_features = self._roi_pooling((shared_features, rois, self._extractor_stride), training=False)
         roi_score, roi_bboxes_txtytwth = self._roi_head(roi_features, training=False)
@@ -305,6 +515,33 @@ class BaseFasterRcnn(tf.keras.Model):
 
         return roi_score_softmax, roi_bboxes_txtytwth, rois
 
+    def im_detect_batch(self, preprocessed_images, image_shapes, img_scales):
+        """
+        batch 版本的 `im_detect`，backbone、rpn head 以及 roi head 对整个 padded batch 都只运行一次
+        :param preprocessed_images:     [batch_size, height, width, 3]
+        :param image_shapes:            [batch_size, 2]，每张图片 resize 后的真实尺寸
+        :param img_scales:              [batch_size, ]
+        :return:                        三个 list，分别为每张图片的 roi_score_softmax, roi_bboxes_txtytwth, rois
+        """
+        shared_features = self._extract_features(preprocessed_images, training=False)
+        rpn_results = self._get_batch_rpn_results(shared_features, image_shapes, False)
+
+        rois_list = [rpn_result[-1] for rpn_result in rpn_results]
+        num_rois = tf.stack([tf.shape(rois)[0] for rois in rois_list])
+        box_ind = tf.concat([tf.fill([tf.shape(rois)[0]], i) for i, rois in enumerate(rois_list)], axis=0)
+
+        roi_features = self._roi_pooling((shared_features, tf.concat(rois_list, axis=0), self._extractor_stride,
+                                          box_ind),
+                                         training=False)
+        roi_score, roi_bboxes_txtytwth = self._roi_head(roi_features, training=False)
+        roi_score_softmax = tf.nn.softmax(roi_score)
+
+        scores_list = tf.split(roi_score_softmax, num_rois, axis=0)
+        roi_bboxes_txtytwth_list = tf.split(roi_bboxes_txtytwth, num_rois, axis=0)
+        rois_list = [rois / tf.to_float(img_scales[i]) for i, rois in enumerate(rois_list)]
+
+        return scores_list, roi_bboxes_txtytwth_list, rois_list
+
 
 class RpnHead(tf.keras.Model):
     def __init__(self, num_anchors, weight_decay=0.0001):
@@ -236,6 +236,16 @@ class ResNetFasterRcnn(BaseFasterRcnn):
                  prediction_max_objects_per_class=50,
                  prediction_nms_iou_threshold=0.3,
                  prediction_score_threshold=0.3,
+
+                 # anchor cache 参数
+                 anchor_cache_size=512,
+
+                 # xla 参数
+                 use_xla_jit=False,
+
+                 # 输入图片参数
+                 preprocessing_type='caffe',
+                 caffe_pixel_means=(103.939, 116.779, 123.68),
                  ):
         if depth not in [50, 101, 152]:
             raise ValueError('unknown resnet layers number {}'.format(depth))
@@ -281,6 +291,13 @@ class ResNetFasterRcnn(BaseFasterRcnn):
                          prediction_max_objects_per_class=prediction_max_objects_per_class,
                          prediction_nms_iou_threshold=prediction_nms_iou_threshold,
                          prediction_score_threshold=prediction_score_threshold,
+
+                         anchor_cache_size=anchor_cache_size,
+
+                         use_xla_jit=use_xla_jit,
+
+                         preprocessing_type=preprocessing_type,
+                         caffe_pixel_means=caffe_pixel_means,
                          )
 
     def _get_roi_head(self):
@@ -7,6 +7,9 @@ from object_detection.model.roi_pooling import RoiPoolingCropAndResize, RoiPooli
 from object_detection.model.losses import smooth_l1_loss, cls_loss
 from object_detection.utils.anchor_generator import generate_by_anchor_base_tf, generate_anchor_base, make_anchors
 from object_detection.model.prediction import post_ops_prediction
+from object_detection.utils.anchor_cache import AnchorCache
+from object_detection.utils.xla_utils import jit_scope
+from object_detection.utils.image_utils import normalize_image
 
 layers = tf.keras.layers
 
@@ -39,6 +42,7 @@ class BaseFPN(tf.keras.Model):
                  rpn_proposal_num_pre_nms_test=6000,
                  rpn_proposal_num_post_nms_test=300,
                  rpn_proposal_nms_iou_threshold=0.7,
+                 rpn_proposal_pre_nms_per_level=False,
 
                  # anchor target 以及相关损失函数参数
                  rpn_sigma=3.0,
@@ -67,6 +71,16 @@ class BaseFPN(tf.keras.Model):
                  prediction_max_objects_per_class=50,
                  prediction_nms_iou_threshold=0.3,
                  prediction_score_threshold=0.,
+
+                 # anchor cache 参数
+                 anchor_cache_size=512,
+
+                 # xla 参数
+                 use_xla_jit=False,
+
+                 # 输入图片参数
+                 preprocessing_type='caffe',
+                 caffe_pixel_means=(103.939, 116.779, 123.68),
                  ):
         super().__init__()
         # 当(extractor & roi head)以及(rpn head, region proposal, anchor target, proposal target)同时用到某参数时
@@ -74,6 +88,9 @@ class BaseFPN(tf.keras.Model):
         self.roi_feature_size = roi_feature_size
         self.num_classes = num_classes
         self.weight_decay = weight_decay
+        self._use_xla_jit = use_xla_jit
+        self._preprocessing_type = preprocessing_type
+        self._caffe_pixel_means = caffe_pixel_means
 
         # fpn 特有参数
         self._level_name_list = level_name_list
@@ -87,6 +104,10 @@ class BaseFPN(tf.keras.Model):
         self._scales = scales
         self._num_anchors = len(ratios) * len(scales)
         self._anchor_generator = generate_by_anchor_base_tf
+        self._anchor_cache = AnchorCache(max_size=anchor_cache_size)
+        self._rpn_proposal_pre_nms_per_level = rpn_proposal_pre_nms_per_level
+        self._anchor_cache_key = (tuple(anchor_stride_list), tuple(base_anchor_size_list),
+                                  tuple(ratios), tuple(scales))
 
         # # 生成 base anchors
         # self._anchor_base_list = []
@@ -118,6 +139,7 @@ class BaseFPN(tf.keras.Model):
             nms_iou_threshold=rpn_proposal_nms_iou_threshold,
             target_means=rpn_proposal_means,
             target_stds=rpn_proposal_stds,
+            use_static_shape=use_xla_jit,
         )
         self._roi_pooling = RoiPoolingCropAndResize2(pool_size=roi_pool_size)
         self._roi_head = self._get_roi_head()
@@ -130,6 +152,7 @@ class BaseFPN(tf.keras.Model):
             max_pos_samples=rpn_training_max_pos_samples,
             target_means=rpn_proposal_means,
             target_stds=rpn_proposal_stds,
+            use_static_shape=use_xla_jit,
         )
         self._proposal_target = ProposalTarget(
             num_classes=num_classes,
@@ -146,21 +169,85 @@ class BaseFPN(tf.keras.Model):
     def _get_extractor(self):
         raise NotImplementedError
 
+    def __call__(self, *args, **kwargs):
+        # 设置了 use_xla_jit 时，在构建 graph（如 defun）的过程中通过 XLA 编译
+        with jit_scope(self._use_xla_jit):
+            return super().__call__(*args, **kwargs)
+
+    def _extract_features(self, image, training):
+        # 输入为 uint8 图片时（数据集中设置了 uint8_image），在 extractor 之前进行归一化
+        if image.dtype == tf.uint8:
+            image = normalize_image(image, self._preprocessing_type, self._caffe_pixel_means)
+        return self._extractor(image, training=training)
+
     def _get_neck(self):
         raise NotImplementedError
 
-    def _get_roi_features(self, rois_list, p_list, image_shape):
+    def _get_roi_features(self, rois_list, p_list, image_shape, box_ind_list=None):
         all_roi_features = []
-        for level_name, cur_rois, cur_p, cur_stride in zip(self._level_name_list[:-1],
-                                                           rois_list, p_list, self._anchor_stride_list):
+        if box_ind_list is None:
+            box_ind_list = [None] * len(rois_list)
+        for level_name, cur_rois, cur_p, cur_stride, cur_box_ind in zip(self._level_name_list[:-1],
+                                                                        rois_list, p_list, self._anchor_stride_list,
+                                                                        box_ind_list):
             if cur_rois.shape[0] == 0:
                 continue
-            cur_roi_features = self._roi_pooling((cur_p, cur_rois, image_shape))
+            if cur_box_ind is None:
+                cur_roi_features = self._roi_pooling((cur_p, cur_rois, image_shape))
+            else:
+                cur_roi_features = self._roi_pooling((cur_p, cur_rois, image_shape, cur_box_ind))
             all_roi_features.append(cur_roi_features)
             tf.logging.debug('{} generate {} roi features'.format(level_name, cur_roi_features.shape[0]))
         return tf.concat(all_roi_features, axis=0, name='all_roi_features')
 
     def _get_anchors(self, image_shape):
+        """
+        通过 anchor cache 获取所有 level 的 anchors 以及相关几何信息
+        :param image_shape:
+        :return:    `AnchorCache` 的缓存对象，其中 'anchors' 为所有 level 的 anchors
+        """
+        return self._anchor_cache.get(image_shape, self._anchor_cache_key,
+                                      lambda: self._generate_anchors(image_shape))
+
+    @property
+    def anchor_cache_stats(self):
+        return self._anchor_cache.get_stats()
+
+    def get_anchor_target(self, gt_bboxes, image_shape, anchor_target_cache=None):
+        """
+        计算 rpn 训练数据（所有 level 的 anchors），不依赖网络输出，可以在 `tf.data` 中并行计算，结果作为模型的输入
+        :param gt_bboxes:       [num_bboxes, 4]，xmin, ymin, xmax, ymax，单位为像素
+        :param image_shape:     [height, width]，python 数值或 float scalar tensor
+        :param anchor_target_cache: `AnchorTargetCache`，不为 None 时优先使用提前计算的结果（不计算 iou），
+                                    缓存中不存在时（如使用了其他数据增强）在线计算
+        :return:                rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights
+        """
+        anchors_entry = self._get_anchors(image_shape)
+        anchor_target_inputs = (gt_bboxes, image_shape, anchors_entry['anchors'], anchors_entry)
+        if anchor_target_cache is None:
+            # 直接调用 call，不经过 keras 的 __call__，可以在 dataset 的 map 函数中使用
+            return self._anchor_target.call(anchor_target_inputs, training=True)
+
+        found, labels, argmax_overlaps = anchor_target_cache.lookup(gt_bboxes, image_shape,
+                                                                    tf.shape(anchors_entry['anchors'])[0])
+        return tf.cond(found,
+                       lambda: self._anchor_target.call_with_overlap_labels((gt_bboxes, anchors_entry['anchors'],
+                                                                             anchors_entry['geometry'],
+                                                                             labels, argmax_overlaps)),
+                       lambda: self._anchor_target.call(anchor_target_inputs, training=True))
+
+    def get_anchor_overlap_labels(self, gt_bboxes, image_shape):
+        """
+        anchor target 中随机采样之前的部分，结果只依赖 gt_bboxes 以及图片尺寸，可以提前计算并保存到磁盘
+        （参考 `generate_anchor_target_cache.py`）
+        :param gt_bboxes:       [num_bboxes, 4]，xmin, ymin, xmax, ymax，单位为像素
+        :param image_shape:     [height, width]，python 数值或 float scalar tensor
+        :return:                labels, argmax_overlaps，参考 `AnchorTarget.get_overlap_labels`
+        """
+        anchors_entry = self._get_anchors(image_shape)
+        return self._anchor_target.get_overlap_labels((gt_bboxes, image_shape, anchors_entry['anchors']))
+
+    def _generate_anchors(self, image_shape):
         all_anchors = []
         for idx in range(len(self._level_name_list)):
             level_name = self._level_name_list[idx]
@@ -185,6 +272,37 @@ class BaseFPN(tf.keras.Model):
         tf.logging.debug('all_anchors shape is {}'.format(all_anchors.get_shape().as_list()))
         return all_anchors
 
+    def _get_level_sizes(self, image_shape):
+        """
+        每个 level 的 anchors 数量，与 `_generate_anchors` 中 featuremap 尺寸的计算方式保持一致
+        """
+        return [tf.to_int32(tf.ceil(image_shape[0] / extractor_stride)) *
+                tf.to_int32(tf.ceil(image_shape[1] / extractor_stride)) * self._num_anchors
+                for extractor_stride in self._anchor_stride_list]
+
+    def _get_rois(self, all_fpn_scores, all_fpn_bbox_pred, anchors_entry, image_shape, training,
+                  with_valid_mask=False):
+        """
+        获取 region proposal 结果
+        如果设置了 rpn_proposal_pre_nms_per_level，则 nms 前对每个 level 分别获取 num_pre_nms 个 anchors
+        设置了 use_xla_jit 时 region proposal 结果填充到固定数量
+        :param with_valid_mask:     为 True 时返回 rois 以及 valid mask（没有设置 use_xla_jit 时为 None），
+                                    为 False 时只返回 rois，且会去除填充的 rois
+        """
+        cur_scores = tf.nn.softmax(all_fpn_scores)[:, 1]
+        inputs = (all_fpn_bbox_pred, anchors_entry['anchors'], cur_scores, image_shape, anchors_entry)
+        if self._rpn_proposal_pre_nms_per_level:
+            inputs += (self._get_level_sizes(image_shape),)
+        if self._use_xla_jit:
+            rois, rois_valid_mask = self._rpn_proposal(inputs, training=training)
+        else:
+            rois, rois_valid_mask = self._rpn_proposal(inputs, training=training), None
+        if with_valid_mask:
+            return rois, rois_valid_mask
+        if rois_valid_mask is not None:
+            rois = tf.boolean_mask(rois, rois_valid_mask)
+        return rois
+
     def _get_fpn_head_results(self, p_list):
         all_fpn_scores = []
         all_fpn_bbox_pred = []
@@ -200,8 +318,16 @@ class BaseFPN(tf.keras.Model):
         return all_fpn_scores, all_fpn_bbox_pred
 
     def call(self, inputs, training=None, mask=None):
+        if training and len(inputs) == 5:
+            return self._call_padded_batch(inputs, training)
+
         # Step 1: get inputs and image shape
-        if training:
+        anchor_targets = None
+        if training and len(inputs) == 7:
+            # 数据集中已经计算了 anchor target（参考 `get_anchor_target`）
+            image, gt_bboxes, gt_labels = inputs[:3]
+            anchor_targets = inputs[3:]
+        elif training:
             image, gt_bboxes, gt_labels = inputs
         else:
             image = inputs
@@ -209,7 +335,7 @@ class BaseFPN(tf.keras.Model):
         tf.logging.debug('image shape is {}'.format(image_shape))
 
         # Step 2: get backbone results: p2, p3, p4, p5, p6
-        c_list = self._extractor(image, training=training)
+        c_list = self._extract_features(image, training=training)
         p_list = self._neck(c_list, training=training)
         tf.logging.debug('shared_features length is {}'.format(len(p_list)))
         for idx, p in enumerate(p_list):
@@ -217,29 +343,33 @@ class BaseFPN(tf.keras.Model):
 
         # Step 3: get rpn head results and anchors
         all_fpn_scores, all_fpn_bbox_pred = self._get_fpn_head_results(p_list)
-        all_anchors = self._get_anchors(image_shape)
+        anchors_entry = self._get_anchors(image_shape)
+        all_anchors = anchors_entry['anchors']
 
         # Step 4: get region proposal results
-        cur_scores = tf.nn.softmax(all_fpn_scores)[:, 1]
-        rois = self._rpn_proposal((all_fpn_bbox_pred, all_anchors, cur_scores, image_shape),
-                                  training=training)
+        rois, rois_valid_mask = self._get_rois(all_fpn_scores, all_fpn_bbox_pred, anchors_entry, image_shape,
+                                               training, with_valid_mask=True)
 
         if training:
             # Step 5 for training: anchor target and rpn loss
-            rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = self._anchor_target((gt_bboxes,
-                                                                                                 image_shape,
-                                                                                                 all_anchors),
-                                                                                                training)
+            if anchor_targets is not None:
+                rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = anchor_targets
+            else:
+                rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = self._anchor_target((gt_bboxes,
+                                                                                                     image_shape,
+                                                                                                     all_anchors,
+                                                                                                     anchors_entry),
+                                                                                                    training)
             rpn_cls_loss, rpn_reg_loss = self._get_rpn_loss(all_fpn_scores, all_fpn_bbox_pred,
                                                             rpn_labels, rpn_bbox_targets,
                                                             rpn_in_weights, rpn_out_weights)
 
             # Step 6 for training: proposal target
-            final_rois, roi_labels, roi_bbox_target, roi_in_weights, roi_out_weights = self._proposal_target((rois,
-                                                                                                              gt_bboxes,
-                                                                                                              gt_labels,
-                                                                                                              ),
-                                                                                                             training)
+            proposal_target_inputs = (rois, gt_bboxes, gt_labels)
+            if rois_valid_mask is not None:
+                proposal_target_inputs += (rois_valid_mask,)
+            final_rois, roi_labels, roi_bbox_target, roi_in_weights, roi_out_weights = self._proposal_target(
+                proposal_target_inputs, training)
             # Step 7 for training: get roi features and roi heads
             rois_list, selected_idx = self._assign_levels(final_rois)
             roi_features = self._get_roi_features(rois_list, p_list, image_shape)
@@ -256,9 +386,11 @@ class BaseFPN(tf.keras.Model):
             return rpn_cls_loss, rpn_reg_loss, roi_cls_loss, roi_reg_loss
         else:
             # Step 5 for predicting: get roi features and roi head results
-            rois_list, _ = self._assign_levels(rois)
+            rois_list, selected_idx = self._assign_levels(rois)
             roi_features = self._get_roi_features(rois_list, p_list, image_shape)
             roi_score, roi_bboxes_txtytwth = self._roi_head(roi_features, training=training)
+            if rois_valid_mask is not None:
+                rois_valid_mask = tf.gather(rois_valid_mask, selected_idx)
 
             # Step 6 for predicting: get predict results
             roi_score_softmax = tf.nn.softmax(roi_score)
@@ -272,16 +404,140 @@ class BaseFPN(tf.keras.Model):
                                                              nms_iou_threshold=self._prediction_nms_iou_threshold,
                                                              score_threshold=self._prediction_score_threshold,
                                                              extractor_stride=16,
+                                                             rois_valid_mask=rois_valid_mask,
+                                                             use_static_shape=self._use_xla_jit,
                                                              )
             return p_rois, p_labels, p_scores
 
+    def _get_batch_rpn_results(self, p_list, image_shapes, training):
+        """
+        对 padded batch 的每个 level 只运行一次 rpn head，再根据每张图片的真实尺寸截取各自的 rpn 结果，
+        并分别生成 anchors 以及 region proposals
+        :param p_list:          p2, p3, p4, p5, p6，shape 均为 [batch_size, height, width, channels]
+        :param image_shapes:    [batch_size, 2]，每张图片的真实尺寸
+        :param training:
+        :return:                list，每个元素为 (image_shape, anchors_entry, all_fpn_scores, all_fpn_bbox_pred, rois)
+        """
+        batch_size = p_list[0].get_shape().as_list()[0]
+        level_scores = []
+        level_bbox_pred = []
+        for p in p_list:
+            cur_score, cur_bboxes_pred = self._rpn_head(p)
+            cur_height, cur_width = p.get_shape().as_list()[1:3]
+            level_scores.append(tf.reshape(cur_score, [batch_size, cur_height, cur_width, -1]))
+            level_bbox_pred.append(tf.reshape(cur_bboxes_pred, [batch_size, cur_height, cur_width, -1]))
+
+        results = []
+        for i in range(batch_size):
+            image_shape = [tf.to_float(image_shapes[i][0]), tf.to_float(image_shapes[i][1])]
+            all_fpn_scores = []
+            all_fpn_bbox_pred = []
+            for cur_score, cur_bbox_pred, extractor_stride in zip(level_scores, level_bbox_pred,
+                                                                  self._anchor_stride_list):
+                # 与 `_get_anchors` 中 featuremap 尺寸的计算方式保持一致
+                cur_height = tf.to_int32(tf.ceil(image_shape[0] / extractor_stride))
+                cur_width = tf.to_int32(tf.ceil(image_shape[1] / extractor_stride))
+                all_fpn_scores.append(tf.reshape(cur_score[i, :cur_height, :cur_width], [-1, 2]))
+                all_fpn_bbox_pred.append(tf.reshape(cur_bbox_pred[i, :cur_height, :cur_width], [-1, 4]))
+            all_fpn_scores = tf.concat(all_fpn_scores, axis=0)
+            all_fpn_bbox_pred = tf.concat(all_fpn_bbox_pred, axis=0)
+
+            anchors_entry = self._get_anchors(image_shape)
+            rois = self._get_rois(all_fpn_scores, all_fpn_bbox_pred, anchors_entry, image_shape, training)
+            results.append((image_shape, anchors_entry, all_fpn_scores, all_fpn_bbox_pred, rois))
+        return results
+
+    def _get_level_box_ind(self, box_ind, rois_list, selected_idx):
+        """
+        `_assign_levels` 会改变 rois 的顺序，box_ind 也需要按照相同的顺序重新排列，并按 level 切分
+        :param box_ind:         [num_rois, ]
+        :param rois_list:       `_assign_levels` 的结果
+        :param selected_idx:    `_assign_levels` 的结果
+        :return:                list，与 rois_list 一一对应
+        """
+        level_box_ind = tf.gather(box_ind, selected_idx)
+        return tf.split(level_box_ind, tf.stack([tf.shape(cur_rois)[0] for cur_rois in rois_list]), axis=0)
+
+    def _call_padded_batch(self, inputs, training):
+        """
+        训练时输入 aspect ratio bucketing 后的 padded batch（参考 `bucket_by_aspect_ratio`）
+        1. backbone、neck 以及 rpn head 对整个 batch 只运行一次；
+        2. 根据每张图片的真实尺寸以及真实 bboxes 数量，分别计算 region proposal、anchor target、proposal target；
+        3. 所有图片的 rois 合并后分配 level，通过 box_ind 进行 roi pooling，roi head 也只运行一次。
+        rpn 损失为每张图片损失的平均，roi 损失直接对所有 rois 计算
+        :param inputs:      image [N, H, W, 3], gt_bboxes [N, M, 4], gt_labels [N, M],
+                            image_shapes [N, 2], num_bboxes [N, ]
+        :param training:
+        :return:
+        """
+        image, gt_bboxes, gt_labels, image_shapes, num_bboxes = inputs
+        padded_image_shape = image.get_shape().as_list()[1:3]
+        c_list = self._extract_features(image, training=training)
+        p_list = self._neck(c_list, training=training)
+        rpn_results = self._get_batch_rpn_results(p_list, image_shapes, training)
+
+        rpn_cls_losses = []
+        rpn_reg_losses = []
+        all_rois = []
+        all_box_ind = []
+        all_roi_labels = []
+        all_roi_bbox_target = []
+        all_roi_in_weights = []
+        all_roi_out_weights = []
+        for i, (image_shape, anchors_entry, all_fpn_scores, all_fpn_bbox_pred, rois) in enumerate(rpn_results):
+            cur_gt_bboxes = gt_bboxes[i, :num_bboxes[i]]
+            cur_gt_labels = gt_labels[i, :num_bboxes[i]]
+
+            # rpn loss
+            rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = self._anchor_target((
+                cur_gt_bboxes, image_shape, anchors_entry['anchors'], anchors_entry), training)
+            rpn_cls_loss, rpn_reg_loss = self._get_rpn_loss(all_fpn_scores, all_fpn_bbox_pred,
+                                                            rpn_labels, rpn_bbox_targets,
+                                                            rpn_in_weights, rpn_out_weights)
+            rpn_cls_losses.append(rpn_cls_loss)
+            rpn_reg_losses.append(rpn_reg_loss)
+
+            # proposal target
+            final_rois, roi_labels, roi_bbox_target, roi_in_weights, roi_out_weights = self._proposal_target((
+                rois, cur_gt_bboxes, cur_gt_labels), training)
+            all_rois.append(final_rois)
+            all_box_ind.append(tf.fill([tf.shape(final_rois)[0]], i))
+            all_roi_labels.append(roi_labels)
+            all_roi_bbox_target.append(roi_bbox_target)
+            all_roi_in_weights.append(roi_in_weights)
+            all_roi_out_weights.append(roi_out_weights)
+
+        # roi features and roi head
+        rois_list, selected_idx = self._assign_levels(tf.concat(all_rois, axis=0))
+        box_ind_list = self._get_level_box_ind(tf.concat(all_box_ind, axis=0), rois_list, selected_idx)
+        roi_features = self._get_roi_features(rois_list, p_list, padded_image_shape, box_ind_list)
+        roi_score, roi_bboxes_txtytwth = self._roi_head(roi_features, training=training)
+
+        # roi loss
+        roi_labels = tf.gather(tf.concat(all_roi_labels, axis=0), selected_idx)
+        roi_bbox_target = tf.gather(tf.concat(all_roi_bbox_target, axis=0), selected_idx)
+        roi_in_weights = tf.gather(tf.concat(all_roi_in_weights, axis=0), selected_idx)
+        roi_out_weights = tf.gather(tf.concat(all_roi_out_weights, axis=0), selected_idx)
+        roi_cls_loss, roi_reg_loss = self._get_roi_loss(roi_score, roi_bboxes_txtytwth,
+                                                        roi_labels, roi_bbox_target,
+                                                        roi_in_weights, roi_out_weights)
+
+        batch_size = len(rpn_results)
+        return tf.add_n(rpn_cls_losses) / batch_size, tf.add_n(rpn_reg_losses) / batch_size, \
+               roi_cls_loss, roi_reg_loss
+
     def _get_rpn_loss(self, rpn_score, rpn_bbox_txtytwth,
                       anchor_target_labels, anchor_target_bboxes_txtytwth,
                       anchor_target_in_weights, anchor_target_out_weights):
-        rpn_selected = tf.where(anchor_target_labels >= 0)[:, 0]
-        rpn_score_selected = tf.gather(rpn_score, rpn_selected)
-        rpn_labels_selected = tf.gather(anchor_target_labels, rpn_selected)
-        rpn_cls_loss = cls_loss(logits=rpn_score_selected, labels=rpn_labels_selected)
+        if self._use_xla_jit:
+            # 通过 weights 忽略不参与训练的 anchors，shape 固定，结果与筛选后计算相同
+            rpn_weights = tf.to_float(anchor_target_labels >= 0)
+            rpn_cls_loss = cls_loss(logits=rpn_score, labels=tf.maximum(anchor_target_labels, 0), weight=rpn_weights)
+        else:
+            rpn_selected = tf.where(anchor_target_labels >= 0)[:, 0]
+            rpn_score_selected = tf.gather(rpn_score, rpn_selected)
+            rpn_labels_selected = tf.gather(anchor_target_labels, rpn_selected)
+            rpn_cls_loss = cls_loss(logits=rpn_score_selected, labels=rpn_labels_selected)
 
         rpn_reg_loss = smooth_l1_loss(rpn_bbox_txtytwth, anchor_target_bboxes_txtytwth,
                                       anchor_target_in_weights, anchor_target_out_weights, self._rpn_sigma,
@@ -330,10 +586,12 @@ class BaseFPN(tf.keras.Model):
         :param gt_bboxes:
         :return:
         """
-        all_anchors = self._get_anchors(image_shape)
+        anchors_entry = self._get_anchors(image_shape)
+        all_anchors = anchors_entry['anchors']
         rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights = self._anchor_target((gt_bboxes,
                                                                                              image_shape,
-                                                                                             all_anchors),
+                                                                                             all_anchors,
+                                                                                             anchors_entry),
                                                                                             True)
         idx = tf.where(rpn_labels > 0)[:, 0]
         return tf.gather(all_anchors, idx)
@@ -348,12 +606,11 @@ class BaseFPN(tf.keras.Model):
         :return:
         """
         image_shape = preprocessed_img.get_shape().as_list()[1:3]
-        c_list = self._extractor(preprocessed_img, training=training)
+        c_list = self._extract_features(preprocessed_img, training=training)
         p_list = self._neck(c_list, training=training)
         all_fpn_scores, all_fpn_bbox_pred = self._get_fpn_head_results(p_list)
-        all_anchors = self._get_anchors(image_shape)
-        cur_scores = tf.nn.softmax(all_fpn_scores)[:, 1]
-        rois = self._rpn_proposal((all_fpn_bbox_pred, all_anchors, cur_scores, image_shape), training=training)
+        anchors_entry = self._get_anchors(image_shape)
+        rois = self._get_rois(all_fpn_scores, all_fpn_bbox_pred, anchors_entry, image_shape, training)
         final_rois, roi_labels, roi_bbox_target, roi_in_weights, roi_out_weights = self._proposal_target((rois,
                                                                                                           gt_bboxes,
                                                                                                           gt_labels,
@@ -370,12 +627,11 @@ class BaseFPN(tf.keras.Model):
         """
         # same as `call` function
         image_shape = preprocessed_img.get_shape().as_list()[1:3]
-        c_list = self._extractor(preprocessed_img, training=False)
+        c_list = self._extract_features(preprocessed_img, training=False)
         p_list = self._neck(c_list, training=False)
         all_fpn_scores, all_fpn_bbox_pred = self._get_fpn_head_results(p_list)
-        all_anchors = self._get_anchors(image_shape)
-        cur_scores = tf.nn.softmax(all_fpn_scores)[:, 1]
-        rois = self._rpn_proposal((all_fpn_bbox_pred, all_anchors, cur_scores, image_shape), training=False)
+        anchors_entry = self._get_anchors(image_shape)
+        rois = self._get_rois(all_fpn_scores, all_fpn_bbox_pred, anchors_entry, image_shape, False)
         rois_list, _ = self._assign_levels(rois)
         roi_features = self._get_roi_features(rois_list, p_list, image_shape)
         roi_score, roi_bboxes_txtytwth = self._roi_head(roi_features, training=False)
@@ -389,6 +645,41 @@ class BaseFPN(tf.keras.Model):
 
         return roi_score_softmax, roi_bboxes_txtytwth, new_rois / tf.to_float(img_scale)
 
+    def im_detect_batch(self, preprocessed_images, image_shapes, img_scales):
+        """
+        batch 版本的 `im_detect`，backbone、neck、rpn head 以及 roi head 对整个 padded batch 都只运行一次
+        :param preprocessed_images:     [batch_size, height, width, 3]
+        :param image_shapes:            [batch_size, 2]，每张图片 resize 后的真实尺寸
+        :param img_scales:              [batch_size, ]
+        :return:                        三个 list，分别为每张图片的 roi_score_softmax, roi_bboxes_txtytwth, rois
+        """
+        padded_image_shape = preprocessed_images.get_shape().as_list()[1:3]
+        c_list = self._extract_features(preprocessed_images, training=False)
+        p_list = self._neck(c_list, training=False)
+        rpn_results = self._get_batch_rpn_results(p_list, image_shapes, False)
+
+        all_rois = [rpn_result[-1] for rpn_result in rpn_results]
+        box_ind = tf.concat([tf.fill([tf.shape(rois)[0]], i) for i, rois in enumerate(all_rois)], axis=0)
+        rois_list, selected_idx = self._assign_levels(tf.concat(all_rois, axis=0))
+        box_ind_list = self._get_level_box_ind(box_ind, rois_list, selected_idx)
+        roi_features = self._get_roi_features(rois_list, p_list, padded_image_shape, box_ind_list)
+        roi_score, roi_bboxes_txtytwth = self._roi_head(roi_features, training=False)
+        roi_score_softmax = tf.nn.softmax(roi_score)
+
+        # roi head 的结果按照 level 排列，需要重新按照图片分组
+        level_rois = tf.concat(rois_list, axis=0)
+        level_box_ind = tf.concat(box_ind_list, axis=0)
+        scores_list = []
+        roi_bboxes_txtytwth_list = []
+        rois_list = []
+        for i in range(len(rpn_results)):
+            cur_idx = tf.reshape(tf.where(tf.equal(level_box_ind, i)), [-1])
+            scores_list.append(tf.gather(roi_score_softmax, cur_idx))
+            roi_bboxes_txtytwth_list.append(tf.gather(roi_bboxes_txtytwth, cur_idx))
+            rois_list.append(tf.gather(level_rois, cur_idx) / tf.to_float(img_scales[i]))
+
+        return scores_list, roi_bboxes_txtytwth_list, rois_list
+
 
 class RpnHead(tf.keras.Model):
     def __init__(self, num_anchors, weight_decay=0.0001):
@@ -439,6 +439,7 @@ class ResnetV1Fpn(BaseFPN):
                  rpn_proposal_num_pre_nms_test=6000,
                  rpn_proposal_num_post_nms_test=1000,
                  rpn_proposal_nms_iou_threshold=0.7,
+                 rpn_proposal_pre_nms_per_level=False,
 
                  # anchor target 以及相关损失函数参数
                  rpn_sigma=3.0,
@@ -467,6 +468,16 @@ class ResnetV1Fpn(BaseFPN):
                  prediction_max_objects_per_class=50,
                  prediction_nms_iou_threshold=0.3,
                  prediction_score_threshold=0.3,
+
+                 # anchor cache 参数
+                 anchor_cache_size=512,
+
+                 # xla 参数
+                 use_xla_jit=False,
+
+                 # 输入图片参数
+                 preprocessing_type='caffe',
+                 caffe_pixel_means=(103.939, 116.779, 123.68),
                  ):
         self._depth = depth
         self._roi_head_keep_dropout_rate = roi_head_keep_dropout_rate
@@ -497,6 +508,7 @@ class ResnetV1Fpn(BaseFPN):
             rpn_proposal_num_pre_nms_test=rpn_proposal_num_pre_nms_test,
             rpn_proposal_num_post_nms_test=rpn_proposal_num_post_nms_test,
             rpn_proposal_nms_iou_threshold=rpn_proposal_nms_iou_threshold,
+            rpn_proposal_pre_nms_per_level=rpn_proposal_pre_nms_per_level,
 
             # anchor target 以及相关损失函数参数
             rpn_sigma=rpn_sigma,
@@ -525,6 +537,13 @@ class ResnetV1Fpn(BaseFPN):
             prediction_max_objects_per_class=prediction_max_objects_per_class,
             prediction_nms_iou_threshold=prediction_nms_iou_threshold,
             prediction_score_threshold=prediction_score_threshold,
+
+            anchor_cache_size=anchor_cache_size,
+
+            use_xla_jit=use_xla_jit,
+
+            preprocessing_type=preprocessing_type,
+            caffe_pixel_means=caffe_pixel_means,
         )
 
     def _get_roi_head(self):
@@ -57,6 +57,7 @@ def _get_fpn_resnet_model(depth, config):
         rpn_proposal_num_pre_nms_test=config['rpn_proposal_test_pre_nms_sample_number'],
         rpn_proposal_num_post_nms_test=config['rpn_proposal_test_after_nms_sample_number'],
         rpn_proposal_nms_iou_threshold=config['rpn_proposal_nms_iou_threshold'],
+        rpn_proposal_pre_nms_per_level=config['rpn_proposal_pre_nms_per_level'],
 
         rpn_sigma=config['rpn_sigma'],
         rpn_training_pos_iou_threshold=config['rpn_pos_iou_threshold'],
@@ -80,6 +81,13 @@ def _get_fpn_resnet_model(depth, config):
         prediction_max_objects_per_class=config['max_objects_per_class_per_image'],
         prediction_nms_iou_threshold=config['prediction_nms_iou_threshold'],
         prediction_score_threshold=config['prediction_score_threshold'],
+
+        anchor_cache_size=config['anchor_cache_size'],
+
+        use_xla_jit=config['use_xla_jit'],
+
+        preprocessing_type=config['preprocessing_type'],
+        caffe_pixel_means=config['bgr_pixel_means'],
     )
 
 
@@ -126,6 +134,13 @@ def _get_faster_rcnn_resnet_model(depth, config):
         prediction_max_objects_per_class=config['max_objects_per_class_per_image'],
         prediction_nms_iou_threshold=config['prediction_nms_iou_threshold'],
         prediction_score_threshold=config['prediction_score_threshold'],
+
+        anchor_cache_size=config['anchor_cache_size'],
+
+        use_xla_jit=config['use_xla_jit'],
+
+        preprocessing_type=config['preprocessing_type'],
+        caffe_pixel_means=config['bgr_pixel_means'],
     )
 
 
@@ -173,4 +188,11 @@ def _get_faster_rcnn_vgg16_model(slim_ckpt_file_path, config):
         prediction_max_objects_per_class=config['max_objects_per_class_per_image'],
         prediction_nms_iou_threshold=config['prediction_nms_iou_threshold'],
         prediction_score_threshold=config['prediction_score_threshold'],
+
+        anchor_cache_size=config['anchor_cache_size'],
+
+        use_xla_jit=config['use_xla_jit'],
+
+        preprocessing_type=config['preprocessing_type'],
+        caffe_pixel_means=config['bgr_pixel_means'],
     )
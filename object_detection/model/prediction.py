@@ -2,6 +2,7 @@ import tensorflow as tf
 
 from object_detection.utils.bbox_transform import decode_bbox_with_mean_and_std
 from object_detection.utils.bbox_tf import bboxes_clip_filter as bboxes_clip_filter_tf
+from object_detection.utils.xla_utils import pad_indices
 
 
 __all__ = ['post_ops_prediction']
@@ -107,57 +108,88 @@ def post_ops_prediction(roi_scores_softmax, roi_txtytwth, rois, image_shape,
                         nms_iou_threshold=0.3,
                         score_threshold=0.05,
                         extractor_stride=16,
-                        num_classes=21,
+                        num_classes=None,
+                        min_edge=None,
+                        rois_valid_mask=None,
+                        use_static_shape=False,
                         ):
     """
+    roi head 之后的后处理，所有类别同时进行 decode 以及 nms，不需要逐类别循环，也没有 host 同步
+    1. 对所有 rois 的所有非背景类别同时 decode，根据 score_threshold 以及最小边长过滤；
+    2. 每个类别的 bboxes 加上不同的偏移量（class offset），不同类别的 bboxes 之间不会重叠，
+       所以只需要进行一次 nms，结果与逐类别 nms 一致；
+    3. nms 结果按照 score 降序排列，每个类别最多保留 max_num_per_class 个，每张图片最多保留 max_num_per_image 个。
 
     :param roi_scores_softmax:      [num_rois, num_classes]
-    :param roi_txtytwth:            [num_rois, num_classes, 4]
+    :param roi_txtytwth:            [num_rois, num_classes, 4] 或 [num_rois, num_classes * 4]
     :param rois:                    [num_rois, 4]
     :param image_shape:             [2,]
     :param target_means:            [4,]
     :param target_stds:             [4,]
     :param max_num_per_class:
-    :param max_num_per_image:
+    :param max_num_per_image:       小于等于0时不限制数量
     :param nms_iou_threshold:
     :param score_threshold:
     :param extractor_stride:
-    :param num_classes:
-    :return:
+    :param num_classes:             默认根据 roi_scores_softmax 的 shape 获取
+    :param min_edge:                最终结果的最小边长，默认为 extractor_stride
+    :param rois_valid_mask:         [num_rois, ]，填充 rois 的 valid mask（参考 `RegionProposal`），填充部分不会作为结果
+    :param use_static_shape:        结果填充到 max_num_per_image 个，填充部分的 label 为 0（即背景）、score 为 0
+    :return:                        bboxes [num_results, 4], labels [num_results, ], scores [num_results, ]
+                                    按照 score 降序排列，没有结果时为空 tensor
     """
     if target_stds is None:
         target_stds = [1, 1, 1, 1]
     if target_means is None:
         target_means = [0, 0, 0, 0]
-    res_scores = []
-    res_bboxes = []
-    res_cls = []
-    for i in range(1, num_classes):
-        inds = tf.where(roi_scores_softmax[:, i] > score_threshold)[:, 0]
-        cls_score = tf.gather(roi_scores_softmax[:, i], inds)
-        final_bboxes = decode_bbox_with_mean_and_std(tf.gather(rois, inds),
-                                                     tf.gather(roi_txtytwth[:, i, :], inds),
-                                                     target_means, target_stds)
-        final_bboxes, clip_selected_idx = bboxes_clip_filter_tf(final_bboxes, 0,
-                                                                image_shape[0], image_shape[1],
-                                                                extractor_stride)
-        cls_score = tf.gather(cls_score, clip_selected_idx)
-
-        keep = tf.image.non_max_suppression(final_bboxes, cls_score, max_num_per_class, iou_threshold=nms_iou_threshold)
-        if tf.size(keep).numpy() == 0:
-            continue
-        res_scores.append(tf.gather(cls_score, keep))
-        res_bboxes.append(tf.gather(final_bboxes, keep))
-        res_cls.append(tf.ones_like(keep, dtype=tf.int32) * i)
-
-    if len(res_scores) == 0:
-        return None, None, None
-
-    scores_after_nms = tf.concat(res_scores, axis=0)
-    bboxes_after_nms = tf.concat(res_bboxes, axis=0)
-    cls_after_nms = tf.concat(res_cls, axis=0)
-
-    _, final_idx = tf.nn.top_k(scores_after_nms, k=tf.minimum(max_num_per_image, tf.size(scores_after_nms)),
-                               sorted=False)
-    return tf.gather(bboxes_after_nms, final_idx), tf.gather(cls_after_nms, final_idx), tf.gather(scores_after_nms,
-                                                                                                  final_idx)
+    if num_classes is None:
+        num_classes = roi_scores_softmax.get_shape().as_list()[1]
+    if min_edge is None:
+        min_edge = extractor_stride
+    image_height = tf.to_float(image_shape[0])
+    image_width = tf.to_float(image_shape[1])
+
+    if rois_valid_mask is not None:
+        roi_scores_softmax = roi_scores_softmax * tf.expand_dims(tf.to_float(rois_valid_mask), 1)
+
+    # 1. 所有非背景类别同时 decode，shape 均为 [num_rois * (num_classes - 1), ...]
+    num_rois = tf.shape(rois)[0]
+    roi_txtytwth = tf.reshape(roi_txtytwth, [-1, num_classes, 4])[:, 1:, :]
+    all_scores = tf.reshape(roi_scores_softmax[:, 1:], [-1])
+    all_labels = tf.reshape(tf.tile(tf.expand_dims(tf.range(1, num_classes), 0), [num_rois, 1]), [-1])
+    all_rois = tf.reshape(tf.tile(tf.expand_dims(rois, 1), [1, num_classes - 1, 1]), [-1, 4])
+    all_txtytwth = tf.reshape(roi_txtytwth, [-1, 4])
+
+    inds = tf.where(all_scores > score_threshold)[:, 0]
+    all_scores = tf.gather(all_scores, inds)
+    all_labels = tf.gather(all_labels, inds)
+    all_bboxes = decode_bbox_with_mean_and_std(tf.gather(all_rois, inds), tf.gather(all_txtytwth, inds),
+                                               target_means, target_stds)
+    all_bboxes, inds = bboxes_clip_filter_tf(all_bboxes, 0, image_height, image_width, min_edge)
+    all_scores = tf.gather(all_scores, inds)
+    all_labels = tf.gather(all_labels, inds)
+
+    # 2. class offset nms，剪裁后所有 bboxes 都在 [0, max(height, width)) 范围内
+    # max_output_size 不限制数量：如果限制为 max_num_per_class * (num_classes - 1)，
+    # 某个类别超出 max_num_per_class 的结果会占用名额，导致其他类别的结果被截断
+    offsets = tf.to_float(all_labels) * (tf.maximum(image_height, image_width) + 1.)
+    keep = tf.image.non_max_suppression(all_bboxes + tf.expand_dims(offsets, 1), all_scores,
+                                        max_output_size=tf.size(all_scores),
+                                        iou_threshold=nms_iou_threshold)
+
+    # 3. 每个类别最多保留 max_num_per_class 个，通过 one hot cumsum 获取每个结果在对应类别中的排名
+    keep_labels = tf.gather(all_labels, keep)
+    class_ranks = tf.cumsum(tf.one_hot(keep_labels, num_classes, dtype=tf.int32), axis=0)
+    class_ranks = tf.reduce_sum(class_ranks * tf.one_hot(keep_labels, num_classes, dtype=tf.int32), axis=1)
+    keep = tf.boolean_mask(keep, class_ranks <= max_num_per_class)
+    if max_num_per_image > 0:
+        keep = keep[:max_num_per_image]
+
+    if use_static_shape:
+        # 末尾添加一个全0的结果，填充部分都取这个结果，没有任何结果时也可以使用
+        keep, _ = pad_indices(keep, max_num_per_image, pad_value=tf.size(all_scores))
+        all_bboxes = tf.concat([all_bboxes, tf.zeros([1, 4], dtype=all_bboxes.dtype)], axis=0)
+        all_labels = tf.concat([all_labels, tf.zeros([1], dtype=all_labels.dtype)], axis=0)
+        all_scores = tf.concat([all_scores, tf.zeros([1], dtype=all_scores.dtype)], axis=0)
+
+    return tf.gather(all_bboxes, keep), tf.gather(all_labels, keep), tf.gather(all_scores, keep)
@@ -1,7 +1,7 @@
 import tensorflow as tf
 from object_detection.utils.bbox_transform import decode_bbox_with_mean_and_std
 from object_detection.utils.bbox_tf import bboxes_clip_filter
-from tensorflow.python.platform import tf_logging
+from object_detection.utils.xla_utils import pad_indices
 
 layers = tf.keras.layers
 
@@ -17,10 +17,12 @@ class RegionProposal(tf.keras.Model):
                  num_post_nms_test=300,
                  nms_iou_threshold=0.7,
                  target_means=None,
-                 target_stds=None):
+                 target_stds=None,
+                 use_static_shape=False):
         super().__init__()
 
         self._num_anchors = num_anchors
+        self._use_static_shape = use_static_shape
         self._num_pre_nms_train = num_pre_nms_train
         self._num_post_nms_train = num_post_nms_train
         self._num_pre_nms_test = num_pre_nms_test
@@ -38,36 +40,51 @@ class RegionProposal(tf.keras.Model):
         """
         生成 rpn 的结果，即一组 bboxes，用于后续 roi pooling
         总体过程：
-        1. 使用anchors和rpn_pred修正，获取所有预测结果。
-        2. 对选中修正后的anchors进行处理（剪裁）。
-        3. 根据rpn_score获取num_pre_nms个anchors。
+        1. 根据rpn_score获取num_pre_nms个anchors（num_pre_nms <= 0 时不筛选）。
+        2. 使用anchors和rpn_pred修正，获取预测结果。
+        3. 对选中修正后的anchors进行处理（剪裁）。
         4. 进行nms。
         5. 根据rpn_score排序，获取num_post_nms个anchors作为proposal结果。
+        如果设置了 use_static_shape，则 proposal 结果填充到 num_post_nms 个，同时返回 valid mask。
         :param inputs:
         :param training:
         :param mask:
-        :return:
+        :return:            rois [num_rois, 4]，use_static_shape 时为 rois [num_post_nms, 4] 以及 valid mask [num_post_nms, ]
         """
         # bboxes_txtytwth shape: [num_anchors*feature_width*feature_height, 4]
         # anchors shape: [num_anchors*feature_width*feature_height, 4]
         # scores shape: [feature_width*feature_height*num_anchors,]
         # image_shape shape: [2, ]
-        bboxes_txtytwth, anchors, scores, image_shape = inputs
+        # 可选的第五个输入为 `AnchorCache` 的缓存对象（可以为None），包含提前计算好的 anchors 几何信息
+        # 可选的第六个输入为 FPN 中每个 level 的 anchors 数量，此时对每个 level 分别获取 num_pre_nms 个 anchors
+        bboxes_txtytwth, anchors, scores, image_shape = inputs[:4]
+        anchors_entry = inputs[4] if len(inputs) > 4 else None
+        level_sizes = inputs[5] if len(inputs) > 5 else None
+        anchors_geometry = anchors_entry['geometry'] if anchors_entry is not None else None
 
-        # 1. 使用anchors使用rpn_pred修正，获取所有预测结果。
-        # [num_anchors*feature_width*feature_height, 4]
+        # 1. 根据rpn_score获取num_pre_nms个anchors，之后只对这些anchors进行修正以及nms。
+        # 剪裁不会过滤anchors，所以先 top_k 再修正与原先先修正再 top_k 的结果一致
+        num_pre_nms = self._num_pre_nms_train if training else self._num_pre_nms_test
+        if num_pre_nms > 0:
+            if level_sizes is None:
+                selected_idx = _top_k_idx(scores, num_pre_nms)
+            else:
+                selected_idx = _per_level_top_k_idx(scores, level_sizes, num_pre_nms)
+            scores = tf.gather(scores, selected_idx)
+            bboxes_txtytwth = tf.gather(bboxes_txtytwth, selected_idx)
+            anchors = tf.gather(anchors, selected_idx)
+            if anchors_geometry is not None:
+                anchors_geometry = [tf.gather(cur, selected_idx) for cur in anchors_geometry]
+
+        # 2. 使用anchors使用rpn_pred修正，获取所有预测结果。
+        # [num_pre_nms, 4]
         decoded_bboxes = decode_bbox_with_mean_and_std(anchors, bboxes_txtytwth,
-                                                       self._target_means, self._target_stds)
+                                                       self._target_means, self._target_stds,
+                                                       anchors_geometry=anchors_geometry)
 
-        # 2. 对选中修正后的anchors进行处理
+        # 3. 对选中修正后的anchors进行处理
         decoded_bboxes, _ = bboxes_clip_filter(decoded_bboxes, 0, image_shape[0], image_shape[1])
 
-        # # 3. 根据rpn_score获取num_pre_nms个anchors。
-        # num_pre_nms = self._num_pre_nms_train if training else self._num_pre_nms_test
-        # cur_top_k = tf.minimum(num_pre_nms, tf.size(scores))
-        # scores, selected_idx = tf.nn.top_k(scores, k=cur_top_k, sorted=False)
-        # decoded_bboxes = tf.gather(decoded_bboxes, selected_idx)
-
         # 4. 进行nms。
         # 5. 根据rpn_score排序，获取num_post_nms个anchors作为proposal结果。
         num_post_nms = self._num_post_nms_train if training else self._num_post_nms_test
@@ -75,7 +92,31 @@ class RegionProposal(tf.keras.Model):
                                                     max_output_size=num_post_nms,
                                                     iou_threshold=self._nms_iou_threshold)
 
-        tf_logging.debug('rpn proposal net generate %d proposals' % tf.size(selected_idx))
+        if self._use_static_shape:
+            # 填充到固定数量，填充部分为第一个 proposal，通过 valid mask 区分
+            selected_idx, valid_mask = pad_indices(selected_idx, num_post_nms)
+            return tf.stop_gradient(tf.gather(decoded_bboxes, selected_idx)), valid_mask
 
         # 不参与训练，所以需要设置 tf.stop_gradient
         return tf.stop_gradient(tf.gather(decoded_bboxes, selected_idx))
+
+
+def _top_k_idx(scores, k):
+    _, selected_idx = tf.nn.top_k(scores, k=tf.minimum(k, tf.size(scores)), sorted=False)
+    return selected_idx
+
+
+def _per_level_top_k_idx(scores, level_sizes, k):
+    """
+    FPN 中对每个 level 分别获取 top k，之后合并在一起进行 nms
+    :param scores:          [num_anchors, ]，所有 level 的 scores 按顺序合并的结果
+    :param level_sizes:     每个 level 的 anchors 数量
+    :param k:               每个 level 最多获取的数量
+    :return:                在 scores 中的 index
+    """
+    all_selected_idx = []
+    offset = 0
+    for cur_scores in tf.split(scores, tf.stack(level_sizes), axis=0):
+        all_selected_idx.append(_top_k_idx(cur_scores, k) + offset)
+        offset += tf.size(cur_scores)
+    return tf.concat(all_selected_idx, axis=0)
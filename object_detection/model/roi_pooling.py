@@ -21,11 +21,15 @@ class RoiPoolingCropAndResize2(tf.keras.Model):
         :param mask:
         :return:
         """
-        # [1, height, width, channels]  [num_rois, 4]
-        shared_layers, rois, image_shape = inputs
+        # [batch_size, height, width, channels]  [num_rois, 4]
+        # 可选的第四个输入为每个 roi 所属图片的 batch index，默认全部为0
+        if len(inputs) == 4:
+            shared_layers, rois, image_shape, batch_ids = inputs
+        else:
+            shared_layers, rois, image_shape = inputs
+            batch_ids = tf.zeros([tf.shape(rois)[0]], dtype=tf.int32)
         h, w = tf.to_float(image_shape[0]), tf.to_float(image_shape[1])
 
-        batch_ids = tf.zeros([tf.shape(rois)[0]], dtype=tf.int32)
         roi_channels = tf.split(rois, 4, axis=1)
         bboxes = tf.concat([
             roi_channels[1] / tf.to_float(h),
@@ -59,11 +63,15 @@ class RoiPoolingCropAndResize(tf.keras.Model):
         :param mask:
         :return:
         """
-        # [1, height, width, channels]  [num_rois, 4]
-        shared_layers, rois, extractor_stride = inputs
+        # [batch_size, height, width, channels]  [num_rois, 4]
+        # 可选的第四个输入为每个 roi 所属图片的 batch index，默认全部为0
+        if len(inputs) == 4:
+            shared_layers, rois, extractor_stride, batch_ids = inputs
+        else:
+            shared_layers, rois, extractor_stride = inputs
+            batch_ids = tf.zeros([tf.shape(rois)[0]], dtype=tf.int32)
         rois = rois / extractor_stride
 
-        batch_ids = tf.zeros([tf.shape(rois)[0]], dtype=tf.int32)
         h, w = shared_layers.get_shape().as_list()[1:3]
         roi_channels = tf.split(rois, 4, axis=1)
         bboxes = tf.concat([
@@ -0,0 +1,87 @@
+import collections
+import tensorflow as tf
+
+from object_detection.utils.bbox_tf import bboxes_range_filter
+from object_detection.utils.bbox_transform import get_bbox_geometry
+
+__all__ = ['AnchorCache']
+
+
+class AnchorCache(object):
+    """
+    anchors 缓存
+    图片经过 min_size/max_size resize 后，整个数据集中不同的图片尺寸只有几百种，
+    所以 anchors 以及相关的几何信息不需要每个 step 都重新计算。
+
+    key 为 (image height, image width, *extra_key)，其中 extra_key 一般为 (stride, anchor base)，
+    缓存数量超过 max_size 后，按照 LRU 策略淘汰。
+
+    每个缓存对象是一个 dict，包括：
+    1) anchors: [num_anchors, 4]，所有 anchors，用于 region proposal
+    2) geometry: 所有 anchors 的 width, height, center_x, center_y，用于 `decode_bbox_with_mean_and_std`
+    3) inside_idx: `bboxes_range_filter` 的结果，即在图片范围内的 anchors 的 index，用于 anchor target
+    4) inside_anchors: 在图片范围内的 anchors
+    5) inside_geometry: 在图片范围内的 anchors 的几何信息，用于 `encode_bbox_with_mean_and_std`
+
+    只在 eager 模式下缓存，graph 模式（如 defun）下每次都直接计算，不改变计数。
+    """
+
+    def __init__(self, max_size=512):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, image_shape, extra_key, generate_anchors_fn):
+        """
+        获取 anchors 缓存，如果不存在则通过 generate_anchors_fn 生成
+        :param image_shape:             [height, width]，python 数值或 scalar tensor
+        :param extra_key:               tuple，除图片尺寸外的 key，要求可以 hash
+        :param generate_anchors_fn:     无参数的函数，返回 anchors，shape 为 [num_anchors, 4]
+        :return:                        dict，具体内容参考类注释
+        """
+        if self._max_size <= 0 or not tf.executing_eagerly():
+            return _build_entry(generate_anchors_fn(), image_shape)
+
+        key = (_to_int(image_shape[0]), _to_int(image_shape[1])) + tuple(extra_key)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        entry = _build_entry(generate_anchors_fn(), image_shape)
+        self._entries[key] = entry
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def _to_int(value):
+    if isinstance(value, tf.Tensor):
+        value = value.numpy()
+    return int(value)
+
+
+def _build_entry(anchors, image_shape):
+    anchors = tf.to_float(anchors)
+    inside_idx = bboxes_range_filter(anchors, image_shape[0], image_shape[1])
+    inside_anchors = tf.gather(anchors, inside_idx)
+    return {
+        'anchors': anchors,
+        'geometry': get_bbox_geometry(anchors),
+        'inside_idx': inside_idx,
+        'inside_anchors': inside_anchors,
+        'inside_geometry': get_bbox_geometry(inside_anchors),
+    }
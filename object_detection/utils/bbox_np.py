@@ -2,7 +2,7 @@
 import numpy as np
 
 
-__all__ = ['pairwise_iou', 'ioa', 'bboxes_clip_filter', 'bboxes_range_filter']
+__all__ = ['pairwise_iou', 'pairwise_iou_max', 'ioa', 'bboxes_clip_filter', 'bboxes_range_filter']
 
 
 def area(boxes):
@@ -55,6 +55,56 @@ def pairwise_iou(boxes1, boxes2):
     return intersect / union
 
 
+def pairwise_iou_max(boxes1, boxes2, chunk_size=16384, valid_mask1=None, with_max_mask=False):
+    """
+    计算 `pairwise_iou` 每一行、每一列的最大值以及 argmax，每次只计算 [chunk_size, M] 的 iou，不保存完整的 [N, M] 矩阵
+    多个最大值时 argmax 取 index 最小的，与 np.argmax 相同。
+    :param boxes1:          a numpy array with shape [N, 4]
+    :param boxes2:          a numpy array with shape [M, 4]
+    :param chunk_size:      每次计算的 boxes1 数量，None 表示不分块
+    :param valid_mask1:     [N, ] bool，为 False 的行 iou 都设置为 -1
+    :param with_max_mask:   是否返回 max_mask1
+    :return:                max1 [N, ], argmax1 [N, ], max2 [M, ], argmax2 [M, ]，
+                            with_max_mask 为 True 时还返回 max_mask1 [N, ] bool，即该行是否等于某一列的最大值
+    """
+    num1, num2 = len(boxes1), len(boxes2)
+    if chunk_size is None:
+        chunk_size = max(num1, 1)
+
+    def _get_chunk_iou(start):
+        iou = pairwise_iou(boxes1[start:start + chunk_size], boxes2)
+        if valid_mask1 is not None:
+            iou[~valid_mask1[start:start + chunk_size]] = -1
+        return iou
+
+    # 与 `pairwise_iou` 结果的类型相同，保证 max_mask1 中的比较与完整矩阵一致
+    dtype = np.result_type(boxes1, boxes2, np.float32)
+    max1 = np.zeros([num1], dtype=dtype)
+    argmax1 = np.zeros([num1], dtype=np.int64)
+    max2 = np.full([num2], -np.inf, dtype=dtype)
+    argmax2 = np.zeros([num2], dtype=np.int64)
+    for start in range(0, num1, chunk_size):
+        iou = _get_chunk_iou(start)
+        end = start + len(iou)
+        if num2 > 0:
+            max1[start:end] = iou.max(axis=1)
+            argmax1[start:end] = iou.argmax(axis=1)
+            chunk_max2 = iou.max(axis=0)
+            # 只有严格大于时才更新，多个最大值时保留 index 较小的结果
+            update = chunk_max2 > max2
+            max2[update] = chunk_max2[update]
+            argmax2[update] = iou.argmax(axis=0)[update] + start
+    if not with_max_mask:
+        return max1, argmax1, max2, argmax2
+
+    # 列方向的最大值确定后，才能判断每一行是否等于某一列的最大值
+    max_mask1 = np.zeros([num1], dtype=np.bool_)
+    for start in range(0, num1, chunk_size):
+        iou = _get_chunk_iou(start)
+        max_mask1[start:start + len(iou)] = (iou == max2).any(axis=1)
+    return max1, argmax1, max2, argmax2, max_mask1
+
+
 def ioa(boxes1, boxes2):
     """Computes pairwise intersection-over-area between box collections.
     Intersection-over-area (ioa) between two boxes box1 and box2 is defined as
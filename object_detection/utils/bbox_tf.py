@@ -1,7 +1,7 @@
 import tensorflow as tf
 
 
-__all__ = ['pairwise_iou', 'bboxes_clip_filter', 'bboxes_range_filter']
+__all__ = ['pairwise_iou', 'pairwise_iou_max', 'bboxes_clip_filter', 'bboxes_range_filter']
 
 
 def area(boxes):
@@ -56,6 +56,91 @@ def pairwise_iou(boxlist1, boxlist2):
         tf.zeros_like(intersections), tf.truediv(intersections, unions))
 
 
+def _iou_max_of_matrix(iou, with_max_mask):
+    max1 = tf.reduce_max(iou, axis=1)
+    argmax1 = tf.argmax(iou, axis=1, output_type=tf.int32)
+    max2 = tf.reduce_max(iou, axis=0)
+    argmax2 = tf.argmax(iou, axis=0, output_type=tf.int32)
+    if not with_max_mask:
+        return max1, argmax1, max2, argmax2
+    return max1, argmax1, max2, argmax2, tf.reduce_any(tf.equal(iou, max2), axis=1)
+
+
+def pairwise_iou_max(boxlist1, boxlist2, chunk_size=16384, valid_mask1=None, with_max_mask=False):
+    """
+    计算 `pairwise_iou` 每一行、每一列的最大值以及 argmax，不保存完整的 [N, M] iou 矩阵
+    boxlist1 按照 chunk_size 分块，每次只计算 [chunk_size, M] 的 iou，列方向的结果在分块之间逐步更新，
+    所以内存占用与 N 无关（FPN 的 anchors 数量可以达到 20w，COCO 图片的 gt 数量可以超过 100）。
+    N 不超过 chunk_size（静态 shape）时直接计算完整的 iou 矩阵，与之前的实现相同。
+    多个最大值时 argmax 取 index 最小的，与 tf.argmax 相同。
+    :param boxlist1:        Nx4 floatbox，如 anchors
+    :param boxlist2:        Mx4，如 gt_bboxes
+    :param chunk_size:      每次计算的 boxlist1 数量，None 表示不分块
+    :param valid_mask1:     [N, ] bool，为 False 的行 iou 都设置为 -1（如超出图片范围的 anchors）
+    :param with_max_mask:   是否返回 max_mask1
+    :return:                max1 [N, ], argmax1 [N, ] int32, max2 [M, ], argmax2 [M, ] int32，
+                            with_max_mask 为 True 时还返回 max_mask1 [N, ] bool，
+                            即该行是否等于某一列的最大值（`tf.reduce_any(tf.equal(iou, max2), axis=1)`）
+    """
+    boxlist1 = tf.to_float(boxlist1)
+    boxlist2 = tf.to_float(boxlist2)
+
+    def _get_iou(cur_boxlist1, cur_valid_mask1):
+        iou = pairwise_iou(cur_boxlist1, boxlist2)
+        if cur_valid_mask1 is not None:
+            iou = tf.where(cur_valid_mask1, iou, -tf.ones_like(iou))
+        return iou
+
+    def _get_chunk_iou(start):
+        return _get_iou(boxlist1[start:start + chunk_size],
+                        valid_mask1[start:start + chunk_size] if valid_mask1 is not None else None)
+
+    num1 = boxlist1.get_shape().as_list()[0]
+    if chunk_size is None or (num1 is not None and num1 <= chunk_size):
+        return _iou_max_of_matrix(_get_iou(boxlist1, valid_mask1), with_max_mask)
+
+    num1 = tf.shape(boxlist1)[0]
+    num2 = tf.shape(boxlist2)[0]
+    num_chunks = (num1 + chunk_size - 1) // chunk_size
+
+    # 第一次遍历：行方向的结果直接保存，列方向的结果逐块更新
+    def _max_body(i, max1_array, argmax1_array, max2, argmax2):
+        start = i * chunk_size
+        iou = _get_chunk_iou(start)
+        max1_array = max1_array.write(i, tf.reduce_max(iou, axis=1))
+        argmax1_array = argmax1_array.write(i, tf.argmax(iou, axis=1, output_type=tf.int32))
+        chunk_max2 = tf.reduce_max(iou, axis=0)
+        # 只有严格大于时才更新，多个最大值时保留 index 较小的结果
+        update = chunk_max2 > max2
+        max2 = tf.where(update, chunk_max2, max2)
+        argmax2 = tf.where(update, tf.argmax(iou, axis=0, output_type=tf.int32) + start, argmax2)
+        return i + 1, max1_array, argmax1_array, max2, argmax2
+
+    _, max1_array, argmax1_array, max2, argmax2 = tf.while_loop(
+        lambda i, *args: i < num_chunks, _max_body,
+        [tf.constant(0),
+         tf.TensorArray(tf.float32, size=num_chunks, infer_shape=False, element_shape=tf.TensorShape([None])),
+         tf.TensorArray(tf.int32, size=num_chunks, infer_shape=False, element_shape=tf.TensorShape([None])),
+         tf.fill([num2], float('-inf')),
+         tf.zeros([num2], dtype=tf.int32)])
+    max1 = max1_array.concat()
+    argmax1 = argmax1_array.concat()
+    if not with_max_mask:
+        return max1, argmax1, max2, argmax2
+
+    # 第二次遍历：列方向的最大值确定后，才能判断每一行是否等于某一列的最大值
+    def _mask_body(i, max_mask1_array):
+        start = i * chunk_size
+        iou = _get_chunk_iou(start)
+        return i + 1, max_mask1_array.write(i, tf.reduce_any(tf.equal(iou, max2), axis=1))
+
+    _, max_mask1_array = tf.while_loop(
+        lambda i, *args: i < num_chunks, _mask_body,
+        [tf.constant(0),
+         tf.TensorArray(tf.bool, size=num_chunks, infer_shape=False, element_shape=tf.TensorShape([None]))])
+    return max1, argmax1, max2, argmax2, max_mask1_array.concat()
+
+
 def bboxes_clip_filter(rpn_proposals, min_value, max_height, max_width, min_edge=None):
     """
     numpy 操作
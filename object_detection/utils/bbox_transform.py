@@ -1,17 +1,30 @@
 import tensorflow as tf
 
 
-def encode_bbox_with_mean_and_std(src_bbox, dst_bbox, target_means, target_stds):
+def get_bbox_geometry(bboxes):
+    """
+    计算 bboxes 的宽、高以及中心点，encode/decode 时会用到
+    anchors 的这些结果可以提前计算并缓存，参考 `AnchorCache`
+    :param bboxes:  [..., 4]，顺序为 xmin, ymin, xmax, ymax
+    :return:        width, height, center_x, center_y
+    """
+    bboxes = tf.cast(bboxes, tf.float32)
+    width = bboxes[..., 2] - bboxes[..., 0] + 1.0
+    height = bboxes[..., 3] - bboxes[..., 1] + 1.0
+    center_x = bboxes[..., 0] + 0.5 * width
+    center_y = bboxes[..., 1] + 0.5 * height
+    return width, height, center_x, center_y
+
+
+def encode_bbox_with_mean_and_std(src_bbox, dst_bbox, target_means, target_stds, src_geometry=None):
     target_means = tf.constant(target_means, dtype=tf.float32)
     target_stds = tf.constant(target_stds, dtype=tf.float32)
 
-    box = tf.cast(src_bbox, tf.float32)
     gt_box = tf.cast(dst_bbox, tf.float32)
 
-    width = box[..., 2] - box[..., 0] + 1.0
-    height = box[..., 3] - box[..., 1] + 1.0
-    center_x = box[..., 0] + 0.5 * width
-    center_y = box[..., 1] + 0.5 * height
+    if src_geometry is None:
+        src_geometry = get_bbox_geometry(src_bbox)
+    width, height, center_x, center_y = src_geometry
 
     gt_width = gt_box[..., 2] - gt_box[..., 0] + 1.0
     gt_height = gt_box[..., 3] - gt_box[..., 1] + 1.0
@@ -29,7 +42,7 @@ def encode_bbox_with_mean_and_std(src_bbox, dst_bbox, target_means, target_stds)
     return delta
 
 
-def decode_bbox_with_mean_and_std(anchors, bboxes_txtytwth, target_means, target_stds):
+def decode_bbox_with_mean_and_std(anchors, bboxes_txtytwth, target_means, target_stds, anchors_geometry=None):
     target_means = tf.constant(
         target_means, dtype=tf.float32)
     target_stds = tf.constant(
@@ -37,10 +50,9 @@ def decode_bbox_with_mean_and_std(anchors, bboxes_txtytwth, target_means, target
     delta = bboxes_txtytwth * target_stds + target_means
 
     # TODO fix whether to use +1 in the following two lines.
-    width = anchors[:, 2] - anchors[:, 0] + 1
-    height = anchors[:, 3] - anchors[:, 1] + 1
-    center_x = anchors[:, 0] + 0.5 * width
-    center_y = anchors[:, 1] + 0.5 * height
+    if anchors_geometry is None:
+        anchors_geometry = get_bbox_geometry(anchors)
+    width, height, center_x, center_y = anchors_geometry
 
     center_x += delta[:, 0] * width
     center_y += delta[:, 1] * height
@@ -0,0 +1,21 @@
+import tensorflow as tf
+
+__all__ = ['normalize_image']
+
+
+def normalize_image(image, preprocessing_type='caffe', caffe_pixel_means=None):
+    """
+    模型内部的图片归一化，输入为数据集输出的 uint8 RGB 图片（参考 `tf_dataset_utils` 中的 uint8_image 参数）
+    与 `tf_dataset_utils` 中的 caffe/tf 预处理结果相同，但不通过 tf.split/tf.concat 逐通道计算，
+    只有 cast、reverse、sub 等 elementwise 操作，可以与 extractor 的第一个卷积一起优化
+    :param image:               [batch_size, height, width, 3]，tf.uint8
+    :param preprocessing_type:  one of ['caffe', 'tf']
+    :param caffe_pixel_means:   bgr 像素平均值
+    :return:                    tf.float32，caffe 为 bgr 减去像素平均值，tf 为 rgb 且取值范围[-1, 1]
+    """
+    image = tf.to_float(image)
+    if preprocessing_type == 'caffe':
+        return tf.reverse(image, axis=[-1]) - tf.constant(caffe_pixel_means, dtype=tf.float32)
+    elif preprocessing_type == 'tf':
+        return image * (2.0 / 255.0) - 1.0
+    raise ValueError('unknown preprocessing type {}'.format(preprocessing_type))
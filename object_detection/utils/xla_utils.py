@@ -0,0 +1,41 @@
+import contextlib
+import tensorflow as tf
+
+__all__ = ['jit_scope', 'pad_indices']
+
+# XLA 不支持或者输出 shape 与数据相关的 op，这些 op 不进行编译，由 tensorflow 直接运行
+_XLA_EXCLUDED_OPS = {
+    'NonMaxSuppression', 'NonMaxSuppressionV2', 'NonMaxSuppressionV3',
+    'CropAndResize', 'Where', 'Unique', 'RandomShuffle',
+    'PyFunc', 'EagerPyFunc',
+}
+
+
+def jit_scope(use_xla_jit=True):
+    """
+    XLA JIT scope，在此 scope 中创建的 op（除了 `_XLA_EXCLUDED_OPS`）都会通过 XLA 编译
+    只在构建 graph 时（如 `tf.contrib.eager.defun`）有效，eager 模式下返回空的 context manager
+    :param use_xla_jit:
+    :return:
+    """
+    if not use_xla_jit or tf.executing_eagerly():
+        return contextlib.ExitStack()
+    return tf.contrib.compiler.jit.experimental_jit_scope(
+        compile_ops=lambda node_def: node_def.op not in _XLA_EXCLUDED_OPS)
+
+
+def pad_indices(indices, size, pad_value=0):
+    """
+    将长度不超过 size 的 indices 填充到固定长度 size，默认填充值为 0（即第一个元素的 index）
+    用于将 nms 等 op 的结果转换为固定 shape
+    :param indices:     [num_indices, ]，num_indices <= size
+    :param size:        int
+    :param pad_value:   int 或 int32 scalar tensor
+    :return:            padded_indices [size, ]，valid_mask [size, ]（bool，填充部分为 False）
+    """
+    indices = tf.to_int32(indices)
+    num_indices = tf.size(indices)
+    padded_indices = tf.pad(indices, [[0, size - num_indices]], constant_values=pad_value)
+    padded_indices = tf.reshape(padded_indices, [size])
+    valid_mask = tf.range(size) < num_indices
+    return padded_indices, valid_mask
@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import argparse
+import resource
+import tensorflow as tf
+
+from object_detection.config.config_factory import config_factory
+from object_detection.dataset.dataset_factory import dataset_factory
+from object_detection.dataset.eval_pascal_tf_dataset import get_dataset_by_local_file, get_dataset_by_tf_records
+
+"""
+数据输入流程的吞吐量以及峰值内存 benchmark
+每个子命令对应一种数据集，比较旧的输入流程（按顺序读取 tfrecords 文件，map 操作不并行）与新的输入流程的吞吐量
+
+python scripts/benchmark_dataset.py pascal --data_root_path /path/to/tf_eager_records --num_batches 500
+python scripts/benchmark_dataset.py pascal --data_root_path /path/to/tf_eager_records --num_parallel_reads 5 \
+    --read_buffer_size 8388608 --num_parallel_calls -1
+
+峰值内存（ru_maxrss）在进程内只增不减，所以每种 shuffle/prefetch 方式需要单独运行一次：
+python scripts/benchmark_dataset.py pascal_memory --data_root_path /path/to/tf_eager_records --pipeline legacy
+python scripts/benchmark_dataset.py pascal_memory --data_root_path /path/to/tf_eager_records --pipeline compact
+
+eval 数据集（VOC07 test），比较按顺序读取与并行读取 + prefetch 的吞吐量：
+python scripts/benchmark_dataset.py pascal_eval --voc_root_path /path/to/VOCdevkit/VOC2007 --dataset_type cv2
+"""
+
+
+def _timeit_dataset(dataset, num_batches, num_warmup=10):
+    """
+    遍历 dataset，返回 num_batches 个 batch 的总耗时以及图片数量（不包括 num_warmup 个预热 batch）
+    """
+    num_images = 0
+    start = None
+    for idx, data in enumerate(dataset):
+        if idx == num_warmup:
+            start = time.time()
+        elif idx > num_warmup:
+            num_images += int(data[0].shape[0])
+        if idx == num_warmup + num_batches:
+            break
+    if start is None:
+        raise ValueError('dataset is too small, get less than {} batches'.format(num_warmup))
+    return time.time() - start, num_images
+
+
+def _report(name, seconds, num_images):
+    tf.logging.info('{}: {} images in {:.2f}s, {:.2f} images/s'.format(name, num_images, seconds,
+                                                                      num_images / max(seconds, 1e-6)))
+
+
+def _get_peak_rss_mb():
+    # linux 下 ru_maxrss 的单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _get_pascal_base_configs(args, repeat=10):
+    config = config_factory('pascal', 'faster_rcnn')
+    base_pattern = 'pascal_{}_{}_%02d.tfrecords'.format(args.pascal_year, args.pascal_mode)
+    file_names = [os.path.join(args.data_root_path, base_pattern % i) for i in range(args.pascal_tf_records_num)]
+    return {'tf_records_list': file_names,
+            'min_size': config['image_min_size'], 'max_size': config['image_max_size'],
+            'preprocessing_type': 'caffe', 'caffe_pixel_means': config['bgr_pixel_means'],
+            'argument': True, 'argument_type': args.argument_type, 'batch_size': args.batch_size,
+            'repeat': repeat, }
+
+
+def benchmark_pascal(args):
+    base_configs = _get_pascal_base_configs(args)
+
+    num_parallel_calls = tf.data.experimental.AUTOTUNE if args.num_parallel_calls < 0 else args.num_parallel_calls
+    pipelines = [
+        ('legacy(sequential reads, no parallel map)', {'num_parallel_reads': None, 'num_parallel_calls': None}),
+        ('parallel interleave + parallel map', {'num_parallel_reads': args.num_parallel_reads,
+                                                'read_buffer_size': args.read_buffer_size,
+                                                'num_parallel_calls': num_parallel_calls}),
+    ]
+    for name, pipeline_configs in pipelines:
+        dataset_configs = dict(base_configs)
+        dataset_configs.update(pipeline_configs)
+        dataset = dataset_factory('pascal', 'train', dataset_configs)
+        seconds, num_images = _timeit_dataset(dataset, args.num_batches)
+        _report(name, seconds, num_images)
+
+
+def benchmark_pascal_memory(args):
+    tf.logging.info('peak rss before building dataset: {:.1f}MB'.format(_get_peak_rss_mb()))
+    if args.pipeline == 'legacy':
+        # 原先的方式：对解码、预处理后的 float32 图片进行 shuffle 以及 prefetch
+        dataset = dataset_factory('pascal', 'train', _get_pascal_base_configs(args, repeat=1))
+        dataset = dataset.shuffle(buffer_size=args.shuffle_buffer_size) \
+            .prefetch(buffer_size=args.legacy_prefetch_buffer_size).repeat(10)
+    elif args.pipeline == 'compact':
+        dataset_configs = _get_pascal_base_configs(args)
+        dataset_configs.update({'shuffle': True, 'shuffle_buffer_size': args.shuffle_buffer_size,
+                                'prefetch': True, 'prefetch_buffer_size': args.prefetch_buffer_size,
+                                'prefetch_max_bytes': args.prefetch_max_bytes})
+        dataset = dataset_factory('pascal', 'train', dataset_configs)
+    else:
+        raise ValueError('unknown pipeline {}'.format(args.pipeline))
+    seconds, num_images = _timeit_dataset(dataset, args.num_batches)
+    _report(args.pipeline, seconds, num_images)
+    tf.logging.info('peak rss after {} batches: {:.1f}MB'.format(args.num_batches, _get_peak_rss_mb()))
+
+
+def benchmark_pascal_eval(args):
+    config = config_factory('pascal', 'faster_rcnn')
+    if args.dataset_type == 'cv2':
+        get_dataset_fn = get_dataset_by_local_file
+    elif args.dataset_type == 'tf':
+        get_dataset_fn = get_dataset_by_tf_records
+    else:
+        raise ValueError('unknown dataset type {}'.format(args.dataset_type))
+
+    num_parallel_calls = tf.data.experimental.AUTOTUNE if args.num_parallel_calls < 0 else args.num_parallel_calls
+    pipelines = [
+        ('legacy(sequential, no prefetch)', {'num_parallel_calls': None, 'prefetch_buffer_size': None}),
+        ('parallel map + prefetch', {'num_parallel_calls': num_parallel_calls,
+                                     'prefetch_buffer_size': args.prefetch_buffer_size}),
+    ]
+    for name, pipeline_configs in pipelines:
+        dataset, _ = get_dataset_fn(args.pascal_mode, args.voc_root_path,
+                                    preprocessing_type='caffe', caffe_pixel_means=config['bgr_pixel_means'],
+                                    min_edge=config['image_min_size'], max_edge=config['image_max_size'],
+                                    **pipeline_configs)
+        seconds, num_images = _timeit_dataset(dataset, args.num_batches)
+        _report(name, seconds, num_images)
+
+
+def _add_pascal_arguments(parser):
+    parser.add_argument('--data_root_path', type=str, default='/path/to/tf_eager_records',
+                        help='path to tfrecord files')
+    parser.add_argument('--pascal_year', default="2007", type=str, help='one of [2007, 2012, 0712]')
+    parser.add_argument('--pascal_mode', default="trainval", type=str, help='one of [trainval, train, val]')
+    parser.add_argument('--pascal_tf_records_num', default=5, type=int, help='number of pascal tf records')
+    parser.add_argument('--argument_type', default='imgaug', type=str, help='one of [imgaug, tf, imgaug_pool]')
+    parser.add_argument('--batch_size', default=1, type=int)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_batches', type=int, default=200)
+    subparsers = parser.add_subparsers()
+
+    pascal_parser = subparsers.add_parser('pascal', help='benchmark pascal tfrecords training dataset')
+    _add_pascal_arguments(pascal_parser)
+    pascal_parser.add_argument('--num_parallel_reads', default=4, type=int)
+    pascal_parser.add_argument('--read_buffer_size', default=None, type=int, help='bytes, None means default')
+    pascal_parser.add_argument('--num_parallel_calls', default=-1, type=int, help='-1 means AUTOTUNE')
+    pascal_parser.set_defaults(func=benchmark_pascal)
+
+    pascal_memory_parser = subparsers.add_parser('pascal_memory',
+                                                 help='report peak rss of pascal dataset with shuffle and prefetch')
+    _add_pascal_arguments(pascal_memory_parser)
+    pascal_memory_parser.add_argument('--pipeline', type=str, default='compact',
+                                      help='one of [legacy, compact], legacy shuffles and prefetches decoded images')
+    pascal_memory_parser.add_argument('--shuffle_buffer_size', default=1000, type=int)
+    pascal_memory_parser.add_argument('--legacy_prefetch_buffer_size', default=1000, type=int)
+    pascal_memory_parser.add_argument('--prefetch_buffer_size', default=2, type=int, help='number of batches')
+    pascal_memory_parser.add_argument('--prefetch_max_bytes', default=None, type=int)
+    pascal_memory_parser.set_defaults(func=benchmark_pascal_memory)
+
+    pascal_eval_parser = subparsers.add_parser('pascal_eval', help='benchmark pascal eval dataset')
+    pascal_eval_parser.add_argument('--voc_root_path', type=str, default='/path/to/VOCdevkit/VOC2007')
+    pascal_eval_parser.add_argument('--pascal_mode', default='test', type=str)
+    pascal_eval_parser.add_argument('--dataset_type', default='cv2', type=str, help='one of [cv2, tf]')
+    pascal_eval_parser.add_argument('--num_parallel_calls', default=-1, type=int, help='-1 means AUTOTUNE')
+    pascal_eval_parser.add_argument('--prefetch_buffer_size', default=2, type=int)
+    pascal_eval_parser.set_defaults(func=benchmark_pascal_eval)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    # 只测试数据输入流程，不使用 gpu
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    tf.enable_eager_execution()
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(parse_args())
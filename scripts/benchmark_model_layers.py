@@ -0,0 +1,360 @@
+import tensorflow as tf
+import numpy as np
+import os
+import sys
+import time
+import argparse
+
+from object_detection.config.config_factory import config_factory
+from object_detection.model.model_factory import model_factory
+from object_detection.model.anchor_target import AnchorTarget
+from object_detection.model.region_proposal import RegionProposal
+from object_detection.utils.anchor_generator import make_anchors, generate_anchor_base, generate_by_anchor_base_tf
+from object_detection.utils.bbox_transform import encode_bbox_with_mean_and_std
+from object_detection.utils.bbox_tf import pairwise_iou, pairwise_iou_max, bboxes_range_filter
+from object_detection.utils import bbox_np
+
+"""
+模型中不需要训练的组件（anchor target 等）的 micro benchmark
+每个子命令对应一个组件，一般包括两部分：
+1. 与旧实现的结果对比，确认新实现的输出与旧实现一致；
+2. 新旧实现的耗时对比。
+
+python scripts/benchmark_model_layers.py anchor_target --image_height 1000 --image_width 1000
+python scripts/benchmark_model_layers.py iou_max --num_gt_bboxes 100 --chunk_size_list 1000 4096 16384
+python scripts/benchmark_model_layers.py region_proposal --model_type fpn --num_pre_nms_list 0 1000 6000 12000
+python scripts/benchmark_model_layers.py xla_jit --model_type faster_rcnn --backbone resnet50 --device /cpu:0
+"""
+
+
+def _legacy_anchor_target(gt_bboxes, image_shape, all_anchors,
+                          pos_iou_threshold=0.7, neg_iou_threshold=0.3,
+                          total_num_samples=256, max_pos_samples=128,
+                          target_means=(0, 0, 0, 0), target_stds=(1, 1, 1, 1)):
+    """
+    旧版本 `AnchorTarget.call` 的拷贝（每次 scatter_update 都新建 tf.Variable），只用于对比
+    """
+    total_anchors = all_anchors.get_shape().as_list()[0]
+    selected_anchor_idx = bboxes_range_filter(all_anchors, image_shape[0], image_shape[1])
+    anchors = tf.gather(all_anchors, selected_anchor_idx)
+
+    labels = -tf.ones((anchors.shape[0],), tf.int32)
+    overlaps = pairwise_iou(anchors, gt_bboxes)
+    argmax_overlaps = tf.argmax(overlaps, axis=1, output_type=tf.int32)
+    max_overlaps = tf.reduce_max(overlaps, axis=1)
+    gt_max_overlaps = tf.reduce_max(overlaps, axis=0)
+    gt_argmax_overlaps = tf.where(tf.equal(overlaps, gt_max_overlaps))[:, 0]
+
+    labels = tf.where(max_overlaps < neg_iou_threshold, tf.zeros_like(labels), labels)
+    labels = tf.scatter_update(tf.Variable(labels), gt_argmax_overlaps, 1)
+    labels = tf.where(max_overlaps >= pos_iou_threshold, tf.ones_like(labels), labels)
+
+    fg_inds = tf.where(tf.equal(labels, 1))[:, 0]
+    if tf.size(fg_inds) > max_pos_samples:
+        fg_inds = tf.random_shuffle(fg_inds)
+        disable_inds = fg_inds[max_pos_samples:]
+        labels = tf.scatter_update(tf.Variable(labels), disable_inds, -1)
+    num_bg = total_num_samples - tf.reduce_sum(tf.to_int32(tf.equal(labels, 1)))
+    bg_inds = tf.where(tf.equal(labels, 0))[:, 0]
+    if tf.size(bg_inds) > num_bg:
+        bg_inds = tf.random_shuffle(bg_inds)
+        disable_inds = bg_inds[num_bg:]
+        labels = tf.scatter_update(tf.Variable(labels), disable_inds, -1)
+
+    bboxes_targets = encode_bbox_with_mean_and_std(anchors, tf.gather(gt_bboxes, argmax_overlaps),
+                                                   target_means=target_means,
+                                                   target_stds=target_stds)
+
+    bbox_inside_weights = tf.zeros((anchors.shape[0], 4), dtype=tf.float32)
+    bbox_inside_weights = tf.scatter_update(tf.Variable(bbox_inside_weights),
+                                            tf.where(tf.equal(labels, 1))[:, 0], 1)
+
+    bbox_outside_weights = tf.zeros((anchors.shape[0], 4), dtype=tf.float32)
+    num_examples = tf.reduce_sum(tf.to_float(labels >= 0))
+    bbox_outside_weights = tf.scatter_update(tf.Variable(bbox_outside_weights),
+                                             tf.where(labels >= 0)[:, 0], 1.0 / num_examples)
+
+    def _unmap(data, count, inds, fill=0):
+        ret = tf.ones([count, ] + data.get_shape().as_list()[1:], dtype=tf.float32) * fill
+        return tf.scatter_update(tf.Variable(ret), inds, tf.to_float(data))
+
+    return _unmap(labels, total_anchors, selected_anchor_idx, -1), \
+           _unmap(bboxes_targets, total_anchors, selected_anchor_idx, 0), \
+           _unmap(bbox_inside_weights, total_anchors, selected_anchor_idx, 0), \
+           _unmap(bbox_outside_weights, total_anchors, selected_anchor_idx, 0)
+
+
+def _get_fpn_anchors(image_height, image_width, config):
+    all_anchors = []
+    for stride, base_anchor_size in zip(config['anchor_stride_list'], config['base_anchor_size_list']):
+        all_anchors.append(make_anchors(base_anchor_size=base_anchor_size,
+                                        anchor_scales=config['scales'],
+                                        anchor_ratios=config['ratios'],
+                                        featuremap_height=tf.to_float(tf.ceil(image_height / stride)),
+                                        featuremap_width=tf.to_float(tf.ceil(image_width / stride)),
+                                        stride=stride))
+    return tf.concat(all_anchors, axis=0)
+
+
+def _get_random_gt_bboxes(num_bboxes, image_height, image_width, seed=None):
+    """
+    随机生成 gt_bboxes，格式为 xmin, ymin, xmax, ymax，单位为像素
+    """
+    rng = np.random.RandomState(seed)
+    xy_min = rng.rand(num_bboxes, 2) * [image_width * 0.8, image_height * 0.8]
+    wh = 16 + rng.rand(num_bboxes, 2) * [image_width * 0.5, image_height * 0.5]
+    xy_max = np.minimum(xy_min + wh, [image_width - 1, image_height - 1])
+    return tf.constant(np.concatenate([xy_min, xy_max], axis=1), dtype=tf.float32)
+
+
+def _timeit(fn, num_iters, num_warmup=2):
+    for _ in range(num_warmup):
+        fn()
+    start = time.time()
+    for _ in range(num_iters):
+        fn()
+    return (time.time() - start) / num_iters
+
+
+def benchmark_anchor_target(args):
+    config = config_factory('pascal', 'fpn')
+    image_shape = [float(args.image_height), float(args.image_width)]
+    all_anchors = _get_fpn_anchors(args.image_height, args.image_width, config)
+    gt_bboxes = _get_random_gt_bboxes(args.num_gt_bboxes, args.image_height, args.image_width, args.seed)
+    tf.logging.info('anchor target benchmark, {} anchors, {} gt_bboxes'.format(all_anchors.shape[0],
+                                                                               args.num_gt_bboxes))
+
+    # 1. 结果对比：采样数量足够大时不存在随机性，所有输出都应该完全一致
+    no_sample_configs = dict(total_num_samples=all_anchors.get_shape().as_list()[0],
+                             max_pos_samples=all_anchors.get_shape().as_list()[0])
+    anchor_target = AnchorTarget(**no_sample_configs)
+    new_results = anchor_target((gt_bboxes, image_shape, all_anchors))
+    legacy_results = _legacy_anchor_target(gt_bboxes, image_shape, all_anchors, **no_sample_configs)
+    for name, new_result, legacy_result in zip(['labels', 'bbox_targets', 'inside_weights', 'outside_weights'],
+                                               new_results, legacy_results):
+        max_diff = np.max(np.abs(new_result.numpy() - legacy_result.numpy()))
+        tf.logging.info('{} max abs diff {}'.format(name, max_diff))
+        if max_diff > 1e-6:
+            raise ValueError('{} does not match legacy anchor target'.format(name))
+
+    # 采样后只对比正例、反例数量
+    anchor_target = AnchorTarget()
+    new_labels = anchor_target((gt_bboxes, image_shape, all_anchors))[0].numpy()
+    legacy_labels = _legacy_anchor_target(gt_bboxes, image_shape, all_anchors)[0].numpy()
+    for label in [0, 1]:
+        new_num, legacy_num = np.sum(new_labels == label), np.sum(legacy_labels == label)
+        tf.logging.info('label {}: {} vs legacy {}'.format(label, new_num, legacy_num))
+        if new_num != legacy_num:
+            raise ValueError('number of label {} does not match legacy anchor target'.format(label))
+
+    # 2. 耗时对比
+    new_time = _timeit(lambda: anchor_target((gt_bboxes, image_shape, all_anchors)), args.num_iters)
+    legacy_time = _timeit(lambda: _legacy_anchor_target(gt_bboxes, image_shape, all_anchors), args.num_iters)
+    tf.logging.info('anchor target: {:.2f}ms, legacy anchor target: {:.2f}ms'.format(new_time * 1000,
+                                                                                    legacy_time * 1000))
+
+
+def _check_iou_max(name, results, expected_results):
+    for result_name, result, expected_result in zip(['max1', 'argmax1', 'max2', 'argmax2', 'max_mask1'],
+                                                    results, expected_results):
+        if not np.array_equal(np.asarray(result), np.asarray(expected_result)):
+            raise ValueError('{}: {} does not match full iou matrix'.format(name, result_name))
+
+
+def benchmark_iou_max(args):
+    config = config_factory('pascal', 'fpn')
+    all_anchors = _get_fpn_anchors(args.image_height, args.image_width, config)
+    gt_bboxes = _get_random_gt_bboxes(args.num_gt_bboxes, args.image_height, args.image_width, args.seed)
+    # 重复的 gt_bboxes 以及 anchors 保证存在多个最大值的情况，检查 argmax 的结果
+    gt_bboxes = tf.concat([gt_bboxes, gt_bboxes[:2]], axis=0)
+    all_anchors = tf.concat([all_anchors, all_anchors[:100]], axis=0)
+    valid_mask = bboxes_range_filter(all_anchors, args.image_height, args.image_width)
+    valid_mask = tf.scatter_nd(tf.expand_dims(tf.to_int32(valid_mask), 1),
+                               tf.ones_like(valid_mask, dtype=tf.int32), tf.shape(all_anchors)[:1]) > 0
+    num1, num2 = all_anchors.get_shape().as_list()[0], gt_bboxes.get_shape().as_list()[0]
+    tf.logging.info('iou max benchmark, {} anchors, {} gt_bboxes, full iou matrix {:.1f}MB'.format(
+        num1, num2, num1 * num2 * 4 / 1024 ** 2))
+
+    def _full_tf(cur_valid_mask):
+        iou = pairwise_iou(all_anchors, gt_bboxes)
+        if cur_valid_mask is not None:
+            iou = tf.where(cur_valid_mask, iou, -tf.ones_like(iou))
+        max2 = tf.reduce_max(iou, axis=0)
+        return tf.reduce_max(iou, axis=1), tf.argmax(iou, axis=1, output_type=tf.int32), \
+               max2, tf.argmax(iou, axis=0, output_type=tf.int32), tf.reduce_any(tf.equal(iou, max2), axis=1)
+
+    def _full_np(cur_valid_mask):
+        iou = bbox_np.pairwise_iou(all_anchors.numpy(), gt_bboxes.numpy())
+        if cur_valid_mask is not None:
+            iou[~cur_valid_mask] = -1
+        max2 = iou.max(axis=0)
+        return iou.max(axis=1), iou.argmax(axis=1), max2, iou.argmax(axis=0), (iou == max2).any(axis=1)
+
+    # 1. 结果对比：与完整 iou 矩阵的结果完全一致（包括 argmax 在多个最大值时的结果）
+    for cur_valid_mask in [None, valid_mask]:
+        expected_tf = [r.numpy() for r in _full_tf(cur_valid_mask)]
+        np_valid_mask = cur_valid_mask.numpy() if cur_valid_mask is not None else None
+        expected_np = _full_np(np_valid_mask)
+        for chunk_size in args.chunk_size_list + [None]:
+            name = 'chunk size {}, valid mask {}'.format(chunk_size, cur_valid_mask is not None)
+            _check_iou_max('tf ' + name,
+                           [r.numpy() for r in pairwise_iou_max(all_anchors, gt_bboxes, chunk_size=chunk_size,
+                                                                valid_mask1=cur_valid_mask, with_max_mask=True)],
+                           expected_tf)
+            _check_iou_max('np ' + name,
+                           bbox_np.pairwise_iou_max(all_anchors.numpy(), gt_bboxes.numpy(), chunk_size=chunk_size,
+                                                    valid_mask1=np_valid_mask, with_max_mask=True),
+                           expected_np)
+    tf.logging.info('all results match full iou matrix')
+
+    # 2. 耗时对比
+    full_time = _timeit(lambda: _full_tf(valid_mask), args.num_iters)
+    tf.logging.info('full iou matrix: {:.2f}ms'.format(full_time * 1000))
+    for chunk_size in args.chunk_size_list:
+        chunk_time = _timeit(lambda: pairwise_iou_max(all_anchors, gt_bboxes, chunk_size=chunk_size,
+                                                      valid_mask1=valid_mask, with_max_mask=True), args.num_iters)
+        tf.logging.info('chunk size {}: {:.2f}ms, iou tile {:.1f}MB'.format(chunk_size, chunk_time * 1000,
+                                                                           chunk_size * num2 * 4 / 1024 ** 2))
+
+
+def _get_faster_rcnn_anchors(image_height, image_width, config):
+    extractor_stride = config['extractor_stride']
+    anchor_base = tf.to_float(generate_anchor_base(extractor_stride, config['ratios'], config['scales']))
+    return generate_by_anchor_base_tf(anchor_base, extractor_stride,
+                                      int(np.ceil(image_height / extractor_stride)),
+                                      int(np.ceil(image_width / extractor_stride)))
+
+
+def benchmark_region_proposal(args):
+    config = config_factory('pascal', args.model_type)
+    image_shape = [args.image_height, args.image_width]
+    num_anchors = len(config['ratios']) * len(config['scales'])
+    if args.model_type == 'fpn':
+        all_anchors = _get_fpn_anchors(args.image_height, args.image_width, config)
+        level_sizes = [int(np.ceil(args.image_height / stride)) * int(np.ceil(args.image_width / stride)) * num_anchors
+                       for stride in config['anchor_stride_list']]
+    else:
+        all_anchors = _get_faster_rcnn_anchors(args.image_height, args.image_width, config)
+        level_sizes = None
+    total_anchors = all_anchors.get_shape().as_list()[0]
+    tf.logging.info('region proposal benchmark, {} anchors'.format(total_anchors))
+
+    # 随机生成 rpn head 的结果
+    rng = np.random.RandomState(args.seed)
+    scores = tf.constant(rng.rand(total_anchors), dtype=tf.float32)
+    bboxes_txtytwth = tf.constant(rng.randn(total_anchors, 4) * 0.1, dtype=tf.float32)
+
+    for num_pre_nms in args.num_pre_nms_list:
+        region_proposal = RegionProposal(num_anchors=num_anchors,
+                                         num_pre_nms_test=num_pre_nms,
+                                         num_post_nms_test=config['rpn_proposal_test_after_nms_sample_number'],
+                                         nms_iou_threshold=config['rpn_proposal_nms_iou_threshold'],
+                                         target_means=config['rpn_proposal_means'],
+                                         target_stds=config['rpn_proposal_stds'])
+        cur_time = _timeit(lambda: region_proposal((bboxes_txtytwth, all_anchors, scores, image_shape),
+                                                   training=False), args.num_iters)
+        tf.logging.info('num_pre_nms {}: {:.2f}ms'.format(num_pre_nms, cur_time * 1000))
+
+        if level_sizes is not None and num_pre_nms > 0:
+            cur_time = _timeit(lambda: region_proposal((bboxes_txtytwth, all_anchors, scores, image_shape,
+                                                        None, level_sizes),
+                                                       training=False), args.num_iters)
+            tf.logging.info('num_pre_nms {} per level: {:.2f}ms'.format(num_pre_nms, cur_time * 1000))
+
+
+def benchmark_xla_jit(args):
+    """
+    训练 step（前向、target layers、loss 以及梯度计算）的耗时对比：
+    1. eager 模式，即 `use_xla_jit=False`；
+    2. defun + XLA JIT，即 `use_xla_jit=True`，此时 region proposal 等组件使用固定 shape 的版本。
+    """
+    image_shape = [args.image_height, args.image_width]
+    rng = np.random.RandomState(args.seed)
+    image = tf.constant(rng.rand(1, args.image_height, args.image_width, 3) * 255. - 128., dtype=tf.float32)
+    gt_bboxes = _get_random_gt_bboxes(args.num_gt_bboxes, args.image_height, args.image_width, seed=args.seed)
+    num_classes = config_factory('pascal', args.model_type)['num_classes']
+    gt_labels = tf.constant(rng.randint(1, num_classes, [args.num_gt_bboxes]), dtype=tf.int32)
+
+    with tf.device(args.device):
+        for use_xla_jit in [False, True]:
+            config = config_factory('pascal', args.model_type)
+            config['use_xla_jit'] = use_xla_jit
+            model = model_factory(args.model_type, args.backbone, config)
+            model(tf.zeros([1] + image_shape + [3]), False)
+
+            def _train_step():
+                with tf.GradientTape() as tape:
+                    losses = model((image, gt_bboxes, gt_labels), True)
+                    total_loss = tf.add_n(list(losses) + model.losses)
+                return tape.gradient(total_loss, model.variables)
+
+            if use_xla_jit:
+                _train_step = tf.contrib.eager.defun(_train_step)
+            start = time.time()
+            _train_step()
+            first_step_time = time.time() - start
+            cur_time = _timeit(_train_step, args.num_iters)
+            tf.logging.info('use_xla_jit {}: first step (including trace & compile) {:.2f}s, step {:.2f}ms'.format(
+                use_xla_jit, first_step_time, cur_time * 1000))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='micro benchmark for model layers')
+    parser.add_argument('--gpu_id', type=str, default='0')
+    parser.add_argument('--num_iters', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    subparsers = parser.add_subparsers()
+
+    anchor_target_parser = subparsers.add_parser('anchor_target', help='benchmark AnchorTarget with fpn anchors')
+    anchor_target_parser.add_argument('--image_height', type=int, default=1000)
+    anchor_target_parser.add_argument('--image_width', type=int, default=1000)
+    anchor_target_parser.add_argument('--num_gt_bboxes', type=int, default=10)
+    anchor_target_parser.set_defaults(func=benchmark_anchor_target)
+
+    iou_max_parser = subparsers.add_parser('iou_max', help='check and benchmark chunked iou max/argmax')
+    iou_max_parser.add_argument('--image_height', type=int, default=1333)
+    iou_max_parser.add_argument('--image_width', type=int, default=1333)
+    iou_max_parser.add_argument('--num_gt_bboxes', type=int, default=100)
+    iou_max_parser.add_argument('--chunk_size_list', type=int, nargs='+', default=[1000, 4096, 16384])
+    iou_max_parser.set_defaults(func=benchmark_iou_max)
+
+    region_proposal_parser = subparsers.add_parser('region_proposal',
+                                                   help='benchmark RegionProposal latency against num_pre_nms')
+    region_proposal_parser.add_argument('--model_type', type=str, default='fpn', help='one of [faster_rcnn, fpn]')
+    region_proposal_parser.add_argument('--image_height', type=int, default=1000)
+    region_proposal_parser.add_argument('--image_width', type=int, default=1000)
+    region_proposal_parser.add_argument('--num_pre_nms_list', type=int, nargs='+', default=[0, 1000, 3000, 6000, 12000],
+                                        help='0 means no pre nms top k')
+    region_proposal_parser.set_defaults(func=benchmark_region_proposal)
+
+    xla_jit_parser = subparsers.add_parser('xla_jit', help='benchmark eager training step against defun + xla jit')
+    xla_jit_parser.add_argument('--model_type', type=str, default='faster_rcnn', help='one of [faster_rcnn, fpn]')
+    xla_jit_parser.add_argument('--backbone', type=str, default='resnet50',
+                                help='one of [vgg16, resnet50, resnet101, resnet152]')
+    xla_jit_parser.add_argument('--device', type=str, default='/cpu:0')
+    xla_jit_parser.add_argument('--image_height', type=int, default=600)
+    xla_jit_parser.add_argument('--image_width', type=int, default=800)
+    xla_jit_parser.add_argument('--num_gt_bboxes', type=int, default=10)
+    xla_jit_parser.set_defaults(func=benchmark_xla_jit)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    # 设置 eager 模式必须的参数
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    tf.enable_eager_execution(config=config)
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(parse_args())
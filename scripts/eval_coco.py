@@ -4,13 +4,13 @@ import os
 import sys
 import argparse
 import json
+import time
 
 from object_detection.dataset.dataset_factory import dataset_factory
 from object_detection.model.model_factory import model_factory
 from object_detection.config.config_factory import config_factory
 from tensorflow.contrib.eager.python import saver as eager_saver
-from object_detection.utils.bbox_transform import decode_bbox_with_mean_and_std
-from object_detection.utils.bbox_tf import bboxes_clip_filter
+from object_detection.model.prediction import post_ops_prediction
 
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
@@ -82,6 +82,9 @@ def eval_coco(model,
               root_path,
               config,
               min_size=10,
+              image_cache_dir=None,
+              batch_size=1,
+              num_parallel_calls=tf.data.experimental.AUTOTUNE,
               ):
     """
     COCO Eval 的总体思路
@@ -104,54 +107,37 @@ def eval_coco(model,
     :param root_path:                   VOC的目录，要具体到某一年
     :param config:
     :param min_size:
+    :param image_cache_dir:             resize 后图片的磁盘缓存目录，与训练共享
+    :param batch_size:                  大于 1 时图片按 aspect ratio 分组、padding 后通过 `im_detect_batch` 预测
+    :param num_parallel_calls:          同时读取、预处理图片的线程数量
     :return:
     """
     dataset_configs = {'root_dir': root_path,
                        'mode': dataset_mode, 'year': dataset_year,
                        'min_size': config['image_max_size'], 'max_size': config['image_min_size'],
                        'preprocessing_type': preprocessing_type,
-                       'caffe_pixel_means': config['bgr_pixel_means']}
+                       'caffe_pixel_means': config['bgr_pixel_means'],
+                       'uint8_image': config['uint8_image'],
+                       'image_cache_dir': image_cache_dir,
+                       'batch_size': batch_size,
+                       'num_parallel_calls': num_parallel_calls}
     dataset = dataset_factory(dataset_mode, mode=dataset_mode, **dataset_configs)
 
     res_list = []
-    for img, img_scale, raw_h, raw_w, img_id in dataset:
-        # final_bboxes, final_labels, final_scores = model(img, False)
-        # final_bboxes = final_bboxes / tf.to_float(img_scale)
-
-        scores, roi_txtytwth, rois = model.im_detect(img, img_scale)
-        roi_txtytwth = tf.reshape(roi_txtytwth, [-1, num_classes, 4])
-
-        res_score = []
-        res_bbox = []
-        res_category = []
-        for j in range(1, num_classes):
-            inds = tf.where(scores[:, j] > config['prediction_score_threshold'])[:, 0]
-            cls_scores = tf.gather(scores[:, j], inds)
-            cls_boxes = decode_bbox_with_mean_and_std(tf.gather(rois, inds),
-                                                      tf.gather(roi_txtytwth[:, j, :], inds),
-                                                      target_means=config['roi_proposal_means'],
-                                                      target_stds=config['roi_proposal_stds'])
-
-            cls_boxes, inds = bboxes_clip_filter(cls_boxes, 0, raw_h, raw_w, min_size)
-            cls_scores = tf.gather(cls_scores, inds)
-            keep = tf.image.non_max_suppression(cls_boxes, cls_scores, config['max_objects_per_class_per_image'],
-                                                iou_threshold=config['prediction_nms_iou_threshold'])
-            if tf.size(keep).numpy() == 0:
-                continue
-
-            res_score.append(tf.gather(cls_scores, keep))
-            res_bbox.append(tf.gather(cls_boxes, keep))
-            res_category.append(tf.ones_like(keep, dtype=tf.int32) * j)
-
-        scores_after_nms = tf.concat(res_score, axis=0)
-        bboxes_after_nms = tf.concat(res_bbox, axis=0)
-        category_after_nms = tf.concat(res_category, axis=0)
-
-        final_scores, final_idx = tf.nn.top_k(scores_after_nms, k=tf.minimum(config['max_objects_per_image'],
-                                                                             tf.size(scores_after_nms)),
-                                              sorted=False)
-        final_bboxes = tf.gather(bboxes_after_nms, final_idx).numpy()
-        final_labels = tf.gather(category_after_nms, final_idx).numpy()
+
+    def _append_results(img_id, scores, roi_txtytwth, rois, raw_h, raw_w):
+        final_bboxes, final_labels, final_scores = post_ops_prediction(
+            scores, roi_txtytwth, rois, (raw_h, raw_w),
+            config['roi_proposal_means'], config['roi_proposal_stds'],
+            max_num_per_class=config['max_objects_per_class_per_image'],
+            max_num_per_image=config['max_objects_per_image'],
+            nms_iou_threshold=config['prediction_nms_iou_threshold'],
+            score_threshold=config['prediction_score_threshold'],
+            num_classes=num_classes,
+            min_edge=min_size,
+        )
+        final_bboxes = final_bboxes.numpy()
+        final_labels = final_labels.numpy()
         final_scores = final_scores.numpy()
 
         for cur_bbox, cur_label, cur_score in zip(final_bboxes, final_labels, final_scores):
@@ -163,6 +149,24 @@ def eval_coco(model,
                 'score': float(cur_score)
             })
 
+    num_images = 0
+    start = time.time()
+    if batch_size == 1:
+        for img, img_scale, raw_h, raw_w, img_id in dataset:
+            # final_bboxes, final_labels, final_scores = model(img, False)
+            # final_bboxes = final_bboxes / tf.to_float(img_scale)
+
+            scores, roi_txtytwth, rois = model.im_detect(img, img_scale)
+            _append_results(img_id, scores, roi_txtytwth, rois, raw_h, raw_w)
+            num_images += 1
+    else:
+        for imgs, image_shapes, img_scales, raw_hs, raw_ws, img_ids in dataset:
+            scores_list, roi_txtytwth_list, rois_list = model.im_detect_batch(imgs, image_shapes, img_scales)
+            for k in range(len(scores_list)):
+                _append_results(img_ids[k], scores_list[k], roi_txtytwth_list[k], rois_list[k], raw_hs[k], raw_ws[k])
+            num_images += len(scores_list)
+    tf.logging.info('predict {} images in {:.2f}s'.format(num_images, time.time() - start))
+
     with open(result_file_path, 'w') as f:
         json.dump(res_list, f)
     eval_by_cocotools(result_file_path, dataset_mode, root_path)
@@ -178,6 +182,12 @@ def _load_from_ckpt_file(model, ckpt_file_path):
         raise ValueError('unknown ckpt file {}'.format(ckpt_file_path))
 
 
+def _get_num_parallel_calls(num_parallel_calls):
+    if num_parallel_calls < 0:
+        return tf.data.experimental.AUTOTUNE
+    return num_parallel_calls if num_parallel_calls > 0 else None
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Evaluate a Fast R-CNN model')
     parser.add_argument('ckpt_file_path', type=str, help='target ckpt file path', )
@@ -198,6 +208,11 @@ def parse_args():
     parser.add_argument('--result_file_dir', help='path to save detection result json file',
                         default='/ssd/zhangyiyang/results/', type=str)
     parser.add_argument('--logs_name', default=None, type=str)
+    parser.add_argument('--image_cache_dir', default=None, type=str, help='path to save resized images')
+    parser.add_argument('--num_parallel_calls', default=-1, type=int,
+                        help='number of threads to load and preprocess images, -1 means AUTOTUNE, 0 means sequential')
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help='images are bucketed by aspect ratio and padded when batch_size > 1')
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -244,7 +259,10 @@ def main(args):
               image_format=image_format,
               preprocessing_type=preprocessing_type,
               root_path=os.path.join(args.root_path),
-              config=model_config,)
+              config=model_config,
+              image_cache_dir=args.image_cache_dir,
+              batch_size=args.batch_size,
+              num_parallel_calls=_get_num_parallel_calls(args.num_parallel_calls),)
 
 
 if __name__ == '__main__':
@@ -26,6 +26,9 @@ def eval_from_scratch(model,
                       cache_dir,
                       use_07_metric,
                       config,
+                      image_cache_dir=None,
+                      batch_size=1,
+                      num_parallel_calls=tf.data.experimental.AUTOTUNE,
                       ):
     """
 
@@ -39,6 +42,9 @@ def eval_from_scratch(model,
     :param cache_dir:                   预测时，会将gt的信息使用pickle进行保存，保存的路径就是 cache_dir+'test_annots.pkl'
     :param use_07_metric:
     :param config:
+    :param image_cache_dir:             resize 后图片的磁盘缓存目录，只支持 cv2 数据集
+    :param batch_size:                  大于 1 时通过 `im_detect_batch` 预测
+    :param num_parallel_calls:          同时读取、预处理图片的线程数量
     :return:
     """
 
@@ -48,6 +54,10 @@ def eval_from_scratch(model,
                          image_format=image_format,
                          preprocessing_type=preprocessing_type,
                          caffe_pixel_means=config['bgr_pixel_means'],
+                         uint8_image=config['uint8_image'],
+                         image_cache_dir=image_cache_dir,
+                         batch_size=batch_size,
+                         num_parallel_calls=num_parallel_calls,
                          min_edge=config['image_min_size'],
                          max_edge=config['image_max_size'],
                          data_root_path=root_path,
@@ -106,6 +116,12 @@ def _load_from_ckpt_file(model, ckpt_file_path):
         raise ValueError('unknown ckpt file {}'.format(ckpt_file_path))
 
 
+def _get_num_parallel_calls(num_parallel_calls):
+    if num_parallel_calls < 0:
+        return tf.data.experimental.AUTOTUNE
+    return num_parallel_calls if num_parallel_calls > 0 else None
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Evaluate a Fast R-CNN model')
     parser.add_argument('ckpt_file_path', type=str, help='target ckpt file path', )
@@ -126,6 +142,12 @@ def parse_args():
     parser.add_argument('--use_local_result_files', default=False, type=bool)
 
     parser.add_argument('--use_07_metric', default=True, type=bool)
+    parser.add_argument('--image_cache_dir', default=None, type=str,
+                        help='path to save resized images, only used when dataset_type is cv2')
+    parser.add_argument('--num_parallel_calls', default=-1, type=int,
+                        help='number of threads to load and preprocess images, -1 means AUTOTUNE, 0 means sequential')
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help='images are bucketed by aspect ratio and padded when batch_size > 1')
 
     # parser.add_argument('--root_path', help='path to pascal VOCdevkit',
     #                     default='D:\\data\\VOCdevkit', type=str)
@@ -209,7 +231,10 @@ def main(args):
                       result_file_format=result_file_path,
                       cache_dir=args.annotation_cache_dir,
                       use_07_metric=args.use_07_metric,
-                      config=model_config)
+                      config=model_config,
+                      image_cache_dir=args.image_cache_dir,
+                      batch_size=args.batch_size,
+                      num_parallel_calls=_get_num_parallel_calls(args.num_parallel_calls))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,110 @@
+import os
+import sys
+import time
+import argparse
+import tensorflow as tf
+from imgaug import augmenters as iaa
+from tqdm import tqdm
+
+from object_detection.model.model_factory import model_factory
+from object_detection.config.config_factory import config_factory
+from object_detection.dataset.dataset_factory import dataset_factory
+from object_detection.dataset.utils.anchor_target_cache_utils import AnchorTargetCache, get_anchor_target_cache_key
+
+"""
+提前计算训练集中每张图片、每个尺寸、是否水平翻转时 anchor target 中随机采样之前的部分（参考 `anchor_target_cache_utils`），
+训练时通过 `train.py --anchor_target_cache_dir` 读取，不需要计算 anchors 与 gt_bboxes 的 iou。
+
+数据集与 `train.py` 相同，只是将默认的 `iaa.Fliplr(0.5)` 分别替换为 `iaa.Fliplr(0.)` 以及 `iaa.Fliplr(1.)`，
+所以 gt_bboxes 的计算过程（包括 imgaug 中的取整）与训练时完全相同。
+model_type、anchors 相关配置需要与训练时相同，anchors 数量不一致时训练中不会使用缓存。
+
+python scripts/generate_anchor_target_cache.py --data_type pascal --model_type faster_rcnn \
+    --data_root_path /path/to/VOCdevkit/tf_eager_records --cache_dir /path/to/anchor_target_cache
+"""
+
+
+def _get_dataset(args, config, min_size, flip, overlap_labels_fn):
+    common_configs = {'min_size': min_size, 'max_size': config['image_max_size'],
+                      'uint8_image': True,
+                      'argument': True, 'argument_type': 'imgaug', 'iaa_sequence': [iaa.Fliplr(float(flip))],
+                      'batch_size': 1, 'shuffle': False,
+                      'anchor_target_fn': overlap_labels_fn, }
+    if args.data_type == 'pascal':
+        base_pattern = 'pascal_{}_{}_%02d.tfrecords'.format(args.pascal_year, args.pascal_mode)
+        file_names = [os.path.join(args.data_root_path, base_pattern % i) for i in range(args.pascal_tf_records_num)]
+        return dataset_factory('pascal', 'train', dict(common_configs, tf_records_list=file_names))
+    if args.data_type == 'coco' and args.coco_tf_records_dir is not None:
+        file_names = sorted(tf.gfile.Glob(os.path.join(args.coco_tf_records_dir,
+                                                       'coco_{}_train_*.tfrecords'.format(args.coco_year))))
+        return dataset_factory('coco', 'train_tf_records', dict(common_configs, tf_records_list=file_names))
+    if args.data_type == 'coco':
+        return dataset_factory('coco', 'train', dict(common_configs, root_dir=args.data_root_path,
+                                                     mode='train', year=args.coco_year))
+    raise ValueError('unknown dataset type {}'.format(args.data_type))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate anchor target cache for training')
+    parser.add_argument('--gpu_id', default="0", type=str, help='used in sys variable CUDA_VISIBLE_DEVICES')
+    parser.add_argument('--model_type', type=str, default='faster_rcnn', help='one of [faster_rcnn, fpn]')
+    parser.add_argument('--backbone', type=str, default='resnet50',
+                        help='one of [vgg16, resnet50, resnet101, resnet152]')
+    parser.add_argument('--data_type', default="pascal", type=str, help='pascal or coco')
+
+    parser.add_argument('--coco_year', default="2017", type=str, help='one of [2014, 2017]')
+    parser.add_argument('--coco_tf_records_dir', default=None, type=str,
+                        help='path to tf records generated by `generate_coco_tf_records.py`, '
+                             'if None, load images from coco root dir')
+    parser.add_argument('--pascal_year', default="2007", type=str, help='one of [2007, 2012, 0712]')
+    parser.add_argument('--pascal_mode', default="trainval", type=str, help='one of [trainval, train, val]')
+    parser.add_argument('--pascal_tf_records_num', default=5, type=int, help='number of pascal tf records')
+    parser.add_argument('--data_root_path', type=str,
+                        help='path to tfrecord files if pascal, path to coco root if coco')
+
+    parser.add_argument('--min_sizes', type=int, nargs='+', default=None,
+                        help='image min sizes, default is `image_min_size` in config')
+    parser.add_argument('--flips', type=int, nargs='+', default=[0, 1], help='0 for original, 1 for horizontal flip')
+    parser.add_argument('--cache_dir', type=str, help='path to save anchor target cache')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu_id)
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    tf.enable_eager_execution(config=config)
+
+    # 只用到 anchors 以及 anchor target 相关配置，不需要导入模型参数
+    model_config = config_factory(args.data_type, args.model_type)
+    cur_model = model_factory(args.model_type, args.backbone, model_config)
+
+    def _overlap_labels_fn(gt_bboxes, image_shape):
+        labels, argmax_overlaps = cur_model.get_anchor_overlap_labels(gt_bboxes, image_shape)
+        return gt_bboxes, tf.to_int32(tf.stack(image_shape)), labels, argmax_overlaps
+
+    cache = AnchorTargetCache(args.cache_dir, readonly=False)
+    min_sizes = args.min_sizes if args.min_sizes is not None else [model_config['image_min_size']]
+    for min_size in min_sizes:
+        for flip in args.flips:
+            start = time.time()
+            num_writes = 0
+            dataset = _get_dataset(args, model_config, min_size, flip, _overlap_labels_fn)
+            for image_idx, (_, _, _, gt_bboxes, image_shape, labels, argmax_overlaps) in enumerate(tqdm(dataset)):
+                key = get_anchor_target_cache_key(gt_bboxes.numpy(), image_shape.numpy())
+                num_writes += cache.put(key, labels.numpy(), argmax_overlaps.numpy(), int(gt_bboxes.shape[0]),
+                                        image_idx=image_idx, flip=flip)
+            cache.flush()
+            print('min size {}, flip {}: {} new entries, costing {:.2f}s'.format(min_size, flip, num_writes,
+                                                                                 time.time() - start))
+    print('{} entries in {}'.format(len(cache), args.cache_dir))
+
+
+if __name__ == '__main__':
+    main(parse_args())
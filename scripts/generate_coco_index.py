@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import argparse
+
+from object_detection.dataset.utils.coco_index_utils import get_default_index_file_path, build_coco_index, \
+    save_coco_index, load_coco_index
+
+"""
+将 COCO instances json 文件转换为列式索引文件（.npz），只需要运行一次
+之后 `CocoDataset` 会直接导入索引文件，不需要再通过 pycocotools 解析 json 文件
+
+python scripts/generate_coco_index.py --root_path /path/to/COCO2017 --year 2017 --modes train val
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate columnar COCO annotation index files')
+    parser.add_argument('--root_path', help='path to COCO root dir', default='/ssd/zhangyiyang/COCO2017', type=str)
+    parser.add_argument('--year', type=str, default='2017', help='one of [2014, 2017]')
+    parser.add_argument('--modes', type=str, nargs='+', default=['train', 'val'],
+                        help='one or more of [train, val, minival]')
+    parser.add_argument('--min_edge', type=int, default=32, help='filter images whose short edge is less than this')
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help='default is `{root_path}/annotations`, which will be loaded by `CocoDataset` by default')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    for mode in args.modes:
+        annotation_file_path = os.path.join(args.root_path, 'annotations', 'instances_{}{}.json'.format(mode, args.year))
+        index_file_path = get_default_index_file_path(args.root_path, mode, args.year)
+        if args.output_dir is not None:
+            index_file_path = os.path.join(args.output_dir, os.path.basename(index_file_path))
+
+        start = time.time()
+        index = build_coco_index(annotation_file_path, min_edge=args.min_edge)
+        save_coco_index(index, index_file_path)
+        print('generate {} with {} images and {} bboxes, costing {:.2f}s'.format(index_file_path,
+                                                                                 len(index['img_ids']),
+                                                                                 len(index['labels']),
+                                                                                 time.time() - start))
+
+        start = time.time()
+        load_coco_index(index_file_path)
+        print('load {}, costing {:.3f}s'.format(index_file_path, time.time() - start))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import object_detection.dataset.utils.tf_record_utils as dataset_utils
+from object_detection.dataset.utils.coco_index_utils import get_default_index_file_path, build_coco_index, \
+    load_coco_index
+
+"""
+将 COCO 数据集转换为多个 tfrecords 文件，训练时通过 `dataset_factory('coco', 'train_tf_records', ...)` 读取
+1. 通过列式索引（参考 `coco_index_utils`）获取所有图片的 bboxes、labels 等信息；
+2. 根据 jpeg 文件大小，将图片分配到各个 tfrecords 文件中，保证每个文件的大小基本相同；
+3. 通过进程池，每个进程生成一个 tfrecords 文件。
+
+python scripts/generate_coco_tf_records.py --root_path /path/to/COCO2017 --year 2017 --mode train --writers_number 64
+"""
+
+
+def _get_tf_example(image_path, file_name, height, width, bboxes, labels, labels_text):
+    """
+    格式与 pascal tfrecords 相同，bboxes 的范围与 `CocoDataset` 相同，即 ymin/height, xmin/width 等
+    """
+    with open(image_path, 'rb') as image:
+        encoded_jpg = image.read()
+
+    example = tf.train.Example(features=tf.train.Features(feature={
+        'image/height': dataset_utils.int64_feature(height),
+        'image/width': dataset_utils.int64_feature(width),
+        'image/filename': dataset_utils.bytes_feature(file_name),
+        'image/encoded': dataset_utils.bytes_feature(encoded_jpg),
+        'image/object/bbox/xmin': dataset_utils.float_list_feature(bboxes[:, 1] / width),
+        'image/object/bbox/xmax': dataset_utils.float_list_feature(bboxes[:, 3] / width),
+        'image/object/bbox/ymin': dataset_utils.float_list_feature(bboxes[:, 0] / height),
+        'image/object/bbox/ymax': dataset_utils.float_list_feature(bboxes[:, 2] / height),
+        'image/object/class/label': dataset_utils.int64_list_feature(labels),
+        'image/object/class/text': dataset_utils.bytes_list_feature(labels_text),
+    }))
+    return example
+
+
+def _split_by_file_size(file_sizes, number):
+    """
+    贪心算法：按照文件大小从大到小，依次分配到当前总大小最小的 tfrecords 文件中
+    :param file_sizes:  [num_images, ]
+    :param number:      tfrecords 文件数量
+    :return:            list，每个元素为对应 tfrecords 文件中的图片 index（按 index 升序）
+    """
+    shard_sizes = np.zeros([number], dtype=np.int64)
+    shards = [[] for _ in range(number)]
+    for idx in np.argsort(-file_sizes, kind='stable'):
+        shard_idx = int(np.argmin(shard_sizes))
+        shards[shard_idx].append(int(idx))
+        shard_sizes[shard_idx] += file_sizes[idx]
+    return [sorted(shard) for shard in shards]
+
+
+def _write_one_tf_record(job):
+    """
+    进程池中运行，生成一个 tfrecords 文件
+    :param job:     (tf record 文件路径, 图片路径, 当前文件需要的索引信息)
+    :return:        tf record 文件路径，图片数量
+    """
+    writer_path, image_dir, samples = job
+    with tf.python_io.TFRecordWriter(writer_path) as writer:
+        for file_name, height, width, bboxes, labels, labels_text in samples:
+            tf_example = _get_tf_example(os.path.join(image_dir, file_name.decode('utf8')), file_name,
+                                         int(height), int(width), bboxes, labels.tolist(), labels_text)
+            writer.write(tf_example.SerializeToString())
+    return writer_path, len(samples)
+
+
+def main(args):
+    # 获取列式索引
+    annotation_file_path = os.path.join(args.root_path, 'annotations',
+                                        'instances_{}{}.json'.format(args.mode, args.year))
+    index_file_path = get_default_index_file_path(args.root_path, args.mode, args.year)
+    if os.path.exists(index_file_path):
+        index = load_coco_index(index_file_path)
+    else:
+        index = build_coco_index(annotation_file_path, min_edge=args.min_edge)
+    image_dir = os.path.join(args.root_path, ('val' if args.mode == 'minival' else args.mode) + args.year)
+
+    # 根据文件大小分配图片
+    file_sizes = np.array([os.path.getsize(os.path.join(image_dir, file_name.decode('utf8')))
+                           for file_name in index['file_names']], dtype=np.int64)
+    shards = _split_by_file_size(file_sizes, args.writers_number)
+
+    if not os.path.exists(args.writer_base_path):
+        os.makedirs(args.writer_base_path)
+    jobs = []
+    for shard_idx, shard in enumerate(shards):
+        samples = []
+        for idx in shard:
+            start, end = index['bbox_offsets'][idx], index['bbox_offsets'][idx + 1]
+            labels = index['labels'][start:end]
+            samples.append((index['file_names'][idx], index['heights'][idx], index['widths'][idx],
+                            index['bboxes'][start:end], labels, [index['cat_names'][label - 1] for label in labels]))
+        writer_path = os.path.join(args.writer_base_path,
+                                   args.writer_file_pattern % (args.year, args.mode, shard_idx))
+        jobs.append((writer_path, image_dir, samples))
+
+    start = time.time()
+    pool = multiprocessing.Pool(args.num_workers)
+    for writer_path, num_images in pool.imap_unordered(_write_one_tf_record, jobs):
+        print('generate {} with {} images'.format(writer_path, num_images))
+    pool.close()
+    pool.join()
+    print('generate {} tf records files, costing {:.2f}s'.format(len(jobs), time.time() - start))
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default='train', help='one of [train, val, minival]')
+    parser.add_argument('--year', type=str, default='2017', help='one of [2014, 2017]')
+    parser.add_argument('--writer_file_pattern', type=str, default='coco_%s_%s_%03d.tfrecords',
+                        help='tf records output file name pattern')
+    parser.add_argument('--writers_number', type=int, default=64, help='split tf records into several files.')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes to generate tf records files')
+    parser.add_argument('--min_edge', type=int, default=32,
+                        help='filter images whose short edge is less than this, used when no index file exists')
+
+    parser.add_argument('--writer_base_path', type=str, default="/path/to/tf_eager_records",
+                        help='path to save generated tf record files.')
+    parser.add_argument('--root_path', type=str, default='/path/to/COCO2017')
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(_parse_arguments(sys.argv[1:]))
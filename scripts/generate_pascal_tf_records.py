@@ -1,9 +1,12 @@
 import os
 import sys
+import queue
+import multiprocessing
 import tensorflow as tf
 import argparse
 import object_detection.dataset.utils.tf_record_utils as dataset_utils
 import object_detection.dataset.utils.label_map_utils as label_map_utils
+import object_detection.dataset.utils.tf_record_index_utils as index_utils
 from tqdm import tqdm
 from lxml import etree
 
@@ -44,12 +47,70 @@ def _get_tf_example(xml_dict, label_map_dict, image_path):
     return example
 
 
+def _write_one_shard(job):
+    """
+    生成一个 tfrecords 文件以及对应的 offset 索引文件，多进程模式下在进程池中运行，每个进程独占自己的 writer
+    :param job:     (tf record 文件路径, [(annotation 文件路径, 对应年份的根目录), ...], label_map_dict, 进度队列)
+                    进度队列为 None 时不汇报进度
+    :return:        tf record 文件路径，图片数量
+    """
+    writer_path, samples, label_map_dict, progress_queue = job
+    record_sizes = []
+    with tf.python_io.TFRecordWriter(writer_path) as writer:
+        for annotation_file_path, root_path in samples:
+            with open(annotation_file_path, 'r') as f:
+                xml_str = f.read()
+            xml_dict = dataset_utils.recursive_parse_xml_to_dict(etree.fromstring(xml_str))['annotation']
+            tf_example = _get_tf_example(xml_dict, label_map_dict,
+                                         os.path.join(root_path, 'JPEGImages', xml_dict['filename']))
+            serialized_example = tf_example.SerializeToString()
+            writer.write(serialized_example)
+            record_sizes.append(len(serialized_example))
+            if progress_queue is not None:
+                progress_queue.put(1)
+    index_utils.save_tf_record_index(index_utils.get_record_sizes_index(record_sizes),
+                                     index_utils.get_default_index_file_path(writer_path))
+    return writer_path, len(samples)
+
+
+def _run_with_pool(jobs, num_workers, total):
+    """
+    通过进程池生成所有 tfrecords 文件，主进程从队列中汇总各个进程的进度
+    """
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+    jobs = [job[:-1] + (progress_queue,) for job in jobs]
+    pool = multiprocessing.Pool(min(num_workers, len(jobs)))
+    results = pool.map_async(_write_one_shard, jobs)
+    with tqdm(total=total) as progress_bar:
+        while not results.ready() or not progress_queue.empty():
+            try:
+                progress_bar.update(progress_queue.get(timeout=0.5))
+            except queue.Empty:
+                pass
+    pool.close()
+    pool.join()
+    manager.shutdown()
+    return results.get()
+
+
+def _build_index_files(args):
+    """
+    为已经存在的 tfrecords 文件生成索引文件
+    """
+    for shard_idx in tqdm(range(args.writers_number)):
+        writer_path = os.path.join(args.writer_base_path,
+                                   args.writer_file_pattern % (args.year, args.mode, shard_idx))
+        index = index_utils.build_tf_record_index(writer_path)
+        index_utils.save_tf_record_index(index, index_utils.get_default_index_file_path(writer_path))
+        print('generate index for {} with {} records'.format(writer_path, len(index)))
+
+
 def main(args):
-    writers = dataset_utils.get_multi_tf_record_writers(base_path=args.writer_base_path,
-                                                        file_pattern=args.writer_file_pattern,
-                                                        year=args.year,
-                                                        number=args.writers_number,
-                                                        mode=args.mode)
+    if args.index_only:
+        _build_index_files(args)
+        return
+
     label_map_dict = label_map_utils.get_label_map_dict(args.label_map_path)
     if args.year == "2007":
         years = ["VOC2007"]
@@ -75,15 +136,21 @@ def main(args):
         annotation_file_paths_list += cur_annotation_list
         root_paths += cur_root_paths
 
-    for idx, (annotation_file_path, root_path) in enumerate(tqdm(zip(annotation_file_paths_list, root_paths))):
-        with open(annotation_file_path, 'r') as f:
-            xml_str = f.read()
-        xml_dict = dataset_utils.recursive_parse_xml_to_dict(etree.fromstring(xml_str))['annotation']
-        tf_example = _get_tf_example(xml_dict, label_map_dict,
-                                     os.path.join(root_path, 'JPEGImages', xml_dict['filename']))
-        writers[idx % args.writers_number].write(tf_example.SerializeToString())
-    for writer in writers:
-        writer.close()
+    # 第 idx 个样本写入第 idx % writers_number 个文件，每个文件内部保持原始顺序
+    # 所以不论是否使用多进程、使用多少个进程，每个文件的内容都相同
+    samples = list(zip(annotation_file_paths_list, root_paths))
+    jobs = []
+    for shard_idx in range(args.writers_number):
+        writer_path = os.path.join(args.writer_base_path,
+                                   args.writer_file_pattern % (args.year, args.mode, shard_idx))
+        jobs.append((writer_path, samples[shard_idx::args.writers_number], label_map_dict, None))
+
+    if args.num_workers > 1:
+        results = _run_with_pool(jobs, args.num_workers, len(samples))
+    else:
+        results = [_write_one_shard(job[:-1] + (None,)) for job in tqdm(jobs)]
+    for writer_path, num_images in results:
+        print('generate {} with {} images'.format(writer_path, num_images))
 
 
 def _parse_arguments(argv):
@@ -93,6 +160,11 @@ def _parse_arguments(argv):
     parser.add_argument('--writer_file_pattern', type=str, default='pascal_%s_%s_%02d.tfrecords',
                         help='tf records output file name pattern')
     parser.add_argument('--writers_number', type=int, default=5, help='split tf records into several files.')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes, each process writes whole tf records files, '
+                             'generated files are the same as single process mode')
+    parser.add_argument('--index_only', type=bool, default=False,
+                        help='only generate offset index files for existing tf records files')
 
     parser.add_argument('--writer_base_path', type=str, default="/path/to/tf_eager_records",
                         help='path to save generated tf record files.')
@@ -3,11 +3,15 @@ import time
 import argparse
 import numpy as np
 import tensorflow as tf
+from functools import partial
 
 from object_detection.model.model_factory import model_factory
 from object_detection.config.config_factory import config_factory
 from object_detection.utils.visual_utils import show_one_image
 from object_detection.dataset.dataset_factory import dataset_factory
+from object_detection.dataset.utils.image_cache_utils import get_all_image_cache_stats
+from object_detection.dataset.utils.anchor_target_cache_utils import get_anchor_target_cache, \
+    get_all_anchor_target_cache_stats
 from tensorflow.contrib.summary import summary
 from tensorflow.contrib.eager.python import saver as eager_saver
 from tensorflow.python.platform import tf_logging
@@ -40,6 +44,83 @@ def train_step(model, loss, tape, optimizer):
                               global_step=tf.train.get_or_create_global_step())
 
 
+def eager_train_step(base_model, optimizer, model_inputs):
+    with tf.GradientTape() as tape:
+        rpn_cls_loss, rpn_reg_loss, roi_cls_loss, roi_reg_loss = base_model(model_inputs, True)
+        l2_loss = tf.add_n(base_model.losses)
+        total_loss = rpn_cls_loss + rpn_reg_loss + roi_cls_loss + roi_reg_loss + l2_loss
+        train_step(base_model, total_loss, tape, optimizer)
+    return rpn_cls_loss, rpn_reg_loss, roi_cls_loss, roi_reg_loss, l2_loss, total_loss
+
+
+class CompiledTrainStep(object):
+    """
+    通过 `tf.contrib.eager.defun` 编译整个训练 step（模型前向、anchor target、proposal target、loss 以及梯度更新）
+    每个图片 shape bucket 对应一个 defun，只 trace 一次，之后直接复用。
+    gt_bboxes、gt_labels 的 bboxes 数量不同（padded_batch 只 padding 到 batch 内的最大数量），
+    所以通过 input_signature 将 bboxes 数量设置为 None，只根据图片的 shape 区分 trace。
+    1. 第一个 step 以 eager 模式运行，用于创建 optimizer slot 等变量（defun 中不能第一次创建变量）；
+    2. 已经 trace 过的 shape 直接运行对应的 graph；
+    3. 新的 shape 在 trace 数量未达到 max_num_traces 时进行 trace，并记录编译耗时，否则以 eager 模式运行。
+    """
+
+    def __init__(self, base_model, optimizer, max_num_traces=32):
+        self._base_model = base_model
+        self._optimizer = optimizer
+        self._max_num_traces = max_num_traces
+        self._compiled_fns = {}
+        self._warmed_up = False
+
+        # key 为 shape bucket，value 为 trace 以及第一次运行的耗时（秒）
+        self.compile_seconds = {}
+        self.num_compiled_steps = 0
+        self.num_eager_steps = 0
+
+    def _train_step_fn(self, model_inputs):
+        return eager_train_step(self._base_model, self._optimizer, model_inputs)
+
+    @staticmethod
+    def _get_input_signature(model_inputs):
+        """
+        model_inputs 为 (image, gt_bboxes, gt_labels, ...)，gt_bboxes 倒数第二维、gt_labels 最后一维为 bboxes 数量
+        """
+        shapes = [t.get_shape().as_list() for t in model_inputs]
+        shapes[1][-2] = None
+        shapes[2][-1] = None
+        return [tuple(tf.TensorSpec(shape, t.dtype) for shape, t in zip(shapes, model_inputs))]
+
+    def __call__(self, model_inputs):
+        key = tuple(model_inputs[0].get_shape().as_list())
+        if not self._warmed_up:
+            self._warmed_up = True
+            self.num_eager_steps += 1
+            return eager_train_step(self._base_model, self._optimizer, model_inputs)
+
+        if key in self._compiled_fns:
+            self.num_compiled_steps += 1
+            return self._compiled_fns[key](model_inputs)
+
+        if len(self.compile_seconds) >= self._max_num_traces:
+            self.num_eager_steps += 1
+            return eager_train_step(self._base_model, self._optimizer, model_inputs)
+
+        start = time.time()
+        self._compiled_fns[key] = tf.contrib.eager.defun(self._train_step_fn,
+                                                         input_signature=self._get_input_signature(model_inputs))
+        losses = self._compiled_fns[key](model_inputs)
+        self.compile_seconds[key] = time.time() - start
+        self.num_compiled_steps += 1
+        tf_logging.info('trace #%d for shape bucket %s, costing %.2f seconds' % (len(self.compile_seconds), key,
+                                                                                 self.compile_seconds[key]))
+        return losses
+
+    def get_stats(self):
+        return {'num_traces': len(self.compile_seconds),
+                'total_compile_seconds': sum(self.compile_seconds.values()),
+                'num_compiled_steps': self.num_compiled_steps,
+                'num_eager_steps': self.num_eager_steps}
+
+
 def _get_default_optimizer(use_adam):
     lr = tf.train.piecewise_constant(tf.train.get_or_create_global_step(),
                                      boundaries=CONFIG['learning_rate_multi_decay_steps'],
@@ -51,23 +132,51 @@ def _get_default_optimizer(use_adam):
 
 
 def _get_training_dataset(preprocessing_type='caffe', dataset_type='pascal',
-                          coco_year="2017",
+                          coco_year="2017", coco_tf_records_dir=None,
                           pascal_year="2007", pascal_mode='trainval', pascal_tf_records_num=5,
-                          data_root_path=None):
+                          pascal_use_tf_record_index=False,
+                          data_root_path=None, argument_type='imgaug', batch_size=1,
+                          image_cache_dir=None, image_cache_max_bytes=50 * 1024 ** 3,
+                          imgaug_num_workers=4,
+                          shuffle=False, shuffle_seed=None, skip=0,
+                          anchor_target_fn=None):
     if dataset_type == 'pascal':
         base_pattern = 'pascal_{}_{}_%02d.tfrecords'.format(pascal_year, pascal_mode)
         file_names = [os.path.join(data_root_path, base_pattern % i) for i in range(pascal_tf_records_num)]
         dataset_configs = {'tf_records_list': file_names,
                            'min_size': CONFIG['image_min_size'], 'max_size': CONFIG['image_max_size'],
                            'preprocessing_type': preprocessing_type, 'caffe_pixel_means': CONFIG['bgr_pixel_means'],
-                           'argument': True, }
+                           'uint8_image': CONFIG['uint8_image'],
+                           'argument': True, 'argument_type': argument_type, 'batch_size': batch_size,
+                           'imgaug_num_workers': imgaug_num_workers,
+                           'shuffle': shuffle, 'shuffle_seed': shuffle_seed, 'skip': skip,
+                           'anchor_target_fn': anchor_target_fn,
+                           'use_tf_record_index': pascal_use_tf_record_index, }
         dataset = dataset_factory('pascal', 'train', dataset_configs)
+    elif dataset_type == 'coco' and coco_tf_records_dir is not None:
+        # 读取 `generate_coco_tf_records.py` 生成的 tfrecords 文件
+        file_names = sorted(tf.gfile.Glob(os.path.join(coco_tf_records_dir,
+                                                       'coco_{}_train_*.tfrecords'.format(coco_year))))
+        dataset_configs = {'tf_records_list': file_names,
+                           'min_size': CONFIG['image_min_size'], 'max_size': CONFIG['image_max_size'],
+                           'preprocessing_type': preprocessing_type, 'caffe_pixel_means': CONFIG['bgr_pixel_means'],
+                           'uint8_image': CONFIG['uint8_image'],
+                           'argument': True, 'argument_type': argument_type, 'batch_size': batch_size,
+                           'imgaug_num_workers': imgaug_num_workers,
+                           'shuffle': shuffle, 'shuffle_seed': shuffle_seed, 'skip': skip,
+                           'anchor_target_fn': anchor_target_fn, }
+        dataset = dataset_factory('coco', 'train_tf_records', dataset_configs)
     elif dataset_type == 'coco':
         dataset_configs = {'root_dir': data_root_path,
                            'mode': 'train', 'year': coco_year,
                            'min_size': CONFIG['image_min_size'], 'max_size': CONFIG['image_max_size'],
                            'preprocessing_type': preprocessing_type, 'caffe_pixel_means': CONFIG['bgr_pixel_means'],
-                           'argument': True, }
+                           'uint8_image': CONFIG['uint8_image'],
+                           'image_cache_dir': image_cache_dir, 'image_cache_max_bytes': image_cache_max_bytes,
+                           'argument': True, 'argument_type': argument_type, 'batch_size': batch_size,
+                           'imgaug_num_workers': imgaug_num_workers,
+                           'shuffle': shuffle, 'shuffle_seed': shuffle_seed, 'skip': skip,
+                           'anchor_target_fn': anchor_target_fn, }
         dataset = dataset_factory('coco', 'train', dataset_configs)
     else:
         raise ValueError('unknown dataset type {}'.format(dataset_type))
@@ -78,29 +187,59 @@ def train_one_epoch(dataset, base_model, optimizer,
                     preprocessing_type,
                     logging_every_n_steps,
                     summary_every_n_steps,
-                    saver, save_every_n_steps, save_path):
-    idx = 0
+                    saver, save_every_n_steps, save_path,
+                    compiled_train_step=None,
+                    data_offset=None):
+    """
+    logging/summary/saving 都以 global step 为准，从 checkpoint 恢复后间隔不变
+    :param data_offset:     当前 epoch 已经训练的图片数量（tf.Variable），每个 step 后更新，与模型参数一起保存
+    """
+    global_step = tf.train.get_or_create_global_step()
+
+    for features in tqdm(dataset):
+        idx = int(global_step.numpy())
+        num_images = int(features[0].shape[0])
 
-    for image, gt_bboxes, gt_labels in tqdm(dataset):
         # bgr input
         # for keras application pre-trained models, use bgr
+        anchor_targets = ()
+        if len(features) == 5:
+            # batch_size > 1，aspect ratio bucketing 后的 padded batch
+            image, gt_bboxes, gt_labels, image_shapes, num_bboxes = features
+        else:
+            # 数据集中计算了 anchor target 时，额外包括 rpn_labels, rpn_bbox_targets, rpn_in_weights, rpn_out_weights
+            image, gt_bboxes, gt_labels = features[:3]
+            anchor_targets = tuple(features[3:])
+            gt_bboxes = tf.squeeze(gt_bboxes, axis=0)
+            gt_labels = tf.squeeze(gt_labels, axis=0)
 
         # conver ymin xmin ymax xmax -> xmin ymin xmax ymax
-        gt_bboxes = tf.squeeze(gt_bboxes, axis=0)
-        channels = tf.split(gt_bboxes, 4, axis=1)
+        channels = tf.split(gt_bboxes, 4, axis=-1)
         gt_bboxes = tf.concat([
             channels[1], channels[0], channels[3], channels[2]
-        ], axis=1)
+        ], axis=-1)
 
         # set labels to int32
-        gt_labels = tf.to_int32(tf.squeeze(gt_labels, axis=0))
+        gt_labels = tf.to_int32(gt_labels)
+
+        if len(features) == 5:
+            model_inputs = (image, gt_bboxes, gt_labels, image_shapes, num_bboxes)
+
+            # summary 时只展示 batch 中的第一张图片
+            image = image[:1, :image_shapes[0][0], :image_shapes[0][1]]
+            gt_bboxes = gt_bboxes[0, :num_bboxes[0]]
+            gt_labels = gt_labels[0, :num_bboxes[0]]
+        else:
+            model_inputs = (image, gt_bboxes, gt_labels) + anchor_targets
 
         # train one step
-        with tf.GradientTape() as tape:
-            rpn_cls_loss, rpn_reg_loss, roi_cls_loss, roi_reg_loss = base_model((image, gt_bboxes, gt_labels), True)
-            l2_loss = tf.add_n(base_model.losses)
-            total_loss = rpn_cls_loss + rpn_reg_loss + roi_cls_loss + roi_reg_loss + l2_loss
-            train_step(base_model, total_loss, tape, optimizer)
+        if compiled_train_step is not None:
+            losses = compiled_train_step(model_inputs)
+        else:
+            losses = eager_train_step(base_model, optimizer, model_inputs)
+        rpn_cls_loss, rpn_reg_loss, roi_cls_loss, roi_reg_loss, l2_loss, total_loss = losses
+        if data_offset is not None:
+            data_offset.assign_add(num_images)
 
         # summary
         if idx % summary_every_n_steps == 0:
@@ -113,6 +252,8 @@ def train_one_epoch(dataset, base_model, optimizer,
 
             pred_bboxes, pred_labels, pred_scores = base_model(image, False)
 
+            # uint8_image 时输入的是 uint8 rgb 图片，不需要反归一化
+            show_preprocessing_type = None if CONFIG['uint8_image'] else preprocessing_type
             if pred_bboxes is not None:
                 selected_idx = tf.where(pred_scores >= CONFIG['show_image_score_threshold'])[:, 0]
                 if tf.size(selected_idx) != 0:
@@ -121,7 +262,7 @@ def train_one_epoch(dataset, base_model, optimizer,
                     show_gt_bboxes = tf.concat([gt_channels[1], gt_channels[0], gt_channels[3], gt_channels[2]], axis=1)
                     gt_image = show_one_image(tf.squeeze(image, axis=0).numpy(), show_gt_bboxes.numpy(),
                                               gt_labels.numpy(),
-                                              preprocessing_type=preprocessing_type,
+                                              preprocessing_type=show_preprocessing_type,
                                               caffe_pixel_means=CONFIG['bgr_pixel_means'],
                                               enable_matplotlib=False)
                     tf.contrib.summary.image("gt_image", tf.expand_dims(gt_image, axis=0))
@@ -136,7 +277,7 @@ def train_one_epoch(dataset, base_model, optimizer,
                     pred_image = show_one_image(tf.squeeze(image, axis=0).numpy(),
                                                 show_pred_bboxes.numpy(),
                                                 pred_labels.numpy(),
-                                                preprocessing_type=preprocessing_type,
+                                                preprocessing_type=show_preprocessing_type,
                                                 caffe_pixel_means=CONFIG['bgr_pixel_means'],
                                                 enable_matplotlib=False)
                     tf.contrib.summary.image("pred_image", tf.expand_dims(pred_image, axis=0))
@@ -154,12 +295,35 @@ def train_one_epoch(dataset, base_model, optimizer,
 
         # saving
         if saver is not None and save_path is not None and idx % save_every_n_steps == 0 and idx != 0:
-            saver.save(os.path.join(save_path, 'model.ckpt'), global_step=tf.train.get_or_create_global_step())
+            saver.save(os.path.join(save_path, 'model.ckpt'), global_step=global_step)
+
 
-        idx += 1
+def _get_data_state_variables():
+    """
+    数据输入流程的状态，与模型参数保存在同一个 checkpoint 中，用于从中断处恢复训练
+    epoch:          当前 epoch
+    offset:         当前 epoch 中已经训练的图片数量，恢复时在解码之前跳过这些图片
+    shuffle_seed:   第 i 个 epoch 的 shuffle seed 为 shuffle_seed + i，恢复后图片顺序不变
+    """
+    return {
+        'epoch': tf.Variable(0, dtype=tf.int64, trainable=False, name='data_epoch'),
+        'offset': tf.Variable(0, dtype=tf.int64, trainable=False, name='data_offset'),
+        'shuffle_seed': tf.Variable(np.random.randint(0, 2 ** 31 - 1 - CONFIG['epochs']), dtype=tf.int64,
+                                    trainable=False, name='data_shuffle_seed'),
+    }
+
+
+def _restore(saver, model_saver, data_state_variables, ckpt_file_path):
+    # 之前的 checkpoint 中没有数据输入流程的状态，只恢复模型参数
+    saved_names = set(name for name, _ in tf.train.list_variables(ckpt_file_path))
+    if all(var.name.split(':')[0] in saved_names for var in data_state_variables.values()):
+        saver.restore(ckpt_file_path)
+    else:
+        tf_logging.info('no data state in {}, only restore model variables'.format(ckpt_file_path))
+        model_saver.restore(ckpt_file_path)
 
 
-def train(training_dataset,
+def train(get_training_dataset_fn,
           preprocessing_type,
 
           base_model,
@@ -173,33 +337,77 @@ def train(training_dataset,
           train_dir,
           ckpt_dir,
           restore_ckpt_file_path,
+
+          use_defun=False,
+          max_num_traces=32,
+          batch_size=1,
           ):
     # 获取 pretrained model
     variables = base_model.variables + [tf.train.get_or_create_global_step()]
-    saver = eager_saver.Saver(variables)
+    model_saver = eager_saver.Saver(variables)
+    data_state = _get_data_state_variables()
+    saver = eager_saver.Saver(variables + list(data_state.values()))
 
     # 命令行指定 ckpt file
     if restore_ckpt_file_path is not None:
-        saver.restore(restore_ckpt_file_path)
+        _restore(saver, model_saver, data_state, restore_ckpt_file_path)
 
     # 当前 logs_dir 中的预训练模型，用于继续训练
     if tf.train.latest_checkpoint(ckpt_dir) is not None:
-        saver.restore(tf.train.latest_checkpoint(ckpt_dir))
+        _restore(saver, model_saver, data_state, tf.train.latest_checkpoint(ckpt_dir))
+
+    # 编译后的训练 step，每个 shape bucket trace 一次
+    compiled_train_step = None
+    if use_defun:
+        if batch_size == 1:
+            # batch_size 为 1 时没有 aspect ratio bucketing，几乎每张图片的尺寸都不同，
+            # 前 max_num_traces 个 step 都需要 trace，之后都以 eager 模式运行，比不编译更慢
+            tf_logging.warning('use_defun with batch size 1 traces almost every image shape, '
+                               'only the first %d shapes are compiled, set batch_size > 1 to use shape buckets'
+                               % max_num_traces)
+        compiled_train_step = CompiledTrainStep(base_model, optimizer, max_num_traces=max_num_traces)
 
     train_writer = tf.contrib.summary.create_file_writer(train_dir, flush_millis=100000)
-    for i in range(CONFIG['epochs']):
+    for i in range(int(data_state['epoch'].numpy()), CONFIG['epochs']):
         tf_logging.info('epoch %d starting...' % (i + 1))
         start = time.time()
+        skip = int(data_state['offset'].numpy())
+        if skip > 0 and batch_size > 1:
+            # group_by_window 会改变图片顺序，已经训练的图片不是 shuffle 结果的前 skip 个，不能从中间恢复
+            tf_logging.warning('can not resume epoch %d from image %d when batch size > 1, '
+                               'restart the epoch from the beginning' % (i + 1, skip))
+            skip = 0
+            data_state['offset'].assign(0)
+        if skip > 0:
+            tf_logging.info('resume epoch %d from image %d' % (i + 1, skip))
+        # 每个 epoch 构建 dataset 之前设置 graph-level seed，与 op-level 的 shuffle_seed 一起决定 shuffle 结果，
+        # 从 checkpoint 恢复后得到与中断前相同的图片顺序
+        shuffle_seed = int(data_state['shuffle_seed'].numpy()) + i
+        tf.set_random_seed(shuffle_seed)
+        training_dataset = get_training_dataset_fn(shuffle_seed=shuffle_seed, skip=skip)
         with train_writer.as_default(), summary.always_record_summaries():
             train_one_epoch(dataset=training_dataset, base_model=base_model,
                             optimizer=optimizer, preprocessing_type=preprocessing_type,
                             logging_every_n_steps=logging_every_n_steps,
                             summary_every_n_steps=summary_every_n_steps,
                             saver=saver, save_every_n_steps=save_every_n_steps, save_path=ckpt_dir,
+                            compiled_train_step=compiled_train_step,
+                            data_offset=data_state['offset'],
                             )
-        tf.set_random_seed(1)
+        data_state['epoch'].assign(i + 1)
+        data_state['offset'].assign(0)
+        saver.save(os.path.join(ckpt_dir, 'model.ckpt'), global_step=tf.train.get_or_create_global_step())
         train_end = time.time()
         tf_logging.info('epoch %d training finished, costing %d seconds...' % (i + 1, train_end - start))
+        tf_logging.info('anchor cache stats: {}'.format(base_model.anchor_cache_stats))
+        image_cache_stats = get_all_image_cache_stats()
+        if image_cache_stats:
+            tf_logging.info('image cache stats: {}'.format(image_cache_stats))
+        anchor_target_cache_stats = get_all_anchor_target_cache_stats()
+        if anchor_target_cache_stats:
+            tf_logging.info('anchor target cache stats: {}'.format(anchor_target_cache_stats))
+        if compiled_train_step is not None:
+            tf_logging.info('compiled train step stats: {}'.format(compiled_train_step.get_stats()))
 
 
 def parse_args():
@@ -218,11 +426,36 @@ def parse_args():
 
     # coco
     parser.add_argument('--coco_year', default="2017", type=str, help='one of [2014, 2017]')
+    parser.add_argument('--coco_tf_records_dir', default=None, type=str,
+                        help='path to tf records generated by `generate_coco_tf_records.py`, '
+                             'if None, load images from coco root dir')
+    parser.add_argument('--image_cache_dir', default=None, type=str,
+                        help='path to save resized images, shared with evaluation, '
+                             'only used when loading images from coco root dir')
+    parser.add_argument('--image_cache_max_gb', default=50, type=float, help='max size of resized images cache')
 
     # pascal
     parser.add_argument('--pascal_year', default="2007", type=str, help='one of [2007, 2012, 0712]')
     parser.add_argument('--pascal_mode', default="trainval", type=str, help='one of [trainval, train, val]')
     parser.add_argument('--pascal_tf_records_num', default=5, type=int, help='number of pascal tf records')
+    parser.add_argument('--pascal_use_tf_record_index', default=False, type=bool,
+                        help='random access tf records by index files, shuffle all records without shuffle buffer')
+
+    parser.add_argument('--argument_type', default='imgaug', type=str,
+                        help='one of [imgaug, tf, imgaug_pool], `tf` means pure tensorflow data argument without '
+                             'tf.py_func, `imgaug_pool` means running imgaug in worker processes')
+    parser.add_argument('--imgaug_num_workers', default=4, type=int,
+                        help='number of imgaug processes, only used when argument_type is imgaug_pool')
+
+    parser.add_argument('--shuffle', default=False, type=bool,
+                        help='shuffle images before decoding, the shuffle seed is saved in checkpoints')
+    parser.add_argument('--anchor_target_in_dataset', default=False, type=bool,
+                        help='compute anchor target in tf.data pipeline, only support batch size 1')
+    parser.add_argument('--anchor_target_cache_dir', default=None, type=str,
+                        help='path to anchor target cache generated by `generate_anchor_target_cache.py`, '
+                             'implies anchor_target_in_dataset, unseen images fall back to live computation')
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help='images will be grouped by aspect ratio and padded when batch size > 1')
 
     parser.add_argument('--logging_every_n_steps', default=100, type=int)
     parser.add_argument('--saving_every_n_steps', default=5000, type=int)
@@ -231,6 +464,12 @@ def parse_args():
 
     parser.add_argument('--use_adam', type=bool, default=False)
 
+    parser.add_argument('--use_defun', type=bool, default=False,
+                        help='compile train step by `tf.contrib.eager.defun`, one graph per image shape bucket, '
+                             'should be used with batch_size > 1')
+    parser.add_argument('--max_num_traces', default=32, type=int,
+                        help='max number of traced shape buckets, unseen shapes after that run eagerly')
+
     parser.add_argument('--logs_name', type=str, default='default',
                         help='logs dir name pattern is `logs-{data_type}-{model_type}-{backbone}-{logs_name}`', )
 
@@ -270,14 +509,32 @@ def main(args):
     logs_name_pattern = 'logs-{}-{}-{}-{}'
     logs_path_name = logs_name_pattern.format(args.data_type, args.model_type, args.backbone, args.logs_name)
 
+    # 数据集中计算 anchor target，可以通过离线缓存跳过 iou 计算
+    anchor_target_fn = None
+    if args.anchor_target_cache_dir is not None:
+        anchor_target_fn = partial(cur_model.get_anchor_target,
+                                   anchor_target_cache=get_anchor_target_cache(args.anchor_target_cache_dir))
+    elif args.anchor_target_in_dataset:
+        anchor_target_fn = cur_model.get_anchor_target
+
     # 开始训练
-    train(training_dataset=_get_training_dataset(preprocessing_type=preprocessing_type,
-                                                 dataset_type=args.data_type,
-                                                 coco_year=args.coco_year,
-                                                 pascal_year=args.pascal_year,
-                                                 pascal_mode=args.pascal_mode,
-                                                 pascal_tf_records_num=args.pascal_tf_records_num,
-                                                 data_root_path=args.data_root_path),
+    train(get_training_dataset_fn=partial(_get_training_dataset,
+                                          preprocessing_type=preprocessing_type,
+                                          dataset_type=args.data_type,
+                                          coco_year=args.coco_year,
+                                          coco_tf_records_dir=args.coco_tf_records_dir,
+                                          pascal_year=args.pascal_year,
+                                          pascal_mode=args.pascal_mode,
+                                          pascal_tf_records_num=args.pascal_tf_records_num,
+                                          pascal_use_tf_record_index=args.pascal_use_tf_record_index,
+                                          data_root_path=args.data_root_path,
+                                          argument_type=args.argument_type,
+                                          batch_size=args.batch_size,
+                                          image_cache_dir=args.image_cache_dir,
+                                          image_cache_max_bytes=args.image_cache_max_gb * 1024 ** 3,
+                                          imgaug_num_workers=args.imgaug_num_workers,
+                                          shuffle=args.shuffle,
+                                          anchor_target_fn=anchor_target_fn),
           preprocessing_type=preprocessing_type,
 
           base_model=cur_model,
@@ -291,6 +548,10 @@ def main(args):
           train_dir=os.path.join(args.logs_dir, logs_path_name, 'train'),
           ckpt_dir=os.path.join(args.logs_dir, logs_path_name, 'ckpt'),
           restore_ckpt_file_path=args.restore_ckpt_path,
+
+          use_defun=args.use_defun,
+          max_num_traces=args.max_num_traces,
+          batch_size=args.batch_size,
           )
 
 